@@ -113,6 +113,11 @@ ROOT_URLCONF = 'btctrader.urls'
 # Celery settings
 BROKER_URL = "django://"
 
+# Whether pages get live updates pushed over a server-sent event stream (or long-polling).
+# Each waiting client holds a web worker, so only enable this when serving with
+# asynchronous workers (e.g. gunicorn with gevent) - otherwise pages poll for updates
+TRADER_EVENT_STREAM = False
+
 # Python dotted path to the WSGI application used by Django's runserver.
 WSGI_APPLICATION = 'btctrader.wsgi.application'
 
@@ -10,12 +10,17 @@ urlpatterns = patterns(
     url(r'^/?$', 'index', name='index'),
     url(r'^market/(?P<market_id>\d+)/?$', 'market_view', name='market_view'),
     url(r'^dashboard/?$', 'dashboard', name='dashboard'),
+    url(r'^orders/?$', 'order_history', name='order_history'),
 )
 
 # Trader API
 urlpatterns += patterns(
     'trader.views',
     url(r'^order/submit/?$', 'order_submit', name='order_submit'),
+    url(r'^orders/list/?$', 'order_list', name='order_list'),
+    url(r'^prices/?$', 'price_snapshot', name='price_snapshot'),
+    url(r'^events/stream/?$', 'event_stream', name='event_stream'),
+    url(r'^events/?$', 'event_poll', name='event_poll'),
 )
 
 # Admin
@@ -1,15 +1,56 @@
 from django.utils import timezone
+from django.db import connection, transaction
 from celery import Celery
-from models import Market, Order, Trader, HistoricalTrade
+from celery.signals import worker_process_init
+from models import Market, Order, Trader, Currency, HistoricalTrade, HistoricalImport, MarketPrice
 from trader_settings import trader_settings
+from utils import datetime_to_timestamp, get_market_setting, timestamp_to_datetime
+import tradestore
+import archive
+import candles
+import events
+import snapshot
+import numpy as np
 import requests
-from datetime import timedelta
+from cStringIO import StringIO
+from datetime import datetime, timedelta
+from decimal import Decimal
+import logging
+import os
+import time
 
 
+logger = logging.getLogger(__name__)
+
 default_settings = trader_settings()
 
 celery = Celery('agent', broker='django://')
 
+
+def warm_up():
+    """
+    Build the API objects for every market used for automated trading, and the
+    algorithm objects for every enabled trader, and start fetching each
+    market's trade fee - so none of this happens during the first trading run.
+    Makes no API calls itself: get_trade_fee returns the default fee straight
+    away, and fetches the actual fee on the market thread pool
+    """
+    for market in Market.objects.filter(automated_trading_enabled=True):
+        market.market_api.get_trade_fee()
+    for trader in Trader.objects.filter(enabled=True):
+        trader.algo
+
+
+@worker_process_init.connect
+def warm_up_worker(**kwargs):
+    # The worker was forked from a parent that may have a database connection open
+    # (e.g. for the django:// broker) - never share its socket
+    connection.close()
+    try:
+        warm_up()
+    except Exception:
+        logger.exception('Unable to warm up worker')
+
 MARKET_HISTORICAL_DATA_MAP = {
     'mtgox': ('mtgoxUSD', 'BTC', 'USD'),
 
@@ -17,47 +58,568 @@ MARKET_HISTORICAL_DATA_MAP = {
 
 BITCOINCHARTS_TRADES_URL = 'http://api.bitcoincharts.com/v1/trades.csv?symbol=%s&end=%s'
 
-HISTORICAL_DATA_LOCATION = 'historical_data/%s.csv'
+HISTORICAL_DATA_LOCATION = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'historical_data', '%s.csv')
+
+# Number of bytes read from a historical data file at a time
+HISTORICAL_IMPORT_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Number of trades written to the database per batch (and per transaction)
+HISTORICAL_IMPORT_BATCH_SIZE = 50000
+
+# Seconds to wait for a single page of trades from bitcoincharts
+BITCOINCHARTS_TIMEOUT = 30
+
+# Size of the time ranges old data is expired in, by enforce_retention
+RETENTION_CHUNK = timedelta(days=1)
+
+# HistoricalTrade stores prices and amounts to 5 decimal places
+HISTORICAL_TRADE_PRECISION = Decimal('0.00001')
+
+# Per-process state for the incremental trade sync, keyed by (market id, symbol)
+# The high-water mark is the unix timestamp of the newest stored trade
+historical_high_water_marks = {}
+historical_sync_times = {}
+
+
+def iter_csv_trades(csv_file, chunk_size=HISTORICAL_IMPORT_CHUNK_SIZE, min_timestamp=None, max_timestamp=None):
+    """
+    Streams (timestamp, price, amount) tuples out of a bitcoincharts style CSV
+    file, reading it in fixed-size chunks so the whole file is never held in
+    memory. Price and amount are left as strings - the database does the
+    conversion to a decimal, which is far cheaper than creating Decimal objects
+    here. Rows older than min_timestamp, or at or after max_timestamp, are skipped.
+    """
+    remainder = ''
+    while True:
+        chunk = csv_file.read(chunk_size)
+        if not chunk:
+            break
+
+        lines = (remainder + chunk).split('\n')
+
+        # The last line is very likely incomplete - carry it over to the next chunk
+        remainder = lines.pop()
+
+        for line in lines:
+            row = parse_csv_trade(line, min_timestamp, max_timestamp)
+            if row is not None:
+                yield row
+
+    row = parse_csv_trade(remainder, min_timestamp, max_timestamp)
+    if row is not None:
+        yield row
+
+
+def parse_csv_trade(line, min_timestamp=None, max_timestamp=None):
+    """
+    Parse a single "timestamp,price,amount" line. Returns None for blank or
+    malformed lines, as well as lines older than min_timestamp or at or after
+    max_timestamp
+    """
+    fields = line.strip().split(',')
+    if len(fields) != 3:
+        return None
+
+    try:
+        timestamp = int(fields[0])
+    except ValueError:
+        # Most likely a header row
+        return None
+
+    if min_timestamp is not None and timestamp < min_timestamp:
+        return None
+    if max_timestamp is not None and timestamp >= max_timestamp:
+        return None
+
+    return timestamp, fields[1], fields[2]
+
+
+def insert_historical_trades(market, currency_from, currency_to, rows):
+    """
+    Insert a batch of (timestamp, price, amount) tuples as HistoricalTrade rows,
+    within the caller's transaction. Uses COPY when running on PostgreSQL, and
+    falls back to bulk_create for any other database.
+    """
+    if connection.vendor == 'postgresql':
+        copy_historical_trades(market, currency_from, currency_to, rows)
+    else:
+        HistoricalTrade.objects.bulk_create([
+            HistoricalTrade(market=market,
+                            currency_from=currency_from,
+                            currency_to=currency_to,
+                            time=timestamp_to_datetime(timestamp),
+                            price=price,
+                            amount=amount)
+            for timestamp, price, amount in rows
+        ])
+
+
+def copy_historical_trades(market, currency_from, currency_to, rows):
+    """
+    Stream a batch of trades into the HistoricalTrade table using PostgreSQL
+    COPY, which avoids building a model instance (and INSERT) per row
+    """
+    meta = HistoricalTrade._meta
+    columns = [meta.get_field(name).column
+               for name in ('market', 'currency_from', 'currency_to', 'time', 'price', 'amount')]
+    prefix = '%d\t%d\t%d\t' % (market.id, currency_from.id, currency_to.id)
+
+    buf = StringIO()
+    last_timestamp = None
+    time_str = None
+    for timestamp, price, amount in rows:
+        # Many trades share the same second - only format the time when it changes
+        if timestamp != last_timestamp:
+            time_str = datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S+00')
+            last_timestamp = timestamp
+        buf.write('%s%s\t%s\t%s\n' % (prefix, time_str, price, amount))
+    buf.seek(0)
+
+    cursor = connection.cursor()
+    cursor.copy_from(buf, meta.db_table, columns=columns)
+
+
+def get_latest_historical_timestamp(market, currency_from, currency_to):
+    """
+    Returns the unix timestamp of the newest HistoricalTrade stored for the
+    given market/currency pair, or None if there are no trades
+    """
+    latest = HistoricalTrade.objects.filter(market=market, currency_from=currency_from, currency_to=currency_to)\
+                                    .order_by('-time').values_list('time', flat=True)[:1]
+    if len(latest) == 0:
+        return None
+    return datetime_to_timestamp(latest[0])
+
+
+def get_earliest_historical_timestamp(market, currency_from, currency_to, since=None):
+    """
+    Returns the unix timestamp of the oldest HistoricalTrade stored for the given
+    market/currency pair at or after the since timestamp, or None if there are none
+    """
+    trades = HistoricalTrade.objects.filter(market=market, currency_from=currency_from, currency_to=currency_to)
+    if since is not None:
+        trades = trades.filter(time__gte=timestamp_to_datetime(since))
+    earliest = trades.order_by('time').values_list('time', flat=True)[:1]
+    if len(earliest) == 0:
+        return None
+    return datetime_to_timestamp(earliest[0])
+
+
+def get_import_progress(symbol):
+    """
+    Returns the unix timestamp of the newest trade imported from the symbol's
+    CSV dump, or None if it hasn't been imported
+    """
+    last_times = HistoricalImport.objects.filter(symbol=symbol).values_list('last_time', flat=True)[:1]
+    if len(last_times) == 0:
+        return None
+    return datetime_to_timestamp(last_times[0])
+
+
+def set_import_progress(symbol, timestamp):
+    """
+    Record the newest trade imported from the symbol's CSV dump, within the
+    caller's transaction
+    """
+    last_time = timestamp_to_datetime(timestamp)
+    if HistoricalImport.objects.filter(symbol=symbol).update(last_time=last_time) == 0:
+        HistoricalImport.objects.create(symbol=symbol, last_time=last_time)
+
+
+def write_archive_trades(trade_archive, rows):
+    """
+    Append a batch of (timestamp, price, amount) tuples to a TradeArchive
+    """
+    timestamps, prices, amounts = zip(*rows)
+    trade_archive.append(timestamps,
+                         np.array(prices, dtype=np.float64),
+                         np.array(amounts, dtype=np.float64))
 
 
 @celery.task
-def import_historical_data():
-    for abbrev, params in MARKET_HISTORICAL_DATA_MAP:
-        market = Market.objects.get(abbrev=abbrev)
+def import_historical_data(symbols=None,
+                           chunk_size=HISTORICAL_IMPORT_CHUNK_SIZE,
+                           batch_size=HISTORICAL_IMPORT_BATCH_SIZE,
+                           to_archive=False):
+    """
+    Bulk import the bitcoincharts CSV dumps found in the historical_data folder.
+
+    The import is streamed and written in batches, so files with tens of millions
+    of rows can be imported in constant memory. It is also resumable - progress is
+    recorded (as a HistoricalImport) with each batch, and only trades at or after
+    the newest imported trade are imported. Trades sharing that final second are
+    removed and re-imported, since bitcoincharts files can have many trades per
+    second and a previous run may have stopped part way through them.
+
+    Any newer trades already stored came from the live sync (update_current_data),
+    so the import stops short of the oldest of them.
+
+    If to_archive is True, trades are converted into a memory-mapped TradeArchive
+    per symbol instead of being written to the database.
+
+    Returns a dictionary of symbol -> (rows imported, seconds taken)
+    """
+    stats = {}
+
+    for abbrev, params in MARKET_HISTORICAL_DATA_MAP.items():
         symbol = params[0]
-        currency_from = params[1]
-        currency_to = params[2]
+        if symbols is not None and symbol not in symbols:
+            continue
+
+        if to_archive:
+            trade_archive = archive.TradeArchive(symbol)
+            min_timestamp = trade_archive.last_timestamp
+            max_timestamp = None
+            if min_timestamp is not None:
+                trade_archive.truncate(min_timestamp)
+
+            def write(batch):
+                write_archive_trades(trade_archive, batch)
+        else:
+            market = Market.objects.get(abbrev=abbrev)
+            currency_from = Currency.objects.get(abbrev=params[1])
+            currency_to = Currency.objects.get(abbrev=params[2])
+
+            min_timestamp = get_import_progress(symbol)
+            if min_timestamp is not None:
+                with transaction.commit_on_success():
+                    HistoricalTrade.objects.filter(market=market,
+                                                   currency_from=currency_from,
+                                                   currency_to=currency_to,
+                                                   time__gte=timestamp_to_datetime(min_timestamp),
+                                                   time__lt=timestamp_to_datetime(min_timestamp + 1)).delete()
+                max_timestamp = get_earliest_historical_timestamp(market, currency_from, currency_to,
+                                                                  min_timestamp + 1)
+            else:
+                max_timestamp = get_earliest_historical_timestamp(market, currency_from, currency_to)
+
+            def write(batch):
+                with transaction.commit_on_success():
+                    insert_historical_trades(market, currency_from, currency_to, batch)
+                    set_import_progress(symbol, batch[-1][0])
+
+        start = time.time()
+        total = 0
+        batch = []
+        with open(HISTORICAL_DATA_LOCATION % symbol, 'rb') as historical_file:
+            for row in iter_csv_trades(historical_file, chunk_size, min_timestamp, max_timestamp):
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    write(batch)
+                    total += len(batch)
+                    batch = []
+
+                    elapsed = time.time() - start
+                    logger.info('%s: imported %d trades (%.0f rows/sec)', symbol, total, total / max(elapsed, 1e-6))
+
+        if len(batch) > 0:
+            write(batch)
+            total += len(batch)
+
+        elapsed = time.time() - start
+        logger.info('%s: finished importing %d trades in %.1f seconds (%.0f rows/sec)',
+                    symbol, total, elapsed, total / max(elapsed, 1e-6))
+        stats[symbol] = (total, elapsed)
+
+    return stats
+
+
+def fetch_bitcoincharts_trades(symbol, end, timeout=BITCOINCHARTS_TIMEOUT):
+    """
+    Fetch a single page of trades from the bitcoincharts API, ending at the given
+    unix timestamp. Returns a list of (timestamp, price, amount) tuples, in the
+    order the API returned them
+    """
+    try:
+        resp = requests.get(BITCOINCHARTS_TRADES_URL % (symbol, end), timeout=timeout)
+    except requests.RequestException as e:
+        return False, 'bitcoincharts request failed: %s' % e, None
+
+    if resp.status_code != 200:
+        return False, 'bitcoincharts request failed: API returned status %s' % resp.status_code, resp
+
+    rows = []
+    for line in resp.text.split('\n'):
+        row = parse_csv_trade(line)
+        if row is not None:
+            rows.append(row)
+
+    return True, None, rows
+
+
+def get_high_water_mark(market, currency_from, currency_to, symbol):
+    """
+    Returns the timestamp of the newest trade known to be stored for the symbol.
+    Only hits the database the first time it is called in a given process
+    """
+    key = (market.id, symbol)
+    if key not in historical_high_water_marks:
+        historical_high_water_marks[key] = get_latest_historical_timestamp(market, currency_from, currency_to)
+    return historical_high_water_marks[key]
+
+
+def quantize_trade(timestamp, price, amount):
+    """
+    Normalize a trade to the precision it is stored with, so fetched trades can
+    be compared against those already in the database
+    """
+    return timestamp, Decimal(price).quantize(HISTORICAL_TRADE_PRECISION), \
+        Decimal(amount).quantize(HISTORICAL_TRADE_PRECISION)
+
+
+def fetch_trades_since(symbol, floor, end):
+    """
+    Page backwards through the bitcoincharts API from end until reaching trades
+    at or before the floor timestamp. Returns a set of the (quantized) trades at
+    or after floor - or a failure if a page couldn't be fetched, since the trades
+    fetched so far would leave a gap behind them
+    """
+    trades = set()
+    while True:
+        success, err, rows = fetch_bitcoincharts_trades(symbol, end)
+        if not success:
+            return success, err, rows
+
+        oldest = None
+        for timestamp, price, amount in rows:
+            if timestamp >= floor:
+                trades.add(quantize_trade(timestamp, price, amount))
+            if oldest is None or timestamp < oldest:
+                oldest = timestamp
+
+        if oldest is not None and oldest <= floor:
+            return True, None, trades
+
+        if oldest is None or oldest >= end:
+            # The API has nothing older to give us, so the gap can never be filled
+            logger.warning('%s: no trades available between %d and %d', symbol, floor, end)
+            return True, None, trades
+        end = oldest
+
+
+def remove_stored_trades(market, currency_from, currency_to, trades):
+    """
+    Remove the trades that are already stored from a set of (quantized) trades,
+    going by the newest stored trade - everything before it is assumed stored,
+    and trades in its second are compared against the database. Returns the rest
+    as a sorted list
+    """
+    latest = get_latest_historical_timestamp(market, currency_from, currency_to)
+    if latest is None:
+        return sorted(trades)
 
-        historical_file = open(HISTORICAL_DATA_LOCATION % symbol, 'r')
+    existing = HistoricalTrade.objects.filter(market=market,
+                                              currency_from=currency_from,
+                                              currency_to=currency_to,
+                                              time=timestamp_to_datetime(latest))\
+                                      .values_list('price', 'amount')
+    stored = set(quantize_trade(latest, price, amount) for price, amount in existing)
+    return sorted(trade for trade in trades if trade[0] >= latest and trade not in stored)
 
 
+@celery.task
+def update_current_data(settings=None):
+    """
+    Incrementally sync recent trades from bitcoincharts into HistoricalTrade.
+
+    Keeps a high-water mark (the newest stored trade time) per market/symbol, and
+    only fetches trades newer than it. If a page of results does not reach back
+    as far as the high-water mark then there is a gap, and older pages are
+    requested until it is filled (or the retention window is reached). If any
+    page fails nothing is written, and the next run tries again from the same
+    mark. Before writing, the market row is locked and the newest stored trade
+    re-read, so that workers syncing the same symbol never store a trade twice.
+    Each run costs O(new trades).
+    """
+    if settings is None:
+        settings = default_settings
 
-def update_current_data():
-    for abbrev, params in MARKET_HISTORICAL_DATA_MAP:
+    now = timezone.now()
+    now_timestamp = datetime_to_timestamp(now)
+    min_timestamp = datetime_to_timestamp(now + timedelta(days=-settings.historical_trades_days_to_keep))
+
+    for abbrev, params in MARKET_HISTORICAL_DATA_MAP.items():
         market = Market.objects.get(abbrev=abbrev)
         symbol = params[0]
-        currency_from = params[1]
-        currency_to = params[2]
-
-        min_time = timezone.now() + timedelta(days=-default_settings.historical_trades_days_to_keep)
+        currency_from = Currency.objects.get(abbrev=params[1])
+        currency_to = Currency.objects.get(abbrev=params[2])
+
+        # Don't bother syncing if we've done so recently
+        key = (market.id, symbol)
+        last_sync = historical_sync_times.get(key)
+        if last_sync is not None and now_timestamp - last_sync < settings.historical_trades_max_age:
+            continue
+
+        high_water_mark = get_high_water_mark(market, currency_from, currency_to, symbol)
+        floor = min_timestamp if high_water_mark is None else max(high_water_mark, min_timestamp)
+
+        # Page backwards from now until we reach trades we already have
+        success, err, new_trades = fetch_trades_since(symbol, floor, now_timestamp)
+        if not success:
+            logger.warning('%s: %s', symbol, err)
+            continue
+
+        with transaction.commit_on_success():
+            # Another worker may have synced the same trades since our high-water mark was read
+            Market.objects.select_for_update().get(id=market.id)
+            rows = remove_stored_trades(market, currency_from, currency_to, new_trades)
+            if len(rows) > 0:
+                insert_historical_trades(market, currency_from, currency_to, rows)
+
+        if len(rows) > 0:
+            historical_high_water_marks[key] = rows[-1][0]
+            tradestore.append_trades(market, currency_from, currency_to, rows,
+                                     settings.historical_trades_days_to_keep)
+            logger.info('%s: synced %d new trades', symbol, len(rows))
+
+            candles.update_market_periods(market, get_market_setting(settings, 'market_periods'),
+                                          timestamp_to_datetime(min_timestamp))
+        else:
+            # Nothing new - but the mark may be stale if another worker has synced
+            historical_high_water_marks.pop(key, None)
+
+        historical_sync_times[key] = now_timestamp
+
+
+def get_expired_ranges(model, cutoff):
+    """
+    Returns a list of (market id, currency_from id, currency_to id, start, end)
+    tuples covering all of the model's rows older than cutoff, split into whole
+    RETENTION_CHUNK time ranges (aligned to midnight UTC)
+    """
+    ranges = []
+    pairs = model.objects.filter(time__lt=cutoff).values_list('market', 'currency_from', 'currency_to').distinct()
+    for market_id, currency_from_id, currency_to_id in pairs:
+        oldest = model.objects.filter(market=market_id,
+                                      currency_from=currency_from_id,
+                                      currency_to=currency_to_id)\
+                              .order_by('time').values_list('time', flat=True)[:1]
+        if len(oldest) == 0:
+            continue
+
+        start = oldest[0].astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        while start < cutoff:
+            end = min(start + RETENTION_CHUNK, cutoff)
+            ranges.append((market_id, currency_from_id, currency_to_id, start, end))
+            start = end
+
+    return ranges
+
+
+def delete_range(model, market_id, currency_from_id, currency_to_id, start, end):
+    """
+    Delete all of the model's rows for the market/currency pair in [start, end)
+    with a single range DELETE over the (market, currency_from, currency_to,
+    time) index, rather than fetching and deleting each row. Returns the number
+    of rows deleted
+    """
+    meta = model._meta
+    columns = [meta.get_field(name).column for name in ('market', 'currency_from', 'currency_to', 'time')]
+    cursor = connection.cursor()
+    cursor.execute('DELETE FROM %s WHERE %s = %%s AND %s = %%s AND %s = %%s AND %s >= %%s AND %s < %%s' %
+                   tuple([connection.ops.quote_name(meta.db_table)] +
+                         [connection.ops.quote_name(column) for column in columns + columns[-1:]]),
+                   [market_id, currency_from_id, currency_to_id, start, end])
+    return cursor.rowcount
 
-        existing_trades = HistoricalTrade.objects.filter(market=market, time__gt=min_time, time__lt=timezone.now())\
-                                                 .order_by('-time')
 
-        if len(existing_trades) > 0:
-            latest_trade = existing_trades[0]
+def archive_range(trade_archive, market_id, currency_from_id, currency_to_id, start, end):
+    """
+    Append the HistoricalTrades for the market/currency pair in [start, end) to
+    a TradeArchive, skipping any trades the archive already covers
+    """
+    trades = HistoricalTrade.objects.filter(market=market_id,
+                                            currency_from=currency_from_id,
+                                            currency_to=currency_to_id,
+                                            time__gte=start,
+                                            time__lt=end)
+    last_timestamp = trade_archive.last_timestamp
+    if last_timestamp is not None:
+        trades = trades.filter(time__gt=timestamp_to_datetime(last_timestamp))
 
-            if
+    rows = [(datetime_to_timestamp(time), price, amount)
+            for time, price, amount in trades.order_by('time').values_list('time', 'price', 'amount')]
+    if len(rows) > 0:
+        write_archive_trades(trade_archive, rows)
 
-        path = BITCOINCHARTS_TRADES_URL % (symbol, timestamp)
-        resp = requests.get(path)
 
+@celery.task
+def enforce_retention(settings=None):
+    """
+    Remove MarketPrices older than market_prices_days_to_keep and, if
+    historical_trades_expire is set, HistoricalTrades older than
+    historical_trades_days_to_keep. Trades are kept by default, since the
+    historical import loads far more history than that.
+
+    This is a batched DELETE, not partition dropping - the tables aren't
+    partitioned. Old rows are removed with a range DELETE per chunk (one
+    market/currency pair, one RETENTION_CHUNK of time), each in its own
+    transaction. Every expired row is still deleted (and written to the WAL,
+    and later vacuumed), but in short transactions that never hold locks on,
+    or bloat, a whole table's worth of rows at once. If
+    historical_trades_archive_expired is set, expired trades for markets in
+    MARKET_HISTORICAL_DATA_MAP are first appended to that symbol's TradeArchive.
+
+    Returns a dictionary of model name -> number of rows removed
+    """
+    if settings is None:
+        settings = default_settings
+
+    now = timezone.now()
+    expire_trades = get_market_setting(settings, 'historical_trades_expire')
+    trade_archives = {}
+    if expire_trades and get_market_setting(settings, 'historical_trades_archive_expired'):
+        for abbrev, params in MARKET_HISTORICAL_DATA_MAP.items():
+            try:
+                market = Market.objects.get(abbrev=abbrev)
+                key = (market.id, Currency.objects.get(abbrev=params[1]).id, Currency.objects.get(abbrev=params[2]).id)
+            except (Market.DoesNotExist, Currency.DoesNotExist):
+                continue
+            trade_archives[key] = archive.TradeArchive(params[0])
+
+    expiring = [(MarketPrice, get_market_setting(settings, 'market_prices_days_to_keep'))]
+    if expire_trades:
+        expiring.append((HistoricalTrade, settings.historical_trades_days_to_keep))
+
+    stats = {}
+    for model, days_to_keep in expiring:
+        deleted = 0
+        for expired_range in get_expired_ranges(model, now - timedelta(days=days_to_keep)):
+            with transaction.commit_on_success():
+                trade_archive = trade_archives.get(expired_range[:3]) if model is HistoricalTrade else None
+                if trade_archive is not None:
+                    archive_range(trade_archive, *expired_range)
+                deleted += delete_range(model, *expired_range)
+
+        if deleted > 0:
+            logger.info('%s: removed %d rows', model.__name__, deleted)
+        stats[model.__name__] = deleted
+
+    return stats
 
 
 def update_prices(markets, timestamp, settings):
-    for market in markets:
-        # Update prices based for given time range
-        pass
+    """
+    Bring the current price of every market up to date, and publish them in the
+    price snapshot. All markets are queried at the same time, so this takes as
+    long as the slowest market rather than the sum of them all. Returns a
+    dictionary of market id -> MarketPrice, for the markets that were updated
+    successfully
+    """
+    pending = [(market, market.market_api.api_get_current_market_price_async()) for market in markets]
+
+    prices = {}
+    for market, result in pending:
+        success, err, market_price = result.get()
+        if success:
+            prices[market.id] = market_price
+        else:
+            logger.warning('%s: unable to update price: %s', market.abbrev, err)
+
+    # Keep the snapshot served to the web interface up to date
+    snapshot.publish_prices(markets, prices)
+
+    return prices
 
 
 @celery.task
@@ -73,21 +635,71 @@ def build_orders(markets, traders, timestamp, settings):
     used to run historical simulations for performance optimization.
 
     This function is also "const" in that it will not modify or add
-    anything to the database.
+    anything to the database - other than the state traders claim so that
+    concurrent workers don't act on the same data twice (see EmaTrader).
     """
 
     orders = []
 
     # Run various trade algorithms
     for trader in traders:
-        orders.append(trader.algo.build_orders(markets, timestamp, settings))
+        orders.extend(trader.algo.build_orders(markets, timestamp, settings))
 
     return orders
 
 
 def execute_orders(orders):
+    """
+    Submit a list of orders to their markets. The orders are saved (as not yet
+    submitted) before any of them are sent, so that every order that reaches a
+    market is recorded, even if this process dies part way through. Orders for
+    different markets are submitted concurrently (so e.g. both legs of an
+    arbitrage go out together), while orders for the same market are submitted
+    one after another, in the order given, subject to the market's rate limit.
+
+    Once every market has responded, all of the orders are saved again with
+    their new statuses, in a single transaction. Returns a list of the
+    (success, err, result) tuple for each order
+    """
+    save_orders(orders, publish=False)
+
+    by_market = {}
     for order in orders:
-        order.market.market_api.api_execute_order(order)
+        by_market.setdefault(order.market.id, []).append(order)
+
+    pending = [(market_orders, market_orders[0].market.market_api.api_execute_orders_async(market_orders))
+               for market_orders in by_market.values()]
+
+    results = {}
+    for market_orders, result in pending:
+        success, err, order_results = result.get()
+        if not success:
+            # Something unexpected stopped the batch part way through - any orders it
+            # had already submitted have been updated, so only fail the rest
+            order_results = [(True, None, None) if order.status != 'N' else (success, err, None)
+                             for order in market_orders]
+        for order, order_result in zip(market_orders, order_results):
+            if not order_result[0]:
+                logger.warning('%s: unable to execute order: %s', order.market.abbrev, order_result[1])
+            results[id(order)] = order_result
+
+    save_orders(orders)
+
+    return [results[id(order)] for order in orders]
+
+
+def save_orders(orders, publish=True):
+    """
+    Save a list of orders in a single transaction, then (if publish is set)
+    publish them as an 'orders' event. Orders are saved one at a time, rather
+    than with bulk_create, so that new orders get their ids
+    """
+    with transaction.commit_on_success():
+        for order in orders:
+            order.save()
+
+    if publish and len(orders) > 0:
+        events.publish('orders', [events.order_entry(order) for order in orders])
 
 
 @celery.task
@@ -124,11 +736,14 @@ def run_trader(
     # Build orders
     orders = build_orders(markets, traders, timestamp, settings)
 
-    # Save orders - build_orders does not do this itself
-    Order.objects.bulk_create(orders)
+    # Persist any state the traders built up along the way
+    for trader in traders:
+        trader.algo.save_state()
 
-    # Execute orders
+    # Execute orders, and save them - build_orders does not do this itself
     if should_execute_orders:
         execute_orders(orders)
+    else:
+        save_orders(orders)
 
     return orders
\ No newline at end of file
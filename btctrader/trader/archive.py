@@ -0,0 +1,165 @@
+import numpy as np
+import os
+
+
+ARCHIVE_LOCATION = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'historical_data', '%s.trades')
+
+ARCHIVE_INDEX_LOCATION = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'historical_data', '%s.index')
+
+# Fixed-width, little-endian trade record. Be VERY careful - changing this
+# invalidates every existing archive
+TRADE_RECORD_DTYPE = np.dtype([('time', '<i8'), ('price', '<f8'), ('amount', '<f8')])
+
+# Sparse time index entry - the time of every ARCHIVE_INDEX_INTERVAL'th record,
+# and its position in the archive
+INDEX_RECORD_DTYPE = np.dtype([('time', '<i8'), ('position', '<i8')])
+
+ARCHIVE_INDEX_INTERVAL = 4096
+
+
+class TradeArchive(object):
+    """
+    Binary, append-only, memory-mapped archive of trades for a single symbol.
+
+    Trades are stored as fixed-width records sorted by time, alongside a sparse
+    index of every ARCHIVE_INDEX_INTERVAL'th record. Range queries use the index
+    to find the handful of pages to binary search, and return zero-copy views
+    onto the mapped file, so months of ticks can be read without loading (or
+    even touching) the rest of the archive.
+
+    Readers expose the same window() interface as tradestore.TradeStore.
+    """
+
+    def __init__(self, symbol):
+        self.symbol = symbol
+        self.path = ARCHIVE_LOCATION % symbol
+        self.index_path = ARCHIVE_INDEX_LOCATION % symbol
+
+        self._records = None
+        self._index = None
+        self._mapped_size = None
+
+    def _refresh(self):
+        """
+        (Re)map the archive if it has changed size since it was last mapped
+        """
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        if size == self._mapped_size:
+            return
+
+        count = size // TRADE_RECORD_DTYPE.itemsize
+        if count == 0:
+            self._records = np.empty(0, dtype=TRADE_RECORD_DTYPE)
+            self._index = np.empty(0, dtype=INDEX_RECORD_DTYPE)
+        else:
+            self._records = np.memmap(self.path, dtype=TRADE_RECORD_DTYPE, mode='r', shape=(count,))
+            self._index = np.fromfile(self.index_path, dtype=INDEX_RECORD_DTYPE)
+        self._mapped_size = size
+
+    def __len__(self):
+        self._refresh()
+        return len(self._records)
+
+    @property
+    def times(self):
+        self._refresh()
+        return self._records['time']
+
+    @property
+    def prices(self):
+        self._refresh()
+        return self._records['price']
+
+    @property
+    def amounts(self):
+        self._refresh()
+        return self._records['amount']
+
+    @property
+    def last_timestamp(self):
+        """
+        Timestamp of the newest trade in the archive, or None if it is empty
+        """
+        self._refresh()
+        if len(self._records) == 0:
+            return None
+        return int(self._records['time'][-1])
+
+    def _search(self, timestamp):
+        """
+        Returns the position of the first record with a time >= timestamp
+        """
+        records = self._records
+        index_times = self._index['time']
+
+        # Narrow the search down to the records between two index entries
+        bucket = int(np.searchsorted(index_times, timestamp, side='left'))
+        lo = int(self._index['position'][bucket - 1]) if bucket > 0 else 0
+        hi = int(self._index['position'][bucket]) + 1 if bucket < len(index_times) else len(records)
+
+        return lo + int(np.searchsorted(records['time'][lo:hi], timestamp, side='left'))
+
+    def window(self, start_timestamp=None, end_timestamp=None):
+        """
+        Returns zero-copy (times, prices, amounts) views covering [start_timestamp, end_timestamp)
+        """
+        self._refresh()
+        lo = 0 if start_timestamp is None else self._search(start_timestamp)
+        hi = len(self._records) if end_timestamp is None else self._search(end_timestamp)
+        records = self._records[lo:hi]
+        return records['time'], records['price'], records['amount']
+
+    def append(self, timestamps, prices, amounts):
+        """
+        Append trades to the end of the archive. Trades must be sorted, and no
+        older than the newest trade already archived
+        """
+        count = len(timestamps)
+        if count == 0:
+            return
+
+        records = np.empty(count, dtype=TRADE_RECORD_DTYPE)
+        records['time'] = timestamps
+        records['price'] = prices
+        records['amount'] = amounts
+
+        last_timestamp = self.last_timestamp
+        if np.any(np.diff(records['time']) < 0) or \
+                (last_timestamp is not None and records['time'][0] < last_timestamp):
+            raise ValueError('Trades must be appended to the %s archive in time order' % self.symbol)
+
+        # Index every ARCHIVE_INDEX_INTERVAL'th record, counting from the start of the archive
+        start = len(self._records)
+        first = -start % ARCHIVE_INDEX_INTERVAL
+        offsets = np.arange(first, count, ARCHIVE_INDEX_INTERVAL)
+        index = np.empty(len(offsets), dtype=INDEX_RECORD_DTYPE)
+        index['time'] = records['time'][offsets]
+        index['position'] = offsets + start
+
+        # Write the index first - a trailing index entry pointing past the end of
+        # the records is harmless, whereas unindexed records are not
+        with open(self.index_path, 'ab') as index_file:
+            index_file.write(index.tostring())
+        with open(self.path, 'ab') as archive_file:
+            archive_file.write(records.tostring())
+
+        self._refresh()
+
+    def truncate(self, timestamp):
+        """
+        Discard every trade at or after timestamp
+        """
+        self._refresh()
+        position = self._search(timestamp) if len(self._records) > 0 else 0
+        index_count = int(np.searchsorted(self._index['position'], position, side='left'))
+
+        # Drop the mapping before resizing the underlying files
+        self._records = None
+        self._index = None
+        self._mapped_size = None
+
+        for path, size in ((self.path, position * TRADE_RECORD_DTYPE.itemsize),
+                           (self.index_path, index_count * INDEX_RECORD_DTYPE.itemsize)):
+            if os.path.exists(path):
+                with open(path, 'r+b') as f:
+                    f.truncate(size)
@@ -0,0 +1,266 @@
+import numpy as np
+import copy
+import heapq
+import itertools
+import multiprocessing
+import traders
+from django.db import connection
+from candles import parse_period
+from datetime import timedelta
+from marketdata import HistoricalMarketData
+from trader_settings import trader_settings
+from utils import datetime_to_timestamp, timestamp_to_datetime
+
+
+# Trade fee (as a fraction of the amount received) applied to simulated fills,
+# for markets with no fee given explicitly
+DEFAULT_BACKTEST_FEE = 0.006
+
+# Starting balance, in each market's default "to" currency (e.g. USD)
+DEFAULT_BACKTEST_BALANCE = 1000.0
+
+
+class BacktestResult(object):
+    """
+    Outcome of a backtest: the equity curve (total account value in each
+    market's "to" currency, at every step), the list of simulated fills, and
+    summary statistics derived from them
+    """
+
+    def __init__(self, step_times, equity, fills, rejected_count):
+        self.step_times = step_times
+        self.equity = equity
+        self.fills = fills
+        self.rejected_count = rejected_count
+
+        if len(equity) > 0:
+            self.pnl = float(equity[-1] - equity[0])
+            self.return_pct = 100.0 * self.pnl / equity[0] if equity[0] != 0 else 0.0
+            peak = np.maximum.accumulate(equity)
+            self.max_drawdown = float(np.max((peak - equity) / np.where(peak > 0, peak, 1)))
+        else:
+            self.pnl = 0.0
+            self.return_pct = 0.0
+            self.max_drawdown = 0.0
+
+    @property
+    def trade_count(self):
+        return len(self.fills)
+
+    def __unicode__(self):
+        return u'PnL: %.2f (%.2f%%), max drawdown: %.2f%%, trades: %d, rejected: %d' % \
+               (self.pnl, self.return_pct, 100 * self.max_drawdown, self.trade_count, self.rejected_count)
+
+
+class PendingOrders(object):
+    """
+    Orders waiting to be filled on one market. Limit orders are kept in heaps,
+    buys highest price first and sells lowest price first, so each step only
+    looks at the orders its trades can actually fill - O(fills log orders) -
+    rather than every order still waiting
+    """
+
+    def __init__(self):
+        self.market_orders = []
+        self.buys = []
+        self.sells = []
+        # Submission sequence, so fills are applied in the order they were placed
+        self.count = 0
+
+    def __len__(self):
+        return len(self.market_orders) + len(self.buys) + len(self.sells)
+
+    def add(self, order):
+        self.count += 1
+        if order.market_order:
+            self.market_orders.append((self.count, order))
+        elif order.order_type == 'B':
+            heapq.heappush(self.buys, (-float(order.price), self.count, order))
+        else:
+            heapq.heappush(self.sells, (float(order.price), self.count, order))
+
+    def fill(self, prices):
+        """
+        Remove and return the orders that would have filled, given the prices of
+        the trades since they were last checked, as a list of (order, fill price)
+        tuples in submission order. Market orders fill at the first trade price.
+        Limit orders fill at their limit price, once a trade reaches it
+        """
+        if len(prices) == 0:
+            return []
+
+        filled = [(count, order, float(prices[0])) for count, order in self.market_orders]
+        self.market_orders = []
+
+        low = float(prices.min())
+        while self.buys and -self.buys[0][0] >= low:
+            price, count, order = heapq.heappop(self.buys)
+            filled.append((count, order, -price))
+
+        high = float(prices.max())
+        while self.sells and self.sells[0][0] <= high:
+            price, count, order = heapq.heappop(self.sells)
+            filled.append((count, order, price))
+
+        filled.sort(key=lambda entry: entry[0])
+        return [(order, price) for count, order, price in filled]
+
+
+def run_backtest(trader, markets, start, end, step='1M', settings=None, fees=None,
+                 starting_balance=DEFAULT_BACKTEST_BALANCE, warmup=timedelta(days=1), data=None):
+    """
+    Replay the date range [start, end) through the trader's algorithm, one step at
+    a time, simulating fills against the historical trades.
+
+    All data is loaded up front into array-backed views (see HistoricalMarketData)
+    which the algorithm slices by timestamp - so no database queries are made per
+    step. Trades from the warmup period before start are loaded too, so that
+    algorithms have history to base their first decisions on. Orders placed at
+    one step are filled against the trades up to the next. Each market starts
+    with starting_balance in its "to" currency, and orders that the balance can't
+    cover are rejected. fees maps market ids to fee fractions.
+
+    @type trader: models.Trader
+    """
+    if settings is None:
+        settings = trader_settings()
+    if fees is None:
+        fees = {}
+
+    step = parse_period(step)
+    start_timestamp = datetime_to_timestamp(start)
+    end_timestamp = datetime_to_timestamp(end)
+
+    if data is None:
+        data = HistoricalMarketData(markets, start - warmup, end + timedelta(seconds=step), fees)
+    algo = traders.AVAILABLE_TRADERS[trader.algo_name](trader, data)
+
+    # Balances of each market's "from" and "to" currencies, after each step
+    step_times = np.arange(start_timestamp, end_timestamp, step, dtype=np.int64)
+    market_index = dict((market.id, i) for i, market in enumerate(markets))
+    balances_from = np.zeros((len(step_times), len(markets)))
+    balances_to = np.zeros((len(step_times), len(markets)))
+    current_from = np.zeros(len(markets))
+    current_to = np.ones(len(markets)) * starting_balance
+
+    pending = dict((market.id, PendingOrders()) for market in markets)
+    fills = []
+    rejected_count = 0
+
+    for i, step_time in enumerate(step_times.tolist()):
+        for order in algo.build_orders(markets, timestamp_to_datetime(step_time), settings):
+            pending[order.market.id].add(order)
+
+        # Attempt to fill everything outstanding against the trades up until the next step.
+        # Orders still waiting were already checked against every earlier step's trades
+        for market in markets:
+            market_pending = pending[market.id]
+            if len(market_pending) == 0:
+                continue
+
+            times, prices, amounts = data.trades(market, step_time, step_time + step)
+            m = market_index[market.id]
+            fee = fees.get(market.id, DEFAULT_BACKTEST_FEE)
+            for order, price in market_pending.fill(prices):
+                amount = float(order.amount)
+                if order.order_type == 'B':
+                    if current_to[m] < amount * price:
+                        rejected_count += 1
+                        continue
+                    current_to[m] -= amount * price
+                    current_from[m] += amount * (1 - fee)
+                else:
+                    if current_from[m] < amount:
+                        rejected_count += 1
+                        continue
+                    current_from[m] -= amount
+                    current_to[m] += amount * price * (1 - fee)
+
+                fills.append((step_time, market.id, order.order_type, amount, price))
+
+        balances_from[i] = current_from
+        balances_to[i] = current_to
+
+    # Value every market's holdings at the last trade price of each step, all at once
+    equity = balances_to.sum(axis=1)
+    for market in markets:
+        times, prices, amounts = data.trades(market)
+        if len(times) == 0:
+            continue
+        idx = np.searchsorted(times, step_times + step, side='left') - 1
+        step_prices = np.where(idx >= 0, prices[np.maximum(idx, 0)], 0.0)
+        equity += balances_from[:, market_index[market.id]] * step_prices
+
+    return BacktestResult(step_times, equity, fills, rejected_count)
+
+
+def expand_grid(grid):
+    """
+    Expand a dictionary of parameter name -> list of values into a list of
+    dictionaries, one per combination
+    """
+    names = sorted(grid.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+# Shared state for sweep worker processes. Set in the parent before forking so
+# that workers inherit the (read-only) historical arrays rather than copying them
+_sweep_context = {}
+
+
+def _sweep_worker(params):
+    trader = _sweep_context['trader']
+    settings = copy.deepcopy(_sweep_context['settings'])
+    algo_settings = settings.algo.setdefault(trader.abbrev, {})
+    algo_settings.update(params)
+
+    result = run_backtest(trader, _sweep_context['markets'], _sweep_context['start'], _sweep_context['end'],
+                          step=_sweep_context['step'], settings=settings, fees=_sweep_context['fees'],
+                          data=_sweep_context['data'])
+    return params, result
+
+
+def run_sweep(trader, markets, start, end, grid, step='1M', settings=None, fees=None, processes=None,
+              rank_by='pnl', warmup=timedelta(days=1)):
+    """
+    Backtest every combination of the algorithm parameters in grid (a dictionary
+    of settings.algo parameter name -> list of values), spread across a pool of
+    worker processes. Historical data is loaded once, in this process, and shared
+    with the workers by forking. Returns a list of (params, BacktestResult) tuples,
+    best first according to the rank_by result attribute (lowest first for
+    max_drawdown, highest first otherwise).
+
+    @type trader: models.Trader
+    """
+    if settings is None:
+        settings = trader_settings()
+
+    step_seconds = parse_period(step)
+    data = HistoricalMarketData(markets, start - warmup, end + timedelta(seconds=step_seconds), fees)
+
+    # Build every candle period up front, so the workers share them too
+    for period in grid.get('period', [settings.algo.get(trader.abbrev, {}).get('period')]):
+        if period is not None:
+            for market in markets:
+                data.candles(market, parse_period(period))
+
+    # Make sure related objects are cached, so workers never need to query the database...
+    for market in markets:
+        market.default_currency_from
+        market.default_currency_to
+    # ...and don't share the parent's database connection
+    connection.close()
+
+    _sweep_context.update(trader=trader, markets=markets, start=start, end=end, step=step, settings=settings,
+                          fees=fees, data=data)
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(_sweep_worker, expand_grid(grid), chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        _sweep_context.clear()
+
+    results.sort(key=lambda result: getattr(result[1], rank_by), reverse=(rank_by != 'max_drawdown'))
+    return results
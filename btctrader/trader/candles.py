@@ -0,0 +1,316 @@
+import numpy as np
+import re
+import time
+from django.db import transaction
+import models
+from tradestore import TradeStore, trade_stores
+from utils import datetime_to_timestamp, timestamp_to_datetime
+
+
+# Seconds before a cached candle series is refreshed from the database, when
+# it is not being kept up to date by this process
+CANDLE_CACHE_MAX_AGE = 60
+
+# Units accepted in period strings such as '1M' or '4H'
+# Note that 'M' is minutes, NOT months
+PERIOD_UNITS = {
+    'S': 1,
+    'M': 60,
+    'H': 60 * 60,
+    'D': 24 * 60 * 60,
+}
+
+
+def parse_period(period):
+    """
+    Convert a period into a number of seconds (as stored in MarketPeriod.period).
+    Accepts either a number of seconds, or a string such as '1M', '5M', '1H' or '1D'
+    """
+    if isinstance(period, (int, long)):
+        return period
+
+    match = re.match(r'^\s*(\d+)\s*([A-Za-z])\s*$', period)
+    if match is None or match.group(2).upper() not in PERIOD_UNITS:
+        raise ValueError('Invalid period: %s' % period)
+
+    return int(match.group(1)) * PERIOD_UNITS[match.group(2).upper()]
+
+
+def build_candles(times, prices, amounts, period):
+    """
+    Bucket sorted trade arrays into OHLCV candles of the given period (in seconds)
+    in a single vectorized pass. Buckets are aligned to the unix epoch, and
+    buckets containing no trades are omitted.
+
+    Returns a tuple of (start_times, open, high, low, close, volume) arrays
+    """
+    if len(times) == 0:
+        empty = np.empty(0, dtype=np.float64)
+        return np.empty(0, dtype=np.int64), empty, empty, empty, empty, empty
+
+    buckets = times - times % period
+
+    # Index of the first trade in each bucket
+    starts = np.flatnonzero(np.concatenate(([True], buckets[1:] != buckets[:-1])))
+    ends = np.concatenate((starts[1:], [len(times)])) - 1
+
+    return (buckets[starts],
+            prices[starts],
+            np.maximum.reduceat(prices, starts),
+            np.minimum.reduceat(prices, starts),
+            prices[ends],
+            np.add.reduceat(amounts, starts))
+
+
+def load_trades(market, start_timestamp, end_timestamp=None):
+    """
+    Returns (times, prices, amounts) arrays of trades for the market's default
+    currency pair. Uses the process-wide TradeStore if one is loaded and covers
+    the requested range, otherwise loads just the range from the database
+    """
+    store = trade_stores.get((market.id, market.default_currency_from_id, market.default_currency_to_id))
+    if store is None or len(store) == 0 or store.times[0] > start_timestamp:
+        store = TradeStore(market, market.default_currency_from, market.default_currency_to)
+        store.load(start=timestamp_to_datetime(start_timestamp),
+                   end=timestamp_to_datetime(end_timestamp) if end_timestamp is not None else None)
+    return store.window(start_timestamp, end_timestamp)
+
+
+def rollup_candles(candles, period):
+    """
+    Derive candles of a coarser period from a tuple of finer candle arrays (as
+    returned by build_candles). The coarse period must be a multiple of the
+    finer one. Takes the open of the first finer candle in each bucket, the
+    close of the last, the max/min of the highs/lows, and the sum of volumes
+    """
+    start_times, open_prices, highs, lows, close_prices, volumes = candles
+    if len(start_times) == 0:
+        return candles
+
+    buckets = start_times - start_times % period
+    starts = np.flatnonzero(np.concatenate(([True], buckets[1:] != buckets[:-1])))
+    ends = np.concatenate((starts[1:], [len(start_times)])) - 1
+
+    return (buckets[starts],
+            open_prices[starts],
+            np.maximum.reduceat(highs, starts),
+            np.minimum.reduceat(lows, starts),
+            close_prices[ends],
+            np.add.reduceat(volumes, starts))
+
+
+class CandleSeries(object):
+    """
+    In-memory cache of the MarketPeriod candles of one period for a market, held
+    as a tuple of (start_times, open, high, low, close, volume) arrays.
+
+    The process that updates candles keeps its series current as it writes them.
+    Other processes refresh only the tail of the series (the newest stored candle
+    onwards) once it is older than CANDLE_CACHE_MAX_AGE seconds.
+    """
+
+    def __init__(self, market, period):
+        self.market = market
+        self.period = period
+        self.candles = build_candles(np.empty(0, dtype=np.int64),
+                                     np.empty(0, dtype=np.float64),
+                                     np.empty(0, dtype=np.float64),
+                                     period)
+        self.refreshed_at = None
+
+    def __len__(self):
+        return len(self.candles[0])
+
+    def _fetch(self, start_timestamp=None):
+        rows = models.MarketPeriod.objects.filter(market=self.market, period=self.period)
+        if start_timestamp is not None:
+            rows = rows.filter(start_time__gte=timestamp_to_datetime(start_timestamp))
+        rows = list(rows.order_by('start_time').values_list('start_time', 'open_price', 'high', 'low',
+                                                            'close_price', 'volume'))
+        if len(rows) == 0:
+            return build_candles(np.empty(0, dtype=np.int64),
+                                 np.empty(0, dtype=np.float64),
+                                 np.empty(0, dtype=np.float64),
+                                 self.period)
+
+        columns = zip(*rows)
+        return (np.array([datetime_to_timestamp(start_time) for start_time in columns[0]], dtype=np.int64),) + \
+            tuple(np.array(column, dtype=np.float64) for column in columns[1:])
+
+    def load(self):
+        self.candles = self._fetch()
+        self.refreshed_at = time.time()
+        return self
+
+    def refresh(self):
+        """
+        Re-read the newest cached candle onwards from the database
+        """
+        start_timestamp = int(self.candles[0][-1]) if len(self) > 0 else None
+        self.replace_from(start_timestamp, self._fetch(start_timestamp))
+
+    def replace_from(self, start_timestamp, candles):
+        """
+        Replace every cached candle starting at or after start_timestamp
+        """
+        idx = 0 if start_timestamp is None else int(np.searchsorted(self.candles[0], start_timestamp, side='left'))
+        self.candles = tuple(np.concatenate((old[:idx], new)) for old, new in zip(self.candles, candles))
+        self.refreshed_at = time.time()
+
+    def window(self, start_timestamp=None, end_timestamp=None):
+        """
+        Returns a tuple of candle array views covering [start_timestamp, end_timestamp)
+        """
+        start_times = self.candles[0]
+        lo = 0 if start_timestamp is None else int(np.searchsorted(start_times, start_timestamp, side='left'))
+        hi = len(start_times) if end_timestamp is None else \
+            int(np.searchsorted(start_times, end_timestamp, side='left'))
+        return tuple(column[lo:hi] for column in self.candles)
+
+
+# Per-process candle cache, keyed by (market id, period in seconds)
+candle_cache = {}
+
+
+def get_candle_series(market, period):
+    """
+    Returns the cached CandleSeries for the market and period, loading it from
+    the database the first time, and refreshing its tail if it has gone stale
+    """
+    period = parse_period(period)
+    key = (market.id, period)
+    series = candle_cache.get(key)
+    if series is None:
+        series = CandleSeries(market, period).load()
+        candle_cache[key] = series
+    elif time.time() - series.refreshed_at > CANDLE_CACHE_MAX_AGE:
+        series.refresh()
+    return series
+
+
+def get_candles(market, period, start=None, end=None):
+    """
+    Returns a tuple of (start_times, open, high, low, close, volume) arrays for
+    the market's candles of the given period, between the start and end datetimes
+    """
+    return get_candle_series(market, period).window(
+        datetime_to_timestamp(start) if start is not None else None,
+        datetime_to_timestamp(end) if end is not None else None)
+
+
+def save_candles(market, period, candles):
+    """
+    Convert candle arrays into MarketPeriod rows and bulk insert them
+    """
+    start_times, open_prices, highs, lows, close_prices, volumes = [column.tolist() for column in candles]
+    models.MarketPeriod.objects.bulk_create([
+        models.MarketPeriod(market=market,
+                            period=period,
+                            start_time=timestamp_to_datetime(start_times[i]),
+                            open_price=open_prices[i],
+                            high=highs[i],
+                            low=lows[i],
+                            close_price=close_prices[i],
+                            volume=volumes[i])
+        for i in xrange(len(start_times))
+    ], batch_size=10000)
+
+
+def replace_market_periods(market, period, start_timestamp, candles):
+    """
+    Replace the stored (and cached) candles of the given period starting at or
+    after start_timestamp
+    """
+    with transaction.commit_on_success():
+        models.MarketPeriod.objects.filter(market=market, period=period,
+                                           start_time__gte=timestamp_to_datetime(start_timestamp)).delete()
+        save_candles(market, period, candles)
+
+    series = candle_cache.get((market.id, period))
+    if series is not None:
+        series.replace_from(start_timestamp, candles)
+
+
+def rebuild_market_periods(market, period, start, end=None):
+    """
+    Rebuild all MarketPeriod candles of the given period for the market, from
+    the start datetime up to (but not including) the end datetime
+    """
+    period = parse_period(period)
+    start_timestamp = datetime_to_timestamp(start)
+    start_timestamp -= start_timestamp % period
+    if end is None:
+        times, prices, amounts = load_trades(market, start_timestamp)
+        replace_market_periods(market, period, start_timestamp, build_candles(times, prices, amounts, period))
+        return
+
+    end_timestamp = datetime_to_timestamp(end)
+    end_timestamp -= end_timestamp % period
+
+    times, prices, amounts = load_trades(market, start_timestamp, end_timestamp)
+    candles = build_candles(times, prices, amounts, period)
+
+    with transaction.commit_on_success():
+        models.MarketPeriod.objects.filter(market=market, period=period,
+                                           start_time__gte=timestamp_to_datetime(start_timestamp),
+                                           start_time__lt=timestamp_to_datetime(end_timestamp)).delete()
+        save_candles(market, period, candles)
+
+    # Rebuilding the middle of a series - simplest to drop the cached copy
+    candle_cache.pop((market.id, period), None)
+
+
+def get_latest_period_start(market, period):
+    """
+    Returns the start timestamp of the newest stored candle of the given period,
+    or None if there are none
+    """
+    series = candle_cache.get((market.id, period))
+    if series is not None:
+        return int(series.candles[0][-1]) if len(series) > 0 else None
+
+    latest = models.MarketPeriod.objects.filter(market=market, period=period)\
+                                        .order_by('-start_time').values_list('start_time', flat=True)[:1]
+    return datetime_to_timestamp(latest[0]) if len(latest) > 0 else None
+
+
+def update_market_periods(market, periods, default_start):
+    """
+    Incrementally bring MarketPeriod candles of all the given periods up to date.
+
+    Only the finest period is built from trades - starting at its newest stored
+    candle, which may still have been open when it was built. Each coarser period
+    is then rolled up from the next finer period that divides it, recomputing
+    only the buckets covering finer candles that changed. If there are no
+    candles yet, they are built from the default_start datetime onwards
+    """
+    periods = sorted(set(parse_period(period) for period in periods))
+    default_timestamp = datetime_to_timestamp(default_start)
+
+    # Timestamp from which each processed period has changed
+    changed = {}
+
+    for period in periods:
+        latest = get_latest_period_start(market, period)
+
+        sources = [finer for finer in changed if period % finer == 0]
+        if len(sources) == 0:
+            start_timestamp = latest if latest is not None else default_timestamp
+            if len(changed) > 0:
+                start_timestamp = min(start_timestamp, min(changed.values()))
+            start_timestamp -= start_timestamp % period
+            times, prices, amounts = load_trades(market, start_timestamp)
+            candles = build_candles(times, prices, amounts, period)
+        else:
+            source = max(sources)
+            start_timestamp = changed[source]
+            if latest is None:
+                # A newly added period - roll up everything the finer period has
+                start_timestamp = default_timestamp
+            elif latest < start_timestamp:
+                start_timestamp = latest
+            start_timestamp -= start_timestamp % period
+            candles = rollup_candles(get_candle_series(market, source).window(start_timestamp), period)
+
+        replace_market_periods(market, period, start_timestamp, candles)
+        changed[period] = start_timestamp
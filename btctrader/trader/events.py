@@ -0,0 +1,93 @@
+from django.core.cache import cache
+import time
+
+
+# Cache key holding the id of the most recently published event
+EVENT_SEQUENCE_KEY = 'trader:events:sequence'
+
+# Seconds the sequence is kept for (the longest memcached allows)
+EVENT_SEQUENCE_TIMEOUT = 30 * 24 * 60 * 60
+
+# Cache key each event is stored under, by id
+EVENT_KEY = 'trader:events:%d'
+
+# Seconds events are kept for - clients that fall further behind than this miss them
+EVENT_TIMEOUT = 300
+
+# Most events returned by a single read. Clients further behind than this are told
+# to reload instead
+MAX_EVENTS_PER_READ = 200
+
+
+def order_entry(order):
+    """
+    Event entry for an order - plain, JSON serializable values only
+    @type order: models.Order
+    """
+    return {
+        'id': order.id,
+        'when_created': order.when_created.isoformat() if order.when_created is not None else None,
+        'market': order.market.name,
+        'market_order_id': order.market_order_id,
+        'currency_from': order.currency_from.abbrev,
+        'currency_to': order.currency_to.abbrev,
+        'order_type': order.get_order_type_display(),
+        'market_order': order.market_order,
+        'amount': str(order.amount),
+        'price': str(order.price) if order.price is not None else None,
+        'status': order.get_status_display(),
+    }
+
+
+def publish(event_type, data):
+    """
+    Publish an event to every connected client. Events are stored once, in
+    Django's cache, and each client reads them from there - so the cost of
+    publishing doesn't depend on the number of clients. Processes only see each
+    other's events if a shared cache backend (e.g. memcached) is configured
+    """
+    cache.add(EVENT_SEQUENCE_KEY, 0, EVENT_SEQUENCE_TIMEOUT)
+    try:
+        event_id = cache.incr(EVENT_SEQUENCE_KEY)
+    except ValueError:
+        # The sequence was evicted between the add and the incr
+        cache.add(EVENT_SEQUENCE_KEY, 0, EVENT_SEQUENCE_TIMEOUT)
+        event_id = cache.incr(EVENT_SEQUENCE_KEY)
+
+    cache.set(EVENT_KEY % event_id, {'id': event_id, 'type': event_type, 'data': data}, EVENT_TIMEOUT)
+    return event_id
+
+
+def latest_event_id():
+    return cache.get(EVENT_SEQUENCE_KEY, 0)
+
+
+def get_events(since):
+    """
+    Returns a list of the events published after the event with id since, in
+    order. If there are more than MAX_EVENTS_PER_READ, or the sequence has been
+    lost and restarted, a single 'reset' event is returned instead, since the
+    client should reload rather than catch up
+    """
+    latest = latest_event_id()
+    if latest == since:
+        return []
+    if latest < since or latest - since > MAX_EVENTS_PER_READ:
+        return [{'id': latest, 'type': 'reset', 'data': None}]
+
+    events = cache.get_many([EVENT_KEY % event_id for event_id in range(since + 1, latest + 1)])
+    return sorted(events.values(), key=lambda event: event['id'])
+
+
+def wait_for_events(since, timeout, poll_interval=1):
+    """
+    Wait up to timeout seconds for events published after since. Returns them
+    as soon as there are any, or an empty list on timeout. Each check is a
+    single cache read
+    """
+    deadline = time.time() + timeout
+    while True:
+        events = get_events(since)
+        if len(events) > 0 or time.time() >= deadline:
+            return events
+        time.sleep(poll_interval)
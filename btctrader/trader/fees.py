@@ -0,0 +1,89 @@
+import threading
+import time
+import parallel
+
+
+def amount_after_fees(amount, fee):
+    """
+    Amount received from a trade of the given amount, once a fee (as a fraction,
+    e.g. 0.006 for 0.6%) has been taken
+    """
+    return amount * (1 - fee)
+
+
+def amount_incl_fees(amount, fee):
+    """
+    Amount that has to be traded so that the given amount is received, once a
+    fee (as a fraction) has been taken
+    """
+    return amount / (1 - fee)
+
+
+class FeeCache(object):
+    """
+    Cache of the trade fee charged to our account on each market.
+
+    Reads never block on the market: a cached fee is returned even once it is
+    older than max_age, and a refresh is started on the shared thread pool to
+    replace it in the background. Until a market's fee has been fetched for the
+    first time, its default_trade_fee is used
+    """
+
+    def __init__(self):
+        self.fees = {}
+        self.fetch_times = {}
+        self.refreshing = set()
+        self.lock = threading.Lock()
+
+    def get_fee(self, market_api):
+        """
+        Returns the current trade fee (as a fraction) for a market API object
+        """
+        key = market_api.market.id
+        with self.lock:
+            fee = self.fees.get(key, market_api.default_trade_fee)
+            fetch_time = self.fetch_times.get(key)
+            stale = fetch_time is None or time.time() - fetch_time > market_api.trade_fee_max_age
+            if stale and key not in self.refreshing:
+                self.refreshing.add(key)
+            else:
+                stale = False
+
+        if stale:
+            parallel.call_async(self._refresh, market_api)
+        return fee
+
+    def expire(self, market_api):
+        """
+        Mark a market's fee as out of date (e.g. after trading, since fee tiers
+        are based on trade volume), so the next read refreshes it
+        """
+        with self.lock:
+            self.fetch_times.pop(market_api.market.id, None)
+
+    def refresh(self, market_api):
+        """
+        Fetch a market's fee straight away, blocking until it is done
+        """
+        with self.lock:
+            self.refreshing.add(market_api.market.id)
+        return self._refresh(market_api)
+
+    def _refresh(self, market_api):
+        key = market_api.market.id
+        try:
+            success, err, fee = market_api.api_fetch_trade_fee()
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+        with self.lock:
+            # Markets that can't report their fee aren't asked again until max_age has passed
+            self.fetch_times[key] = time.time()
+            if success:
+                self.fees[key] = fee
+
+        return success, err, fee
+
+
+fee_cache = FeeCache()
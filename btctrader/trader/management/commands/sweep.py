@@ -0,0 +1,72 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from datetime import datetime
+from optparse import make_option
+from trader.backtest import run_sweep
+from trader.models import Market, Trader
+
+
+def parse_value(value):
+    """
+    Parameter values are numbers where possible (e.g. periods), otherwise strings (e.g. '1M')
+    """
+    for convert in (int, float):
+        try:
+            return convert(value)
+        except ValueError:
+            pass
+    return value
+
+
+class Command(BaseCommand):
+    args = '<trader abbrev>'
+    help = 'Backtests a grid of parameters for a trader (e.g. --param short_period=5,10,15) in parallel, ' \
+           'and ranks the results'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--start', help='Start date of the backtest (YYYY-MM-DD)'),
+        make_option('--end', help='End date of the backtest (YYYY-MM-DD)'),
+        make_option('--param', action='append', default=[],
+                    help='Parameter to sweep and its comma separated values, e.g. long_period=21,30'),
+        make_option('--market', action='append', default=[],
+                    help='Abbreviation of a market to trade on (default: all automated markets)'),
+        make_option('--step', default='1M', help='Simulation step size (default: 1M)'),
+        make_option('--processes', type='int', default=None,
+                    help='Number of worker processes (default: one per CPU)'),
+        make_option('--rank-by', dest='rank_by', default='pnl',
+                    help='Result to rank by: pnl, return_pct, max_drawdown or trade_count (default: pnl)'),
+        make_option('--top', type='int', default=10, help='Number of results to show (default: 10)'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Expected a single trader abbreviation')
+        if options['start'] is None or options['end'] is None:
+            raise CommandError('Both --start and --end are required')
+
+        try:
+            trader = Trader.objects.get(abbrev=args[0])
+        except Trader.DoesNotExist:
+            raise CommandError('No such trader: %s' % args[0])
+
+        if options['market']:
+            markets = list(Market.objects.filter(abbrev__in=options['market']))
+        else:
+            markets = list(Market.objects.filter(automated_trading_enabled=True))
+
+        grid = {}
+        for param in options['param']:
+            if '=' not in param:
+                raise CommandError('Expected name=value1,value2,... but got %s' % param)
+            name, values = param.split('=', 1)
+            grid[name] = [parse_value(value) for value in values.split(',')]
+
+        start = timezone.make_aware(datetime.strptime(options['start'], '%Y-%m-%d'), timezone.utc)
+        end = timezone.make_aware(datetime.strptime(options['end'], '%Y-%m-%d'), timezone.utc)
+
+        results = run_sweep(trader, markets, start, end, grid, step=options['step'],
+                            processes=options['processes'], rank_by=options['rank_by'])
+
+        for params, result in results[:options['top']]:
+            self.stdout.write('%s: %s' % (', '.join('%s=%s' % item for item in sorted(params.items())),
+                                          unicode(result)))
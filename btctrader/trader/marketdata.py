@@ -0,0 +1,129 @@
+import candles
+import prices
+import tradestore
+from trader_settings import trader_settings
+from utils import datetime_to_timestamp
+
+
+default_settings = trader_settings()
+
+
+class LiveMarketData(object):
+    """
+    Source of market data for trading algorithms, backed by the per-process
+    candle cache and trade stores (and hence the database)
+    """
+
+    # Algorithms may persist state built from live data, but never from a simulation
+    live = True
+
+    def __init__(self, days_to_keep=None):
+        if days_to_keep is None:
+            days_to_keep = default_settings.historical_trades_days_to_keep
+        self.days_to_keep = days_to_keep
+
+    def candles(self, market, period, start_timestamp=None, end_timestamp=None):
+        """
+        Returns a tuple of (start_times, open, high, low, close, volume) arrays for
+        the market's candles of the given period (in seconds), covering
+        [start_timestamp, end_timestamp)
+        """
+        return candles.get_candle_series(market, period).window(start_timestamp, end_timestamp)
+
+    def trades(self, market, start_timestamp=None, end_timestamp=None):
+        """
+        Returns (times, prices, amounts) arrays for the market's default currency
+        pair, covering [start_timestamp, end_timestamp)
+        """
+        return self._store(market).window(start_timestamp, end_timestamp)
+
+    def last_price(self, market, timestamp=None):
+        """
+        Returns the price of the market's last trade at or before timestamp
+        """
+        return self._store(market).last_price(timestamp)
+
+    def quote(self, market, timestamp=None):
+        """
+        Returns a (timestamp, buy price, sell price) tuple for the market's default
+        currency pair - the prices we can currently buy and sell at - or None if
+        there's no price available. Taken from the latest cached MarketPrice, so
+        no API calls are made
+        """
+        market_price = prices.price_cache.peek(market, market.default_currency_from, market.default_currency_to)
+        if market_price is None:
+            return None
+        return datetime_to_timestamp(market_price.time), float(market_price.buy_price), float(market_price.sell_price)
+
+    def fee(self, market):
+        """
+        Returns the trade fee (as a fraction) charged to this account on the
+        market. Never makes an API call - see MarketBase.get_trade_fee
+        """
+        return market.market_api.get_trade_fee()
+
+    def _store(self, market):
+        return tradestore.get_trade_store(market, market.default_currency_from, market.default_currency_to,
+                                          self.days_to_keep)
+
+
+class HistoricalMarketData(LiveMarketData):
+    """
+    Market data for historical simulations. Trades for every market are loaded
+    into memory once, up front, and candles are built from them on first use -
+    so each simulation step is just a handful of array slices, rather than
+    database queries.
+
+    Note that candles are built over the whole loaded range. It's up to the
+    caller to slice them by timestamp so that no future data is used.
+
+    Trade fees come from fees (a dictionary of market id -> fee fraction), never
+    from the markets themselves, so simulations are repeatable and make no API
+    calls. Markets missing from it have no known fee.
+    """
+
+    live = False
+
+    def __init__(self, markets, start, end, fees=None):
+        super(HistoricalMarketData, self).__init__()
+
+        self.fees = fees if fees is not None else {}
+
+        self.start_timestamp = datetime_to_timestamp(start)
+        self.end_timestamp = datetime_to_timestamp(end)
+
+        self.stores = {}
+        for market in markets:
+            store = tradestore.TradeStore(market, market.default_currency_from, market.default_currency_to)
+            self.stores[market.id] = store.load(start=start, end=end)
+
+        self.candle_cache = {}
+
+    def candles(self, market, period, start_timestamp=None, end_timestamp=None):
+        key = (market.id, period)
+        market_candles = self.candle_cache.get(key)
+        if market_candles is None:
+            store = self.stores[market.id]
+            market_candles = candles.build_candles(store.times, store.prices, store.amounts, period)
+            self.candle_cache[key] = market_candles
+
+        start_times = market_candles[0]
+        lo = 0 if start_timestamp is None else int(start_times.searchsorted(start_timestamp, side='left'))
+        hi = len(start_times) if end_timestamp is None else int(start_times.searchsorted(end_timestamp, side='left'))
+        return tuple(column[lo:hi] for column in market_candles)
+
+    def quote(self, market, timestamp=None):
+        # There's no order book history - the last trade price has to stand in for both
+        # the buy and sell prices
+        store = self.stores[market.id]
+        hi = len(store.times) if timestamp is None else int(store.times.searchsorted(timestamp, side='right'))
+        if hi == 0:
+            return None
+        price = float(store.prices[hi - 1])
+        return int(store.times[hi - 1]), price, price
+
+    def fee(self, market):
+        return self.fees.get(market.id)
+
+    def _store(self, market):
+        return self.stores[market.id]
@@ -1,12 +1,30 @@
 import base64
+import cPickle
+import fcntl
 import hashlib
 import hmac
+import os
+import random
+import tempfile
+import threading
 import time
-from django.utils import timezone
 import urllib
+import uuid
 import requests
+import requests.adapters
+from datetime import datetime, timedelta
+from django.db import transaction
+from django.utils import timezone
+import events
+import fees
 import models
+import orderbook
+import parallel
+import prices
+import ratelimit
+import tradestore
 from trader_settings import market_settings
+from utils import datetime_to_timestamp, get_market_setting, timestamp_to_datetime
 
 
 settings = market_settings()
@@ -30,20 +48,141 @@ class MarketBase(object):
         ('BTC', 'USD'),
     )
 
+    # HTTP settings - override these in market classes as required
+    # Seconds to wait for a response
+    timeout = 15
+    # Maximum number of attempts made for each request
+    tryout = 5
+    # Seconds to wait before the first retry - doubled for each retry after that
+    retry_backoff = 0.5
+    # Errors worth retrying an idempotent request for
+    retry_exceptions = (requests.Timeout, requests.ConnectionError)
+    # Errors raised before a request could have reached the market - the only ones
+    # worth retrying a request that isn't idempotent (e.g. placing an order) for.
+    # Versions of requests before 2.4 have no ConnectTimeout, and raise ConnectionError
+    # when they can't connect
+    connect_exceptions = (getattr(requests.exceptions, 'ConnectTimeout', requests.exceptions.ConnectionError),)
+    # Maximum number of keep-alive connections kept open to the market
+    pool_size = 4
+
+    # Caching rules for market price data
+    # If the last price is older than this number of seconds, an API call will be made to refresh the price
+    market_price_max_age = 60
+
+    # Trade fee (as a fraction) assumed until the account's actual fee has been fetched
+    default_trade_fee = 0.006
+    # Fees are refreshed in the background once they are older than this number of seconds
+    trade_fee_max_age = 3600
+
+    # Limit on requests made to the market - at most 'max' requests in any 'window'
+    # seconds. None for no limit
+    rate_limit = None
+    # Longest time in seconds a request will wait for the rate limit, before failing
+    # instead. By default it fails straight away, so that a Celery worker never sleeps
+    # on the limit. None to always wait
+    throttle_max_wait = 0
+
     def __init__(self, market):
         """
         Instantiate the Market API object. Stores a pointer back to the Market
-        database object
+        database object, and creates the pooled HTTP session used for all requests
         """
         self.market = market
 
+        # Reusing a session means connections (and their TLS handshakes) are kept
+        # alive between requests, rather than being set up again each time
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # All API objects for the same exchange share one rate limit - and if configured,
+        # so do all processes
+        self.rate_limiter = None
+        if self.rate_limit is not None:
+            self.rate_limiter = ratelimit.get_limiter(self.market.api_name, self.rate_limit['max'],
+                                                      self.rate_limit['window'],
+                                                      get_market_setting(settings, 'rate_limit_dir'))
+
+    def throttle(self):
+        """
+        Called before every HTTP request to enforce the rate limit. Waits until
+        the request is allowed, and returns True - or returns False if that would
+        take longer than throttle_max_wait
+        """
+        if self.rate_limiter is None:
+            return True
+        return self.rate_limiter.acquire(self.throttle_max_wait)
+
+    def http_request(self, url, data=None, headers=None, post=False, idempotent=None):
+        """
+        Make an HTTP request to the market over the pooled session, throttling
+        each attempt, and retrying up to tryout times (with exponential backoff)
+        on retry_exceptions. GET requests are assumed idempotent and POSTs not,
+        unless idempotent is given. A request that isn't idempotent is only
+        retried if it failed to connect, since otherwise the market may have
+        acted on it (e.g. placed the order) before the response was lost.
+        Returns the response if successful
+        """
+        if idempotent is None:
+            idempotent = not post
+
+        tries = 0
+        err = None
+        while tries < self.tryout:
+            if tries > 0:
+                time.sleep(self.retry_backoff * 2 ** (tries - 1))
+            tries += 1
+
+            # We want a hard throttle on requests to avoid being blocked
+            if not self.throttle():
+                return False, 'Rate limit exceeded (request URL %s)' % url, None
+
+            # Make the actual request
+            try:
+                if post:
+                    resp = self.session.post(url, data=data, headers=headers, timeout=self.timeout)
+                else:
+                    resp = self.session.get(url, data=data, headers=headers, timeout=self.timeout)
+            except self.retry_exceptions as e:
+                if not idempotent and not isinstance(e, self.connect_exceptions):
+                    return False, 'HTTP request failed, and may have reached the market: %s (request URL %s)' % \
+                                  (e, url), None
+                err = e
+                continue
+
+            # Check for failure response
+            if resp.status_code != 200:
+                return False, 'HTTP request failed: API returned status %s (request URL %s)' % \
+                              (resp.status_code, url), resp
+
+            return True, None, resp
+
+        return False, 'HTTP request failed after %d tries: %s (request URL %s)' % (tries, err, url), None
+
     def api_execute_order(self, order):
         """
-        Attempt to execute the specified order
+        Attempt to execute the specified order. On success, the order's market
+        order id, status and submission time are updated - but the order is not
+        saved, so that callers can save a batch of orders at once
         @type order: models.Order
         """
         return False, 'Not implemented', None
 
+    def api_execute_orders(self, orders):
+        """
+        Execute a list of orders one after another, in order. Returns a list of
+        the (success, err, result) tuple for each order
+        """
+        results = []
+        for order in orders:
+            # One order failing unexpectedly mustn't lose the results of the others
+            try:
+                results.append(self.api_execute_order(order))
+            except Exception as e:
+                results.append((False, 'Unexpected error: %s' % e, None))
+        return True, None, results
+
     def api_cancel_order(self, order):
         """
         Attempt to cancel the specified order
@@ -51,12 +190,130 @@ class MarketBase(object):
         """
         return False, 'Not implemented', None
 
+    def api_list_open_orders(self, currency_pairs=None):
+        """
+        Returns a dictionary of market order id -> order details, for all of this
+        account's orders that are currently open on the market. The details are
+        passed to get_order_status. Should take a single API call - markets that
+        can only list open orders one currency pair at a time list each of
+        currency_pairs (e.g. 'BTCUSD') instead, or the default pair if None
+        """
+        return False, 'Not implemented', None
+
+    def api_list_recent_fills(self):
+        """
+        Returns a dictionary of market order id -> fill time, for this account's
+        recently filled orders. Should take a single API call. Markets that can't
+        list fills return None instead, in which case any order that is no longer
+        open is assumed to have been filled
+        """
+        return True, None, None
+
+    def get_order_status(self, db_order, open_order):
+        """
+        Work out the status of a database order, given the details of the matching
+        open order from api_list_open_orders. Override this to validate the order
+        against the database, or to tell executing orders apart from open ones
+        @type db_order: models.Order
+        """
+        return True, None, 'O'
+
+    def reconcile_orders(self, db_orders, open_orders, fills=None):
+        """
+        Bring a list of database orders up to date with the open orders (and
+        fills, if available) listed by the market. Each order is looked up by its
+        market order id, and all status changes are written in a single batch.
+        Orders that don't match what the market reports are left unchanged, and
+        reported in the error message
+        """
+        now = timezone.now()
+        transitions = {}
+        fill_times = {}
+        errors = []
+        for db_order in db_orders:
+            market_order_id = db_order.market_order_id
+
+            if market_order_id in open_orders:
+                success, err, status = self.get_order_status(db_order, open_orders[market_order_id])
+                if not success:
+                    errors.append('Order %s: %s' % (market_order_id, err))
+                    continue
+            elif fills is not None and market_order_id in fills:
+                status = 'F'
+                fill_times[db_order] = fills[market_order_id] or now
+            elif db_order.status in ['O', 'E']:
+                if fills is None:
+                    # Can't tell whether it was filled or cancelled - assume it was filled
+                    status = 'F'
+                    fill_times[db_order] = now
+                else:
+                    # Neither open, nor recently filled - it may have been cancelled on the
+                    # market, or filled longer ago than the market lists fills for
+                    status = 'U'
+            else:
+                continue
+
+            if status != db_order.status:
+                transitions[db_order] = status
+
+        self.save_order_statuses(transitions, fill_times)
+
+        if len(errors) > 0:
+            return False, '; '.join(errors), None
+        return True, None, None
+
+    def save_order_statuses(self, transitions, fill_times=None):
+        """
+        Write a batch of order status changes to the database, given a dictionary
+        of order -> new status, and optionally of order -> fill time. Orders are
+        grouped by their new status (and fill time), so this takes one UPDATE per
+        group, all in one transaction, rather than one per order. The changes are
+        then published as an 'orders' event
+        """
+        if fill_times is None:
+            fill_times = {}
+
+        groups = {}
+        for order, status in transitions.items():
+            order.status = status
+            when_filled = fill_times.get(order) if status == 'F' else None
+            if when_filled is not None:
+                order.when_filled = when_filled
+            groups.setdefault((status, when_filled), []).append(order.id)
+
+        with transaction.commit_on_success():
+            for (status, when_filled), order_ids in groups.items():
+                if when_filled is not None:
+                    models.Order.objects.filter(id__in=order_ids).update(status=status, when_filled=when_filled)
+                else:
+                    models.Order.objects.filter(id__in=order_ids).update(status=status)
+
+        if len(transitions) > 0:
+            events.publish('orders', [events.order_entry(order) for order in transitions])
+
     def api_update_order_status(self, order):
         """
         Update a single order object with the latest status from the market
         @type order: models.Order
         """
-        return False, 'Not implemented', None
+        return self.api_reconcile_orders([order])
+
+    def api_reconcile_orders(self, db_orders):
+        """
+        Update a list of order objects with their latest status from the market.
+        Costs one api_list_open_orders and one api_list_recent_fills call, however
+        many orders there are
+        """
+        currency_pairs = sorted(set(db_order.get_currency_pair() for db_order in db_orders))
+        success, err, open_orders = self.api_list_open_orders(currency_pairs)
+        if not success:
+            return success, err, open_orders
+
+        success, err, fills = self.api_list_recent_fills()
+        if not success:
+            return success, err, fills
+
+        return self.reconcile_orders(db_orders, open_orders, fills)
 
     def api_update_market(self):
         """
@@ -65,15 +322,42 @@ class MarketBase(object):
         as well as all currently open orders. This is intended to be called with
         relatively low frequency, typically once per minute
         """
+        # Orders that haven't been submitted yet have nothing to reconcile
+        db_orders = self.market.order_set.filter(status__in=['O', 'E', 'U'])\
+                                         .select_related('currency_from', 'currency_to')
+        success, err, result = self.api_reconcile_orders(db_orders)
+        if not success:
+            return success, err, result
+
+        # Update market price
+        success, err, market_price = self.api_get_current_market_price()
+        if not success:
+            return success, err, market_price
+
+        return True, None, None
+
+    def api_fetch_trade_fee(self):
+        """
+        Fetch the trade fee (as a fraction, e.g. 0.006 for 0.6%) currently charged
+        to this account by the market. Called in the background by the fee cache -
+        use get_trade_fee instead
+        """
         return False, 'Not implemented', None
 
+    def get_trade_fee(self):
+        """
+        Returns the trade fee (as a fraction) charged to this account. Never makes
+        an API call - the fee is cached, and refreshed in the background
+        """
+        return fees.fee_cache.get_fee(self)
+
     def api_get_total_amount_after_fees(self, amount, order_type, currency):
         """
         Calculate the final amount, after fees have been subtracted
         Based on both a currency, and an order type (Buy/Sell)
         @type currency: models.Currency
         """
-        return False, 'Not implemented', None
+        return True, None, fees.amount_after_fees(amount, self.get_trade_fee())
 
     def api_get_total_amount_incl_fees(self, amount, order_type, currency):
         """
@@ -83,19 +367,56 @@ class MarketBase(object):
         Based on both a currency, and an order type (Buy/Sell)
         @type currency: models.Currency
         """
+        return True, None, fees.amount_incl_fees(amount, self.get_trade_fee())
+
+    def api_fetch_market_price(self, currency_from, currency_to):
+        """
+        Fetch the live price for a (supported) currency pair from the market, and
+        return it as a new, unsaved MarketPrice object. Called by
+        api_get_current_market_price when there's no recent enough price cached
+        @type currency_from: models.Currency
+        @type currency_to: models.Currency
+        """
         return False, 'Not implemented', None
 
     def api_get_current_market_price(self, force_update=False, currency_from=None, currency_to=None):
         """
-        Returns a current MarketPrice object for the market. Markets can choose
-        to introduce caching here if desired (i.e. only update with live data
-        once every X seconds). It's also optional to actually save the market
-        price to the database (although recommended if caching). If force_update
-        is true, then caching behavior should be bypassed
+        Returns a current MarketPrice object for the market. Prices are cached
+        (in memory, and in the database) for market_price_max_age seconds, and
+        concurrent requests for the same price share a single API call to
+        api_fetch_market_price. If force_update is true, then caching behavior
+        is bypassed
         @type currency_from: models.Currency
         @type currency_to: models.Currency
         """
-        return False, 'Not implemented', None
+        # Wrangle the inputs - if we got currencies then use them, otherwise
+        # set them to default values
+        if currency_from is None or currency_to is None:
+            currency_from = self.market.default_currency_from
+            currency_to = self.market.default_currency_to
+
+        if (currency_from.abbrev, currency_to.abbrev) not in self.supported_currency_pairs:
+            return False, 'Currency pair not supported: %s%s' % (currency_from.abbrev, currency_to.abbrev), None
+
+        return prices.price_cache.get_price(self.market, currency_from, currency_to, self.market_price_max_age,
+                                            lambda: self.api_fetch_market_price(currency_from, currency_to),
+                                            force_update)
+
+    # Asynchronous versions of the API functions above. Each runs the function on
+    # a shared thread pool, and returns straight away with an AsyncResult - calling
+    # get() on it waits for the usual (success, err, result) tuple. This allows
+    # requests to several markets to be in flight at once
+    def api_execute_order_async(self, order):
+        return parallel.call_async(self.api_execute_order, order)
+
+    def api_execute_orders_async(self, orders):
+        return parallel.call_async(self.api_execute_orders, orders)
+
+    def api_update_market_async(self):
+        return parallel.call_async(self.api_update_market)
+
+    def api_get_current_market_price_async(self, force_update=False, currency_from=None, currency_to=None):
+        return parallel.call_async(self.api_get_current_market_price, force_update, currency_from, currency_to)
 
 
 # Be VERY careful - should NOT be changed unless no longer correct
@@ -154,8 +475,8 @@ class MtGoxMarket(MarketBase):
         ('BTC', 'THB'),
     )
 
-    timeout = 15
-    tryout = 5
+    # Max of 10 requests in 10 seconds
+    rate_limit = {'max': 10, 'window': 10}
 
     def __init__(self, market):
         super(MtGoxMarket, self).__init__(market)
@@ -164,45 +485,13 @@ class MtGoxMarket(MarketBase):
         self.api_key = settings.mtgox_api_key
         self.api_secret = settings.mtgox_api_secret
 
-        # Internal storage for the current trading fee
-        # Varies from account to account - must be updated via the API
-        self.trade_fee = 0
-        self.trade_fee_valid = False
-
-        # Rolling window to limit requests made to the API
-        self.reqs = {'max': 10, 'window': 10}
-        self.req_timestamps = []
-
         # Default currency pair; used for API calls where the currency makes no difference
         self.default_currency_pair = self.market.default_currency_from.abbrev + self.market.default_currency_to.abbrev
 
-        # Caching rules for market price data
-        # If the last price is older than this number of seconds, an API call will be made to refresh the price
-        self.market_price_max_age = 60
-
-    def throttle(self):
-        # Make sure we don't send more than a given number of requests in a certain
-        # time window
-
-        # First clear out old request timestamps
-        current_timestamp = timezone.now()
-        for timestamp in self.req_timestamps:
-            if (current_timestamp - timestamp).total_seconds() > self.reqs['window']:
-                self.req_timestamps.remove(timestamp)
-            else:
-                break
-
-        # Now add the current timestamp
-        self.req_timestamps.append(current_timestamp)
-
-        # Now see if we have too many requests
-        if len(self.req_timestamps) > self.reqs['max']:
-            time.sleep(self.reqs['window'] - (current_timestamp - self.req_timestamps[0]).total_seconds())
-
     def nonce(self):
         return str(int(time.time() * 1000))
 
-    def api_request(self, path, post_data=None, check_success=True, authenticate=True, post=True):
+    def api_request(self, path, post_data=None, check_success=True, authenticate=True, post=True, idempotent=None):
         # Convert input to a list if we got a dict
         if post_data is not None:
             if isinstance(post_data, dict):
@@ -240,37 +529,10 @@ class MtGoxMarket(MarketBase):
                 'User-Agent': 'btctrader'
             }
 
-        tries = 0
-        resp = None
-        while tries < self.tryout:
-            tries += 1
-
-            # We want a hard throttle on requests to avoid being blocked
-            self.throttle()
-
-            # Make the actual request
-            try:
-                if post:
-                    resp = requests.post(MTGOX_API_BASE_URL + path,
-                                         data=post_data_str,
-                                         headers=headers,
-                                         timeout=self.timeout)
-                else:
-                    resp = requests.get(MTGOX_API_BASE_URL + path,
-                                         data=post_data_str,
-                                         headers=headers,
-                                         timeout=self.timeout)
-            except requests.Timeout:
-                continue
-
-            # If we got to here, the request did not timeout
-            break
-
-        # Check for failure response
-        if resp is None or resp.status_code != 200:
-            return False,\
-                'HTTP request failed: API returned status %s (request path %s)' % (resp.status_code, path),\
-                resp
+        success, err, resp = self.http_request(MTGOX_API_BASE_URL + path, data=post_data_str, headers=headers,
+                                               post=post, idempotent=idempotent)
+        if not success:
+            return success, err, resp
 
         resp_json = resp.json()
         if check_success:
@@ -282,18 +544,15 @@ class MtGoxMarket(MarketBase):
             return True, None, resp_json
 
     def api_get_info(self):
-        return self.api_request(path=self.default_currency_pair + '/money/info')
+        return self.api_request(path=self.default_currency_pair + '/money/info', idempotent=True)
 
-    def api_get_trade_fee(self):
-        if not self.trade_fee_valid:
-            success, err, info = self.api_get_info()
-            if not success:
-                return success, err, info
-
-            self.trade_fee = float(info['Trade_Fee'])
-            self.trade_fee_valid = True
+    def api_fetch_trade_fee(self):
+        success, err, info = self.api_get_info()
+        if not success:
+            return success, err, info
 
-        return True, None, self.trade_fee
+        # Given as a percentage
+        return True, None, float(info['Trade_Fee']) / 100
 
     def api_execute_order(self, order):
         # Should we even be executing this order?
@@ -304,11 +563,6 @@ class MtGoxMarket(MarketBase):
         if not (order.currency_from.abbrev, order.currency_to.abbrev) in self.supported_currency_pairs:
             return False, 'MtGox does not support this currency pairing', None
 
-        # Get the current trade fee associated with this account
-        # success, err, fee = self.api_get_trade_fee()
-        # if not success:
-        #     return success, err, fee
-
         # Build the trade request
         trade_req = {}
 
@@ -338,13 +592,13 @@ class MtGoxMarket(MarketBase):
         if not success:
             return success, err, result
 
-        # Save the order ID and update the status
+        # Record the order ID and update the status
         order.market_order_id = str(result)
         order.status = 'O'
-        order.save()
+        order.when_submitted = timezone.now()
 
-        # Invalidate trade fee
-        self.trade_fee_valid = False
+        # Trading may have moved the account into a different fee tier
+        fees.fee_cache.expire(self)
 
         return True, None, None
 
@@ -365,110 +619,55 @@ class MtGoxMarket(MarketBase):
         else:
             return True, None, None
 
-    def update_db_order_status(self, db_order, mtgox_orders):
-        found = False
-        for open_order in mtgox_orders:
-            if open_order['oid'] == db_order.market_order_id:
-                # Validate order parameters - if MtGox doesn't agree with the database then there's a serious problem
-                if open_order['currency'] != db_order.currency_to.abbrev:
-                    return False, 'Order currency_to does not match expected value (expected %s, got %s)' %\
-                                  (db_order.currency_to.abbrev, open_order['currency']), None
-                if open_order['item'] != db_order.currency_from.abbrev:
-                    return False, 'Order currency_from does not match expected value (expected %s, got %s)' %\
-                                  (db_order.currency_from.abbrev, open_order['item']), None
-                if open_order['amount'] != db_order.amount:
-                    return False, 'Order amount does not match expected value (expected %s, got %s)' %\
-                                  (db_order.amount, open_order['amount']), None
-                if db_order.market_order and float(open_order['price']) != 0:
-                    return False, 'Order expected to be a market order, got price %s' % open_order['price'], None
-
-                # Update status
-                if open_order['status'] in ['pending', 'executing', 'post-pending']:
-                    db_order.status = 'E'
-                elif open_order['status'] == 'open':
-                    db_order.status = 'O'
-                elif open_order['status'] == 'invalid':
-                    db_order.status = 'I'
-                else:
-                    db_order.status = 'U'
-
-                found = True
-                break
-
-        # TODO: Could it have been cancelled? No way to tell in current API version!
-        # /money/orders does not return filled orders - if it wasn't found, assume it was filled
-        # For now, only update to Filled if the order was Open or Executing
-        if not found and db_order.status in ['O', 'E']:
-            db_order.status = 'F'
-
-        db_order.save()
-
-        return True, None, None
-
-    def api_update_order_status(self, order):
+    def api_list_open_orders(self, currency_pairs=None):
         # Currently the v2 API call for info on a specific order is broke
         # Hence retrieve info for all orders and filter from there
-        success, err, mtgox_orders = self.api_request(path=order.get_currency_pair() + '/money/orders')
-        if not success:
-            return success, err, mtgox_orders
-
-        return self.update_db_order_status(order, mtgox_orders)
-
-    def api_update_market(self):
-        # Update all orders
-
-        # TODO: Do we need to split this request into separate requests for different currency pairs, per order?
-        # It's possible that the API returns all orders no matter which currency you specify - need to test
-        success, err, mtgox_orders = self.api_request(path=self.default_currency_pair + '/money/orders')
-        if not success:
-            return success, err, mtgox_orders
-
-        db_orders = self.market.order_set.filter(order_status__in=['N', 'O', 'E', 'U'])
-        for db_order in db_orders:
-            success, err, result = self.update_db_order_status(db_order, mtgox_orders)
+        # The API may only return orders for the currency pair requested, so each pair
+        # that has orders is requested separately
+        if not currency_pairs:
+            currency_pairs = [self.default_currency_pair]
+
+        open_orders = {}
+        for currency_pair in currency_pairs:
+            success, err, mtgox_orders = self.api_request(path=currency_pair + '/money/orders', idempotent=True)
             if not success:
-                return success, err, result
-
-        # Update market price
-        success, err, market_price = self.api_get_current_market_price(self.market)
-        if not success:
-            return success, err, market_price
-
-        return True, None, None
-
-    def api_get_current_market_price(self, force_update=False, currency_from=None, currency_to=None):
-        currency_pair = self.default_currency_pair
-
-        # Wrangle the inputs - if we got currencies then use them, otherwise
-        # set them to default values
-        if currency_from is not None and currency_to is not None:
-            currency_pair = currency_from.abbrev + currency_to.abbrev
+                return success, err, mtgox_orders
+
+            for open_order in mtgox_orders:
+                open_orders[open_order['oid']] = open_order
+
+        return True, None, open_orders
+
+    # TODO: Could an order have been cancelled? No way to tell in current API version!
+    # /money/orders does not return filled orders, and there's no call listing them - so
+    # api_list_recent_fills isn't implemented, and orders that aren't found are assumed filled
+
+    def get_order_status(self, db_order, open_order):
+        # Validate order parameters - if MtGox doesn't agree with the database then there's a serious problem
+        if open_order['currency'] != db_order.currency_to.abbrev:
+            return False, 'Order currency_to does not match expected value (expected %s, got %s)' %\
+                          (db_order.currency_to.abbrev, open_order['currency']), None
+        if open_order['item'] != db_order.currency_from.abbrev:
+            return False, 'Order currency_from does not match expected value (expected %s, got %s)' %\
+                          (db_order.currency_from.abbrev, open_order['item']), None
+        if open_order['amount'] != db_order.amount:
+            return False, 'Order amount does not match expected value (expected %s, got %s)' %\
+                          (db_order.amount, open_order['amount']), None
+        if db_order.market_order and float(open_order['price']) != 0:
+            return False, 'Order expected to be a market order, got price %s' % open_order['price'], None
+
+        if open_order['status'] in ['pending', 'executing', 'post-pending']:
+            return True, None, 'E'
+        elif open_order['status'] == 'open':
+            return True, None, 'O'
+        elif open_order['status'] == 'invalid':
+            return True, None, 'I'
         else:
-            currency_from = self.market.default_currency_from
-            currency_to = self.market.default_currency_to
+            return True, None, 'U'
 
-        if (currency_from.abbrev, currency_to.abbrev) not in self.supported_currency_pairs:
-            return False, 'Currency pair not supported: %s' % currency_pair, None
+    def api_fetch_market_price(self, currency_from, currency_to):
+        currency_pair = currency_from.abbrev + currency_to.abbrev
 
-        # See if there's a recent price
-        if not force_update:
-            try:
-                last_price = models.MarketPrice.objects.filter(
-                    market=self.market,
-                    currency_from=currency_from,
-                    currency_to=currency_to
-                ).order_by('-time')[0]
-
-                # Is this price recent enough? If so, just return it
-                if (timezone.now() - last_price.time).total_seconds() <= self.market_price_max_age:
-                    return True, None, last_price
-
-            except IndexError:
-                # Don't do anything - this just means we couldn't find any MarketPrice
-                # objects for the market/currency
-                pass
-
-        # If we got to this point, then we need to make an API call to get the latest price
         success, err, ticker = self.api_request(path=currency_pair + '/money/ticker_fast', authenticate=False,
                                                 post=False)
         if not success:
@@ -485,9 +684,6 @@ class MtGoxMarket(MarketBase):
         market_price.buy_price = float(ticker['sell']['value_int']) / MTGOX_CURRENCY_DIVISIONS[currency_to.abbrev]
         market_price.sell_price = float(ticker['buy']['value_int']) / MTGOX_CURRENCY_DIVISIONS[currency_to.abbrev]
 
-        # Save it so it can be "cached" for next time
-        market_price.save()
-
         return True, None, market_price
 
 
@@ -496,6 +692,9 @@ BITSTAMP_MINIMUM_TRADE_BTC = 0.01
 
 BITSTAMP_API_BASE_URL = 'https://www.bitstamp.net/api/'
 
+# Format of times returned by the API (in UTC)
+BITSTAMP_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
 
 class BitstampMarket(MarketBase):
     """
@@ -518,8 +717,8 @@ class BitstampMarket(MarketBase):
         #('BTC', 'AUD'),
     )
 
-    timeout = 15
-    tryout = 5
+    # Max of 600 requests in 10 minutes
+    rate_limit = {'max': 600, 'window': 600}
 
     def __init__(self, market):
         super(BitstampMarket, self).__init__(market)
@@ -527,43 +726,10 @@ class BitstampMarket(MarketBase):
         self.api_user = settings.bitstamp_api_user
         self.api_password = settings.bitstamp_api_password
 
-        # Internal storage for the current trading fee
-        # Varies from account to account - must be updated via the API
-        self.trade_fee = 0
-        self.trade_fee_valid = False
-
-        # Rolling window to limit requests made to the API
-        # Max of 600 in 10 minutes
-        self.reqs = {'max': 600, 'window': 600}
-        self.req_timestamps = []
-
         # Default currency pair; used for API calls where the currency makes no difference
         self.default_currency_pair = self.market.default_currency_from.abbrev + self.market.default_currency_to.abbrev
 
-        # Caching rules for market price data
-        # If the last price is older than this number of seconds, an API call will be made to refresh the price
-        self.market_price_max_age = 60
-
-    def throttle(self):
-        # Make sure we don't send more than a given number of requests in a certain
-        # time window
-
-        # First clear out old request timestamps
-        current_timestamp = timezone.now()
-        for timestamp in self.req_timestamps:
-            if (current_timestamp - timestamp).total_seconds() > self.reqs['window']:
-                self.req_timestamps.remove(timestamp)
-            else:
-                break
-
-        # Now add the current timestamp
-        self.req_timestamps.append(current_timestamp)
-
-        # Now see if we have too many requests
-        if len(self.req_timestamps) > self.reqs['max']:
-            time.sleep(self.reqs['window'] - (current_timestamp - self.req_timestamps[0]).total_seconds())
-
-    def api_request(self, path, post=False, add_credentials=False, data=None):
+    def api_request(self, path, post=False, add_credentials=False, data=None, idempotent=None):
         # Convert input to a list if we got a dict
         if data is not None:
             if isinstance(data, dict):
@@ -585,37 +751,10 @@ class BitstampMarket(MarketBase):
             'Content-Type': 'application/x-www-form-urlencoded',
         }
 
-        tries = 0
-        resp = None
-        while tries < self.tryout:
-            tries += 1
-
-            # We want a hard throttle on requests to avoid being blocked
-            self.throttle()
-
-            # Make the actual request
-            try:
-                if post:
-                    resp = requests.post(BITSTAMP_API_BASE_URL + path,
-                                         data=data_str,
-                                         headers=headers,
-                                         timeout=self.timeout)
-                else:
-                    resp = requests.get(BITSTAMP_API_BASE_URL + path,
-                                        data=data_str,
-                                        headers=headers,
-                                        timeout=self.timeout)
-            except requests.Timeout:
-                continue
-
-            # If we got to here, the request did not timeout
-            break
-
-        # Check for failure response
-        if resp is None or resp.status_code != 200:
-            return False,\
-                'HTTP request failed: API returned status %s (request path %s)' % (resp.status_code, path),\
-                resp
+        success, err, resp = self.http_request(BITSTAMP_API_BASE_URL + path, data=data_str, headers=headers,
+                                               post=post, idempotent=idempotent)
+        if not success:
+            return success, err, resp
 
         resp_json = resp.json()
         return True, None, resp_json
@@ -629,11 +768,6 @@ class BitstampMarket(MarketBase):
         if not (order.currency_from.abbrev, order.currency_to.abbrev) in self.supported_currency_pairs:
             return False, 'Bitstamp does not support this currency pairing', None
 
-        # Get the current trade fee associated with this account
-        # success, err, fee = self.api_get_trade_fee()
-        # if not success:
-        #     return success, err, fee
-
         # Build the trade request
         trade_req = {}
 
@@ -682,47 +816,62 @@ class BitstampMarket(MarketBase):
         if not success:
             return success, err, result
 
-        # Save the order ID and update the status
+        # Record the order ID and update the status
         order.market_order_id = str(result['id'])
         if new_price > 0:
             order.price = new_price
         order.status = 'O'
-        order.save()
+        order.when_submitted = timezone.now()
 
-        # Invalidate trade fee
-        self.trade_fee_valid = False
+        # Trading may have moved the account into a different fee tier
+        fees.fee_cache.expire(self)
 
         return True, None, None
 
-    def api_get_current_market_price(self, force_update=False, currency_from=None, currency_to=None):
-        # Wrangle the inputs - if we got currencies then use them, otherwise
-        # set them to default values
-        if currency_from is None or currency_to is None:
-            currency_from = self.market.default_currency_from
-            currency_to = self.market.default_currency_to
+    def api_fetch_trade_fee(self):
+        success, err, balance = self.api_request(path='balance/', post=True, add_credentials=True,
+                                                 idempotent=True)
+        if not success:
+            return success, err, balance
+        if 'error' in balance:
+            return False, 'API request failed: %s' % balance['error'], None
 
-        if (currency_from.abbrev, currency_to.abbrev) not in self.supported_currency_pairs:
-            return False, 'Currency pair not supported: %s%s' % (currency_from.abbrev, currency_to.abbrev), None
+        # Given as a percentage
+        return True, None, float(balance['fee']) / 100
 
-        # See if there's a recent price
-        if not force_update:
-            try:
-                last_price = models.MarketPrice.objects.filter(
-                    market=self.market,
-                    currency_from=currency_from,
-                    currency_to=currency_to
-                ).order_by('-time')[0]
-
-                # Is this price recent enough? If so, just return it
-                if (timezone.now() - last_price.time).total_seconds() <= self.market_price_max_age:
-                    return True, None, last_price
-
-            except IndexError:
-                # Don't do anything - this just means we couldn't find any MarketPrice
-                # objects for the market/currency
-                pass
-
-        # If we got to this point, then we need to make an API call to get the latest price
+    def api_list_open_orders(self, currency_pairs=None):
+        success, err, result = self.api_request(path='open_orders/', post=True, add_credentials=True,
+                                                idempotent=True)
+        if not success:
+            return success, err, result
+        if isinstance(result, dict) and 'error' in result:
+            return False, 'API request failed: %s' % result['error'], None
+
+        return True, None, dict((str(open_order['id']), open_order) for open_order in result)
+
+    def api_list_recent_fills(self):
+        success, err, result = self.api_request(path='user_transactions/', post=True, add_credentials=True,
+                                                idempotent=True)
+        if not success:
+            return success, err, result
+        if isinstance(result, dict) and 'error' in result:
+            return False, 'API request failed: %s' % result['error'], None
+
+        # Orders can be filled by several transactions - the last one is when the order was filled
+        fills = {}
+        for user_transaction in result:
+            # Type 2 is a market trade (as opposed to a deposit or withdrawal)
+            if int(user_transaction['type']) != 2 or not user_transaction.get('order_id'):
+                continue
+            when = timezone.make_aware(datetime.strptime(user_transaction['datetime'], BITSTAMP_DATETIME_FORMAT),
+                                       timezone.utc)
+            market_order_id = str(user_transaction['order_id'])
+            if market_order_id not in fills or fills[market_order_id] < when:
+                fills[market_order_id] = when
+
+        return True, None, fills
+
+    def api_fetch_market_price(self, currency_from, currency_to):
         success, err, ticker = self.api_request(path='ticker/')
         if not success:
             return success, err, ticker
@@ -738,9 +887,6 @@ class BitstampMarket(MarketBase):
         market_price.buy_price = float(ticker['ask'])
         market_price.sell_price = float(ticker['bid'])
 
-        # Save it so it can be "cached" for next time
-        market_price.save()
-
         return True, None, market_price
 
 
@@ -766,8 +912,11 @@ class CampBxMarket(MarketBase):
         ('BTC', 'USD'),
     )
 
-    timeout = 15
-    tryout = 5
+    # Max of 1 request every half a second
+    rate_limit = {'max': 1, 'window': 0.5}
+
+    # CampBX charges a flat fee, and has no API call to fetch it
+    default_trade_fee = 0.0055
 
     def __init__(self, market):
         super(CampBxMarket, self).__init__(market)
@@ -775,43 +924,10 @@ class CampBxMarket(MarketBase):
         self.api_user = settings.campbx_api_user
         self.api_password = settings.campbx_api_password
 
-        # Internal storage for the current trading fee
-        # Varies from account to account - must be updated via the API
-        self.trade_fee = 0
-        self.trade_fee_valid = False
-
-        # Rolling window to limit requests made to the API
-        # Max of 600 in 10 minutes
-        self.reqs = {'max': 1, 'window': 0.5}
-        self.req_timestamps = []
-
         # Default currency pair; used for API calls where the currency makes no difference
         self.default_currency_pair = self.market.default_currency_from.abbrev + self.market.default_currency_to.abbrev
 
-        # Caching rules for market price data
-        # If the last price is older than this number of seconds, an API call will be made to refresh the price
-        self.market_price_max_age = 60
-
-    def throttle(self):
-        # Make sure we don't send more than a given number of requests in a certain
-        # time window
-
-        # First clear out old request timestamps
-        current_timestamp = timezone.now()
-        for timestamp in self.req_timestamps:
-            if (current_timestamp - timestamp).total_seconds() > self.reqs['window']:
-                self.req_timestamps.remove(timestamp)
-            else:
-                break
-
-        # Now add the current timestamp
-        self.req_timestamps.append(current_timestamp)
-
-        # Now see if we have too many requests
-        if len(self.req_timestamps) > self.reqs['max']:
-            time.sleep(self.reqs['window'] - (current_timestamp - self.req_timestamps[0]).total_seconds())
-
-    def api_request(self, path, post=False, add_credentials=False, data=None):
+    def api_request(self, path, post=False, add_credentials=False, data=None, idempotent=None):
         # Convert input to a list if we got a dict
         if data is not None:
             if isinstance(data, dict):
@@ -833,37 +949,10 @@ class CampBxMarket(MarketBase):
             'Content-Type': 'application/x-www-form-urlencoded',
         }
 
-        tries = 0
-        resp = None
-        while tries < self.tryout:
-            tries += 1
-
-            # We want a hard throttle on requests to avoid being blocked
-            self.throttle()
-
-            # Make the actual request
-            try:
-                if post:
-                    resp = requests.post(CAMPBX_API_BASE_URL + path,
-                                         data=data_str,
-                                         headers=headers,
-                                         timeout=self.timeout)
-                else:
-                    resp = requests.get(CAMPBX_API_BASE_URL + path,
-                                        data=data_str,
-                                        headers=headers,
-                                        timeout=self.timeout)
-            except requests.Timeout:
-                continue
-
-            # If we got to here, the request did not timeout
-            break
-
-        # Check for failure response
-        if resp is None or resp.status_code != 200:
-            return False,\
-                'HTTP request failed: API returned status %s (request path %s)' % (resp.status_code, path),\
-                resp
+        success, err, resp = self.http_request(CAMPBX_API_BASE_URL + path, data=data_str, headers=headers,
+                                               post=post, idempotent=idempotent)
+        if not success:
+            return success, err, resp
 
         resp_json = resp.json()
 
@@ -873,35 +962,26 @@ class CampBxMarket(MarketBase):
 
         return True, None, resp_json
 
-    def api_get_current_market_price(self, force_update=False, currency_from=None, currency_to=None):
-        # Wrangle the inputs - if we got currencies then use them, otherwise
-        # set them to default values
-        if currency_from is None or currency_to is None:
-            currency_from = self.market.default_currency_from
-            currency_to = self.market.default_currency_to
+    def api_list_open_orders(self, currency_pairs=None):
+        success, err, result = self.api_request(path='myorders.php', post=True, add_credentials=True,
+                                                idempotent=True)
+        if not success:
+            return success, err, result
 
-        if (currency_from.abbrev, currency_to.abbrev) not in self.supported_currency_pairs:
-            return False, 'Currency pair not supported: %s%s' % (currency_from.abbrev, currency_to.abbrev), None
+        # Buy and sell orders are listed separately. If there are none of either, the
+        # list contains a single entry with an 'Info' message instead
+        open_orders = {}
+        for side in ('Buy', 'Sell'):
+            for open_order in result.get(side, []):
+                if 'Order ID' in open_order:
+                    open_orders[str(open_order['Order ID'])] = open_order
 
-        # See if there's a recent price
-        if not force_update:
-            try:
-                last_price = models.MarketPrice.objects.filter(
-                    market=self.market,
-                    currency_from=currency_from,
-                    currency_to=currency_to
-                ).order_by('-time')[0]
-
-                # Is this price recent enough? If so, just return it
-                if (timezone.now() - last_price.time).total_seconds() <= self.market_price_max_age:
-                    return True, None, last_price
-
-            except IndexError:
-                # Don't do anything - this just means we couldn't find any MarketPrice
-                # objects for the market/currency
-                pass
-
-        # If we got to this point, then we need to make an API call to get the latest price
+        return True, None, open_orders
+
+    # CampBX has no call listing filled orders - so api_list_recent_fills isn't
+    # implemented, and orders that are no longer open are assumed filled
+
+    def api_fetch_market_price(self, currency_from, currency_to):
         success, err, ticker = self.api_request(path='xticker.php')
         if not success:
             return success, err, ticker
@@ -917,9 +997,6 @@ class CampBxMarket(MarketBase):
         market_price.buy_price = float(ticker['Best Bid'])
         market_price.sell_price = float(ticker['Best Ask'])
 
-        # Save it so it can be "cached" for next time
-        market_price.save()
-
         return True, None, market_price
 
 
@@ -929,11 +1006,295 @@ class NullMarket(MarketBase):
     Has some varied behavior built into it based on random numbers, in order to simulate a variety of different
     scenarios - including random failures that might be seen on a real market.
 
+    Orders are matched by a SimulatedExchange (see orderbook.py) for each currency pair, whose price follows a
+    replay of another market's HistoricalTrades in the same pair. Each API call waits for latency seconds, and
+    fails with probability failure_rate. It is configured by the null_market_* market settings (see
+    trader_settings.py.default).
+
+    Each exchange is kept in a state file in null_market_state_dir, which is loaded and saved again (under a
+    file lock) around every call - so every process on the host, web and Celery workers alike, shares one
+    book, and open orders survive a restart. Processes on different hosts don't share state. Order ids are
+    prefixed with an id unique to each book, so if the state is lost, orders placed before are never
+    mistaken for new ones - they are simply no longer known to the book.
+
     In a production deployment, you can safely remove this market from the AVAILABLE_MARKETS dictionary.
     """
 
-    # Empty for now
-    pass
+    supported_currency_pairs = (
+        ('BTC', 'USD'),
+        ('BTC', 'GBP'),
+        ('BTC', 'EUR'),
+    )
+
+    default_trade_fee = 0.002
+
+    def __init__(self, market):
+        super(NullMarket, self).__init__(market)
+
+        for name in ('price_source', 'replay_start', 'replay_days', 'replay_speed', 'spread', 'depth',
+                     'latency', 'failure_rate', 'seed', 'state_dir'):
+            setattr(self, name, get_market_setting(settings, 'null_market_' + name))
+
+        self.random = random.Random(self.seed)
+
+        # Currency pair (e.g. 'BTCUSD') -> (currency from, currency to) abbreviations
+        self.currency_pairs = dict((currency_from + currency_to, (currency_from, currency_to))
+                                   for currency_from, currency_to in self.supported_currency_pairs)
+        # Currency pair -> (replay start timestamp, TradeStore) of the trades being replayed
+        self.replays = {}
+
+        # Threads in this process take turns with the state files
+        self.lock = threading.Lock()
+
+    def make_order_id(self, book_id, order_id):
+        return '%s-%d' % (book_id, order_id)
+
+    def parse_order_id(self, market_order_id):
+        """
+        Returns the (book id, order id) for a market order id, or None if it isn't one of ours
+        """
+        book_id, sep, order_id = market_order_id.rpartition('-')
+        if not book_id or not order_id.isdigit():
+            return None
+        return book_id, int(order_id)
+
+    def load_replay(self, currency_from, currency_to, start):
+        """
+        Load the HistoricalTrades in a currency pair since the start datetime, from the market configured
+        as the price source
+        """
+        try:
+            source = models.Market.objects.get(abbrev=self.price_source)
+        except models.Market.DoesNotExist:
+            return False, 'NullMarket price source market %s does not exist' % self.price_source, None
+        try:
+            currency_from = models.Currency.objects.get(abbrev=currency_from)
+            currency_to = models.Currency.objects.get(abbrev=currency_to)
+        except models.Currency.DoesNotExist:
+            return False, 'Currency %s or %s does not exist' % (currency_from, currency_to), None
+
+        replay_store = tradestore.TradeStore(source, currency_from, currency_to)
+        replay_store.load(start=start)
+        return True, None, replay_store
+
+    def get_replay(self, currency_pair, replay_from):
+        """
+        Returns the trades being replayed for a currency pair, loading them on first use
+        """
+        replay = self.replays.get(currency_pair)
+        if replay is not None and replay[0] == replay_from:
+            return True, None, replay[1]
+
+        success, err, replay_store = self.load_replay(self.currency_pairs[currency_pair][0],
+                                                      self.currency_pairs[currency_pair][1],
+                                                      timestamp_to_datetime(replay_from))
+        if not success:
+            return success, err, replay_store
+
+        self.replays[currency_pair] = (replay_from, replay_store)
+        return True, None, replay_store
+
+    def replay_price(self, replay_store, replay_started, now):
+        """
+        Price of the replayed trades at the given (wall clock) time. Replay starts
+        at the first loaded trade, and runs faster
+        than real time (replay_speed). The last price holds once the trades run out
+        """
+        if len(replay_store) == 0:
+            return None
+
+        replay_time = float(replay_store.times[0]) + (now - replay_started) * self.replay_speed
+        return replay_store.last_price(replay_time)
+
+    def call_exchange(self, currency_pair, action):
+        """
+        Run action(exchange, book id) against the simulated exchange for a currency pair, and return
+        its result. The exchange is loaded from its state file under an exclusive lock, and saved back
+        afterwards - or started afresh, with a new book id, if there's no state yet
+        """
+        if currency_pair not in self.currency_pairs:
+            return False, 'NullMarket does not support this currency pairing', None
+
+        state_dir = self.state_dir if self.state_dir is not None else tempfile.gettempdir()
+        path = os.path.join(state_dir, 'btctrader-nullmarket-%d-%s.state' % (self.market.id, currency_pair))
+
+        with self.lock:
+            state_file = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o644), 'r+b')
+            try:
+                fcntl.flock(state_file.fileno(), fcntl.LOCK_EX)
+                data = state_file.read()
+                if data:
+                    state = cPickle.loads(data)
+                else:
+                    start = self.replay_start
+                    if start is None:
+                        start = timezone.now() - timedelta(days=self.replay_days)
+                    state = {
+                        'book_id': uuid.uuid4().hex[:12],
+                        'replay_from': datetime_to_timestamp(start),
+                        'replay_started': time.time(),
+                        'exchange': orderbook.SimulatedExchange(None, spread=self.spread, depth=self.depth),
+                    }
+
+                success, err, replay_store = self.get_replay(currency_pair, state['replay_from'])
+                if not success:
+                    return success, err, replay_store
+
+                exchange = state['exchange']
+                exchange.attach(lambda now: self.replay_price(replay_store, state['replay_started'], now))
+                result = action(exchange, state['book_id'])
+
+                state_file.seek(0)
+                state_file.truncate()
+                cPickle.dump(state, state_file, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                state_file.close()
+
+        return True, None, result
+
+    def simulate_call(self):
+        """
+        Simulate the latency of an API call, and (randomly) its failure
+        """
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if self.random.random() < self.failure_rate:
+            return False, 'Simulated API failure', None
+        return True, None, None
+
+    def api_execute_order(self, order):
+        if order.status != 'N' or order.market_order_id != '':
+            return False, 'Order has already been submitted to NullMarket', None
+        if not (order.currency_from.abbrev, order.currency_to.abbrev) in self.supported_currency_pairs:
+            return False, 'NullMarket does not support this currency pairing', None
+        if order.order_type not in ('B', 'S'):
+            return False, 'Unsupported order type: %s' % order.order_type, None
+        if not order.market_order and not order.price > 0:
+            return False, 'Must specify a price for a non-market order', None
+
+        success, err, result = self.simulate_call()
+        if not success:
+            return success, err, result
+
+        def submit(exchange, book_id):
+            book_order, fills = exchange.submit(order.order_type, float(order.amount),
+                                                None if order.market_order else float(order.price))
+            return self.make_order_id(book_id, book_order.id), book_order.status
+
+        success, err, result = self.call_exchange(order.get_currency_pair(), submit)
+        if not success:
+            return success, err, result
+
+        order.market_order_id, status = result
+        order.when_submitted = timezone.now()
+        if status == 'F':
+            order.status = 'F'
+            order.when_filled = order.when_submitted
+        elif status == 'C':
+            # A market order that couldn't be (completely) filled
+            order.status = 'C'
+            order.when_cancelled = order.when_submitted
+        else:
+            order.status = 'O'
+
+        fees.fee_cache.expire(self)
+
+        return True, None, None
+
+    def api_cancel_order(self, order):
+        # Can we even cancel this order?
+        if order.status not in ('O', 'E'):
+            return False, 'Order is not currently open or executing - cannot cancel', None
+
+        parsed = self.parse_order_id(order.market_order_id)
+        if parsed is None:
+            return False, 'Not a NullMarket order id: %s' % order.market_order_id, None
+        order_book_id, order_id = parsed
+
+        success, err, result = self.simulate_call()
+        if not success:
+            return success, err, result
+
+        def cancel(exchange, book_id):
+            # An order from a book that has since been lost can't be in the current one
+            return book_id == order_book_id and exchange.cancel(order_id)
+
+        success, err, cancelled = self.call_exchange(order.get_currency_pair(), cancel)
+        if not success:
+            return success, err, cancelled
+
+        if not cancelled:
+            return False, 'Unable to cancel order', None
+        else:
+            return True, None, None
+
+    def api_list_open_orders(self, currency_pairs=None):
+        success, err, result = self.simulate_call()
+        if not success:
+            return success, err, result
+
+        def list_open_orders(exchange, book_id):
+            return dict((self.make_order_id(book_id, order_id), book_order)
+                        for order_id, book_order in exchange.list_open_orders().items())
+
+        if currency_pairs is None:
+            currency_pairs = self.currency_pairs
+
+        open_orders = {}
+        for currency_pair in currency_pairs:
+            if currency_pair not in self.currency_pairs:
+                continue
+            success, err, result = self.call_exchange(currency_pair, list_open_orders)
+            if not success:
+                return success, err, result
+            open_orders.update(result)
+
+        return True, None, open_orders
+
+    def api_list_recent_fills(self):
+        success, err, result = self.simulate_call()
+        if not success:
+            return success, err, result
+
+        def list_recent_fills(exchange, book_id):
+            return dict((self.make_order_id(book_id, order_id), timestamp_to_datetime(int(fill_time)))
+                        for order_id, fill_time in exchange.list_recent_fills().items())
+
+        fills = {}
+        for currency_pair in self.currency_pairs:
+            success, err, result = self.call_exchange(currency_pair, list_recent_fills)
+            if not success:
+                return success, err, result
+            fills.update(result)
+
+        return True, None, fills
+
+    def api_fetch_trade_fee(self):
+        return True, None, self.default_trade_fee
+
+    def api_fetch_market_price(self, currency_from, currency_to):
+        success, err, result = self.simulate_call()
+        if not success:
+            return success, err, result
+
+        success, err, result = self.call_exchange(currency_from.abbrev + currency_to.abbrev,
+                                                  lambda exchange, book_id: exchange.quote())
+        if not success:
+            return success, err, result
+
+        best_ask, best_bid = result
+        if best_ask is None or best_bid is None:
+            return False, 'No simulated price available - are there HistoricalTrades to replay?', None
+
+        # Build the MarketPrice object
+        market_price = models.MarketPrice()
+        market_price.market = self.market
+        market_price.currency_from = currency_from
+        market_price.currency_to = currency_to
+        market_price.buy_price = best_ask
+        market_price.sell_price = best_bid
+
+        return True, None, market_price
 
 
 # This is used for dynamically "reflecting" markets/orders to their corresponding API class
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding index on 'Order', fields ['when_created', 'id']
+        db.create_index(u'trader_order', ['when_created', 'id'])
+
+        # Adding index on 'Order', fields ['market', 'when_created', 'id']
+        db.create_index(u'trader_order', ['market_id', 'when_created', 'id'])
+
+        # Adding index on 'Order', fields ['status', 'when_created', 'id']
+        db.create_index(u'trader_order', ['status', 'when_created', 'id'])
+
+        # Adding index on 'Order', fields ['trader', 'when_created', 'id']
+        db.create_index(u'trader_order', ['trader_id', 'when_created', 'id'])
+
+
+    def backwards(self, orm):
+        # Removing index on 'Order', fields ['when_created', 'id']
+        db.delete_index(u'trader_order', ['when_created', 'id'])
+
+        # Removing index on 'Order', fields ['market', 'when_created', 'id']
+        db.delete_index(u'trader_order', ['market_id', 'when_created', 'id'])
+
+        # Removing index on 'Order', fields ['status', 'when_created', 'id']
+        db.delete_index(u'trader_order', ['status', 'when_created', 'id'])
+
+        # Removing index on 'Order', fields ['trader', 'when_created', 'id']
+        db.delete_index(u'trader_order', ['trader_id', 'when_created', 'id'])
+
+
+    models = {
+        u'trader.currency': {
+            'Meta': {'object_name': 'Currency'},
+            'abbrev': ('django.db.models.fields.CharField', [], {'max_length': '10'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '256'})
+        },
+        u'trader.emastate': {
+            'Meta': {'unique_together': "(('trader', 'market', 'period'),)", 'object_name': 'EmaState'},
+            'candle_count': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_start_time': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'long_ema': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'market': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['trader.Market']"}),
+            'period': ('django.db.models.fields.IntegerField', [], {}),
+            'short_ema': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'trader': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['trader.Trader']"})
+        },
+        u'trader.historicaltrade': {
+            'Meta': {'object_name': 'HistoricalTrade', 'index_together': "(('market', 'currency_from', 'currency_to', 'time'),)"},
+            'amount': ('django.db.models.fields.DecimalField', [], {'max_digits': '18', 'decimal_places': '5'}),
+            'currency_from': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'currency_from_historicaltrade_set'", 'to': u"orm['trader.Currency']"}),
+            'currency_to': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'currency_to_historicaltrade_set'", 'to': u"orm['trader.Currency']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'market': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['trader.Market']"}),
+            'price': ('django.db.models.fields.DecimalField', [], {'max_digits': '18', 'decimal_places': '5'}),
+            'time': ('django.db.models.fields.DateTimeField', [], {})
+        },
+        u'trader.market': {
+            'Meta': {'object_name': 'Market'},
+            'abbrev': ('django.db.models.fields.CharField', [], {'max_length': '10'}),
+            'api_name': ('django.db.models.fields.CharField', [], {'max_length': '256'}),
+            'automated_trading_enabled': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'default_currency_from': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'default_currency_from_market_set'", 'to': u"orm['trader.Currency']"}),
+            'default_currency_to': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'default_currency_to_market_set'", 'to': u"orm['trader.Currency']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '256'}),
+            'reserved_amount': ('django.db.models.fields.DecimalField', [], {'default': '0', 'max_digits': '18', 'decimal_places': '5'}),
+            'reserved_currency': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'reserved_currency_market_set'", 'to': u"orm['trader.Currency']"})
+        },
+        u'trader.marketperiod': {
+            'Meta': {'object_name': 'MarketPeriod'},
+            'close_price': ('django.db.models.fields.DecimalField', [], {'max_digits': '18', 'decimal_places': '5'}),
+            'high': ('django.db.models.fields.DecimalField', [], {'max_digits': '18', 'decimal_places': '5'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'low': ('django.db.models.fields.DecimalField', [], {'max_digits': '18', 'decimal_places': '5'}),
+            'market': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['trader.Market']"}),
+            'open_price': ('django.db.models.fields.DecimalField', [], {'max_digits': '18', 'decimal_places': '5'}),
+            'period': ('django.db.models.fields.IntegerField', [], {}),
+            'start_time': ('django.db.models.fields.DateTimeField', [], {}),
+            'volume': ('django.db.models.fields.DecimalField', [], {'max_digits': '16', 'decimal_places': '3'})
+        },
+        u'trader.marketprice': {
+            'Meta': {'object_name': 'MarketPrice', 'index_together': "(('market', 'currency_from', 'currency_to', 'time'),)"},
+            'buy_price': ('django.db.models.fields.DecimalField', [], {'max_digits': '18', 'decimal_places': '5'}),
+            'currency_from': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'currency_from_marketprice_set'", 'to': u"orm['trader.Currency']"}),
+            'currency_to': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'currency_to_marketprice_set'", 'to': u"orm['trader.Currency']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'market': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['trader.Market']"}),
+            'sell_price': ('django.db.models.fields.DecimalField', [], {'max_digits': '18', 'decimal_places': '5'}),
+            'time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now', 'blank': 'True'})
+        },
+        u'trader.order': {
+            'Meta': {'object_name': 'Order', 'index_together': "(('when_created', 'id'), ('market', 'when_created', 'id'), ('status', 'when_created', 'id'), ('trader', 'when_created', 'id'))"},
+            'amount': ('django.db.models.fields.DecimalField', [], {'max_digits': '18', 'decimal_places': '5'}),
+            'currency_from': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'currency_from_order_set'", 'to': u"orm['trader.Currency']"}),
+            'currency_to': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'currency_to_order_set'", 'to': u"orm['trader.Currency']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'market': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['trader.Market']"}),
+            'market_order': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'market_order_id': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'order_type': ('django.db.models.fields.CharField', [], {'max_length': '1'}),
+            'price': ('django.db.models.fields.DecimalField', [], {'null': 'True', 'max_digits': '18', 'decimal_places': '5', 'blank': 'True'}),
+            'status': ('django.db.models.fields.CharField', [], {'default': "'N'", 'max_length': '1'}),
+            'trader': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['trader.Trader']", 'null': 'True', 'blank': 'True'}),
+            'when_cancelled': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'when_created': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now', 'blank': 'True'}),
+            'when_filled': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'when_submitted': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'})
+        },
+        u'trader.trader': {
+            'Meta': {'object_name': 'Trader'},
+            'abbrev': ('django.db.models.fields.CharField', [], {'max_length': '20'}),
+            'algo_name': ('django.db.models.fields.CharField', [], {'max_length': '256'}),
+            'enabled': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '256'})
+        }
+    }
+
+    complete_apps = ['trader']
\ No newline at end of file
@@ -1,5 +1,7 @@
 from django.db import models
+from django.db.models.signals import post_delete, post_save
 import markets
+import registry
 import traders
 from django.utils import timezone
 
@@ -30,28 +32,25 @@ class Market(models.Model):
     reserved_currency = models.ForeignKey(Currency, related_name='reserved_currency_market_set')
 
     # Stores persistent API objects
-    apis = {}
+    apis = registry.Registry(lambda market: markets.AVAILABLE_MARKETS[market.api_name](market),
+                             lambda market: (market.api_name, market.default_currency_from_id,
+                                             market.default_currency_to_id))
 
     def __unicode__(self):
         return self.name
 
     @property
     def market_api(self):
-        if self.id in Market.apis.keys():
-            return Market.apis[self.id]
-        else:
-            api = markets.AVAILABLE_MARKETS[self.api_name](self)
-            Market.apis[self.id] = api
-            return api
+        return Market.apis.get(self)
 
     @property
     def supported_from_currencies(self):
-        api = self.market_api()
+        api = self.market_api
         return Currency.objects.filter(abbrev__in=[pair[0] for pair in api.supported_currency_pairs])
 
     @property
     def supported_to_currencies(self):
-        api = self.market_api()
+        api = self.market_api
         return Currency.objects.filter(abbrev__in=[pair[1] for pair in api.supported_currency_pairs])
 
     @property
@@ -84,19 +83,34 @@ class Trader(models.Model):
     enabled = models.BooleanField(blank=False, null=False, default=True)
 
     # Stores persistent trading algorithm objects
-    algos = {}
+    algos = registry.Registry(lambda trader: traders.AVAILABLE_TRADERS[trader.algo_name](trader),
+                              lambda trader: (trader.algo_name, trader.abbrev))
 
     def __unicode__(self):
         return self.name
 
     @property
     def algo(self):
-        if self.id in Trader.algos.keys():
-            return Trader.algos[self.id]
-        else:
-            algo = traders.AVAILABLE_TRADERS[self.algo_name](self)
-            Trader.algos[self.id] = algo
-            return algo
+        return Trader.algos.get(self)
+
+
+class EmaState(models.Model):
+    """
+    Persisted state of a streaming EMA crossover, so that it doesn't need to be
+    recomputed over the full history. Every worker reads and updates the same
+    row (under a row lock), so each candle is only acted upon once
+    """
+
+    trader = models.ForeignKey(Trader)
+    market = models.ForeignKey(Market)
+    period = models.IntegerField()
+    short_ema = models.FloatField(blank=True, null=True)
+    long_ema = models.FloatField(blank=True, null=True)
+    candle_count = models.IntegerField(default=0)
+    last_start_time = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        unique_together = (('trader', 'market', 'period'),)
 
 
 ORDER_TYPE_CHOICES = (
@@ -132,6 +146,15 @@ class Order(models.Model):
     market_order_id = models.CharField(max_length=255)
     trader = models.ForeignKey(Trader, blank=True, null=True)
 
+    class Meta:
+        # Order history is listed newest first, optionally filtered by market, status or trader
+        index_together = (
+            ('when_created', 'id'),
+            ('market', 'when_created', 'id'),
+            ('status', 'when_created', 'id'),
+            ('trader', 'when_created', 'id'),
+        )
+
     def __unicode__(self):
         return self.market_order_id
 
@@ -152,6 +175,9 @@ class MarketPrice(models.Model):
     buy_price = models.DecimalField(decimal_places=5, max_digits=18)
     sell_price = models.DecimalField(decimal_places=5, max_digits=18)
 
+    class Meta:
+        index_together = (('market', 'currency_from', 'currency_to', 'time'),)
+
 
 class HistoricalTrade(models.Model):
 
@@ -161,3 +187,32 @@ class HistoricalTrade(models.Model):
     time = models.DateTimeField()
     amount = models.DecimalField(decimal_places=5, max_digits=18)
     price = models.DecimalField(decimal_places=5, max_digits=18)
+
+    class Meta:
+        index_together = (('market', 'currency_from', 'currency_to', 'time'),)
+
+
+class HistoricalImport(models.Model):
+    """
+    How far the bitcoincharts CSV dump for a symbol has been imported into
+    HistoricalTrade. Tracked apart from the trades themselves, since the live
+    sync writes newer trades into the same table
+    """
+
+    symbol = models.CharField(max_length=64, unique=True)
+    last_time = models.DateTimeField()
+
+
+def invalidate_market_api(sender, instance, **kwargs):
+    Market.apis.invalidate(instance.id)
+
+
+def invalidate_trader_algo(sender, instance, **kwargs):
+    Trader.algos.invalidate(instance.id)
+
+
+# Rebuild API/algorithm objects when their market or trader is changed
+post_save.connect(invalidate_market_api, sender=Market)
+post_delete.connect(invalidate_market_api, sender=Market)
+post_save.connect(invalidate_trader_algo, sender=Trader)
+post_delete.connect(invalidate_trader_algo, sender=Trader)
@@ -0,0 +1,258 @@
+from collections import deque
+import heapq
+import time
+
+
+# Amounts smaller than this are treated as zero, to absorb floating point error
+AMOUNT_EPSILON = 1e-9
+
+# Number of recent fills an exchange remembers, for listing
+RECENT_FILLS_KEPT = 1000
+
+
+class BookOrder(object):
+    """
+    An order in an OrderBook. Status is 'O' (open), 'F' (filled) or 'C'
+    (cancelled - including the unfilled part of a market order)
+    """
+
+    __slots__ = ('id', 'side', 'price', 'amount', 'remaining', 'status', 'time', 'filled_time', 'owner')
+
+    def __init__(self, order_id, side, price, amount, time, owner):
+        self.id = order_id
+        self.side = side
+        self.price = price
+        self.amount = amount
+        self.remaining = amount
+        self.status = 'O'
+        self.time = time
+        self.filled_time = None
+        self.owner = owner
+
+
+class OrderBook(object):
+    """
+    Limit order book with price-time priority.
+
+    Each side keeps a heap of its price levels (best first) and a FIFO queue of
+    orders at each level, so finding the best price is O(1), adding an order is
+    O(log levels), and each fill is O(1). Cancelled orders are left in their
+    queues and skipped when reached, rather than searched for. Only orders
+    resting on the book are kept in orders (by id) - they're forgotten once they
+    leave it.
+
+    Sides are 'B' (bids) and 'S' (asks), and prices are floats.
+    """
+
+    def __init__(self):
+        self.heaps = {'B': [], 'S': []}
+        self.levels = {'B': {}, 'S': {}}
+        self.orders = {}
+        self.next_id = 1
+
+    def best_price(self, side):
+        """
+        Returns the best price on a side of the book, or None if it is empty
+        """
+        heap = self.heaps[side]
+        levels = self.levels[side]
+        while heap:
+            price = heap[0] if side == 'S' else -heap[0]
+            queue = levels[price]
+            while queue and queue[0].status != 'O':
+                queue.popleft()
+            if queue:
+                return price
+            del levels[price]
+            heapq.heappop(heap)
+        return None
+
+    def submit(self, side, amount, price=None, timestamp=None, owner=None):
+        """
+        Submit a buy ('B') or sell ('S') order, matching it against the other side
+        of the book. Limit orders (with a price) rest on the book if not completely
+        filled. Market orders (price None) take whatever liquidity is available,
+        and the rest is cancelled. Returns the new BookOrder, and a list of
+        (maker BookOrder, price, amount) fills
+        """
+        if timestamp is None:
+            timestamp = time.time()
+
+        order = BookOrder(self.next_id, side, price, amount, timestamp, owner)
+        self.next_id += 1
+
+        fills = self._match(order, timestamp)
+
+        if order.remaining <= AMOUNT_EPSILON:
+            order.remaining = 0.0
+            order.status = 'F'
+            order.filled_time = timestamp
+        elif price is None:
+            order.status = 'C'
+        else:
+            self._rest(order)
+
+        return order, fills
+
+    def cancel(self, order_id):
+        """
+        Cancel an open order. Returns False if it wasn't open
+        """
+        order = self.orders.pop(order_id, None)
+        if order is None:
+            return False
+        order.status = 'C'
+        return True
+
+    def _rest(self, order):
+        levels = self.levels[order.side]
+        queue = levels.get(order.price)
+        if queue is None:
+            queue = deque()
+            levels[order.price] = queue
+            heapq.heappush(self.heaps[order.side], order.price if order.side == 'S' else -order.price)
+        queue.append(order)
+        self.orders[order.id] = order
+
+    def _match(self, order, timestamp):
+        other_side = 'S' if order.side == 'B' else 'B'
+        orders = self.orders
+        fills = []
+
+        while order.remaining > AMOUNT_EPSILON:
+            best = self.best_price(other_side)
+            if best is None:
+                break
+            if order.price is not None and (best > order.price if order.side == 'B' else best < order.price):
+                break
+
+            queue = self.levels[other_side][best]
+            while queue and order.remaining > AMOUNT_EPSILON:
+                maker = queue[0]
+                if maker.status != 'O':
+                    queue.popleft()
+                    continue
+
+                amount = min(order.remaining, maker.remaining)
+                order.remaining -= amount
+                maker.remaining -= amount
+                fills.append((maker, best, amount))
+
+                if maker.remaining <= AMOUNT_EPSILON:
+                    maker.remaining = 0.0
+                    maker.status = 'F'
+                    maker.filled_time = timestamp
+                    queue.popleft()
+                    del orders[maker.id]
+
+        return fills
+
+
+class SimulatedExchange(object):
+    """
+    In-process exchange built around an OrderBook. A simulated market maker
+    quotes depth on each side of a reference price (e.g. historical trades being
+    replayed), spread apart by the given fraction, and requotes whenever the
+    reference price changes - so resting orders fill as the price moves through
+    them, and market orders pay the spread.
+
+    price_source(timestamp) returns the reference price at a unix timestamp (or
+    None if there isn't one yet), and clock() returns the current timestamp.
+
+    An exchange can be pickled, to share it between processes - the price source
+    and clock aren't included, and must be given back with attach()
+    """
+
+    def __init__(self, price_source, spread=0.002, depth=10.0, clock=time.time):
+        self.price_source = price_source
+        self.spread = spread
+        self.depth = depth
+        self.clock = clock
+
+        self.book = OrderBook()
+        self.reference_price = None
+        self.quote_ids = []
+
+        # Orders submitted by users (rather than the market maker), while they're
+        # open, and the fill times of recently filled ones
+        self.open_orders = {}
+        self.recent_fills = deque(maxlen=RECENT_FILLS_KEPT)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['price_source']
+        del state['clock']
+        return state
+
+    def attach(self, price_source, clock=time.time):
+        self.price_source = price_source
+        self.clock = clock
+
+    def update(self):
+        """
+        Requote around the latest reference price, if it has changed
+        """
+        now = self.clock()
+        price = self.price_source(now)
+        if price is None or price == self.reference_price:
+            return now
+        self.reference_price = price
+
+        for quote_id in self.quote_ids:
+            self.book.cancel(quote_id)
+        self.quote_ids = []
+
+        # The market maker's quotes can cross resting user orders, filling them
+        for side, quote_price in (('B', price * (1 - self.spread / 2)), ('S', price * (1 + self.spread / 2))):
+            quote, fills = self.book.submit(side, self.depth, quote_price, now, owner='maker')
+            self._record_fills(fills, now)
+            if quote.status == 'O':
+                self.quote_ids.append(quote.id)
+
+        return now
+
+    def quote(self):
+        """
+        Returns the current (best ask, best bid) - the prices a market buy and a
+        market sell would start filling at
+        """
+        self.update()
+        return self.book.best_price('S'), self.book.best_price('B')
+
+    def submit(self, side, amount, price=None):
+        """
+        Submit a user order. Returns the BookOrder and its list of fills
+        """
+        now = self.update()
+        order, fills = self.book.submit(side, amount, price, now)
+        self._record_fills(fills, now)
+        if order.status == 'O':
+            self.open_orders[order.id] = order
+        elif order.status == 'F':
+            self.recent_fills.append((order.id, now))
+        return order, fills
+
+    def cancel(self, order_id):
+        self.update()
+        self.open_orders.pop(order_id, None)
+        return self.book.cancel(order_id)
+
+    def list_open_orders(self):
+        """
+        Returns a dictionary of order id -> BookOrder for open user orders
+        """
+        self.update()
+        return dict(self.open_orders)
+
+    def list_recent_fills(self):
+        """
+        Returns a dictionary of order id -> fill time for recently filled user orders
+        """
+        self.update()
+        return dict(self.recent_fills)
+
+    def _record_fills(self, fills, now):
+        for maker, price, amount in fills:
+            if maker.status == 'F' and maker.owner is None:
+                self.open_orders.pop(maker.id, None)
+                self.recent_fills.append((maker.id, now))
@@ -0,0 +1,37 @@
+from multiprocessing.pool import ThreadPool
+import threading
+
+
+# Number of threads available for talking to markets concurrently
+MARKET_THREADS = 8
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Returns the per-process thread pool, creating it on first use (so it is never
+    created before a fork)
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(MARKET_THREADS)
+        return _pool
+
+
+def _guard(function, args, kwargs):
+    # Keep the (success, err, result) contract even if something unexpected is raised
+    try:
+        return function(*args, **kwargs)
+    except Exception as e:
+        return False, 'Unexpected error: %s' % e, None
+
+
+def call_async(function, *args, **kwargs):
+    """
+    Run an api_ function on the thread pool. Returns an AsyncResult - call get()
+    on it to wait for the usual (success, err, result) tuple
+    """
+    return get_pool().apply_async(_guard, (function, args, kwargs))
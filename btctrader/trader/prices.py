@@ -0,0 +1,298 @@
+from celery.signals import worker_process_shutdown
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.utils import timezone
+from cStringIO import StringIO
+import atexit
+import logging
+import threading
+import time
+import models
+from trader_settings import market_settings
+from utils import get_market_setting
+
+
+logger = logging.getLogger(__name__)
+
+
+# Key used to share the latest MarketPrice between processes via Django's cache
+PRICE_CACHE_KEY = 'trader:market_price:%d:%d:%d'
+
+
+class Flight(object):
+    """
+    A refresh in progress. Callers that arrive while it is running wait for its
+    result, rather than making a request of their own
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+
+class PriceCache(object):
+    """
+    In-process TTL cache of the latest MarketPrice for each market/currency pair.
+
+    Lookups within the max age are served from memory, without touching the
+    database or network. Concurrent refreshes of the same price are coalesced,
+    so that only one request is made to the exchange (single-flight).
+
+    If shared is True, each newly fetched price is also published via Django's
+    cache framework. Lookups are always served from memory while the price is
+    fresh, and only check the shared cache once it has expired - so a price
+    fetched by one process saves the others fetching it again, at the cost of a
+    single cache round trip per expiry (this needs a shared cache backend such
+    as memcached to be configured)
+    """
+
+    def __init__(self, shared=False):
+        self.shared = shared
+        self.prices = {}
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    def _fresh(self, key, max_age):
+        market_price = self.prices.get(key)
+        if market_price is None or (timezone.now() - market_price.time).total_seconds() > max_age:
+            return None
+        return market_price
+
+    def peek(self, market, currency_from, currency_to):
+        """
+        Returns the latest cached price for the market/currency pair, however old, or None
+        """
+        return self.prices.get((market.id, currency_from.id, currency_to.id))
+
+    def put(self, market_price, publish=False):
+        """
+        Cache a MarketPrice, if it is newer than the price already cached
+        """
+        key = (market_price.market_id, market_price.currency_from_id, market_price.currency_to_id)
+        with self.lock:
+            current = self.prices.get(key)
+            if current is None or current.time <= market_price.time:
+                self.prices[key] = market_price
+
+        if publish and self.shared:
+            cache.set(PRICE_CACHE_KEY % key, market_price)
+
+    def invalidate(self, market, currency_from, currency_to):
+        key = (market.id, currency_from.id, currency_to.id)
+        with self.lock:
+            self.prices.pop(key, None)
+        if self.shared:
+            cache.delete(PRICE_CACHE_KEY % key)
+
+    def get_price(self, market, currency_from, currency_to, max_age, fetch, force_update=False):
+        """
+        Returns (success, err, MarketPrice) for the market/currency pair. Served
+        from memory if a price no older than max_age seconds is cached; otherwise
+        from the shared cache or the database if another process has a recent
+        enough price; otherwise fetch() is called to get a new price from the
+        exchange, which is cached straight away and queued to be written to the
+        database by price_writer. If force_update is True, a new price is always
+        fetched
+        """
+        key = (market.id, currency_from.id, currency_to.id)
+        if not force_update:
+            market_price = self._fresh(key, max_age)
+            if market_price is not None:
+                return True, None, market_price
+
+        flight_key = key + (force_update,)
+        with self.lock:
+            flight = self.flights.get(flight_key)
+            leader = flight is None
+            if leader:
+                flight = Flight()
+                self.flights[flight_key] = flight
+
+        if not leader:
+            flight.event.wait()
+            return flight.result
+
+        try:
+            flight.result = self._refresh(market, currency_from, currency_to, max_age, fetch, force_update)
+        except Exception as e:
+            flight.result = False, 'Unexpected error: %s' % e, None
+        finally:
+            with self.lock:
+                del self.flights[flight_key]
+            flight.event.set()
+
+        return flight.result
+
+    def _refresh(self, market, currency_from, currency_to, max_age, fetch, force_update):
+        if not force_update and self.shared:
+            key = (market.id, currency_from.id, currency_to.id)
+            market_price = cache.get(PRICE_CACHE_KEY % key)
+            if market_price is not None and (timezone.now() - market_price.time).total_seconds() <= max_age:
+                self.put(market_price)
+                return True, None, market_price
+
+        if not force_update:
+            try:
+                last_price = models.MarketPrice.objects.filter(
+                    market=market,
+                    currency_from=currency_from,
+                    currency_to=currency_to
+                ).order_by('-time')[0]
+
+                # Is this price recent enough? If so, just return it
+                if (timezone.now() - last_price.time).total_seconds() <= max_age:
+                    self.put(last_price)
+                    return True, None, last_price
+
+            except IndexError:
+                # Don't do anything - this just means we couldn't find any MarketPrice
+                # objects for the market/currency
+                pass
+
+        success, err, market_price = fetch()
+        if not success:
+            return success, err, market_price
+
+        self.put(market_price, publish=True)
+        price_writer.add(market_price)
+
+        return True, None, market_price
+
+
+def write_market_prices(market_prices):
+    """
+    Write a batch of new MarketPrice objects in a single transaction. Uses COPY
+    when running on PostgreSQL, and falls back to bulk_create for any other
+    database.
+    """
+    with transaction.commit_on_success():
+        if connection.vendor == 'postgresql':
+            copy_market_prices(market_prices)
+        else:
+            models.MarketPrice.objects.bulk_create(market_prices)
+
+
+def copy_market_prices(market_prices):
+    """
+    Stream a batch of MarketPrice objects into the MarketPrice table using
+    PostgreSQL COPY
+    """
+    meta = models.MarketPrice._meta
+    columns = [meta.get_field(name).column
+               for name in ('market', 'currency_from', 'currency_to', 'time', 'buy_price', 'sell_price')]
+
+    buf = StringIO()
+    for market_price in market_prices:
+        buf.write('%d\t%d\t%d\t%s\t%s\t%s\n' % (market_price.market_id, market_price.currency_from_id,
+                                                market_price.currency_to_id, market_price.time.isoformat(),
+                                                market_price.buy_price, market_price.sell_price))
+    buf.seek(0)
+
+    cursor = connection.cursor()
+    cursor.copy_from(buf, meta.db_table, columns=columns)
+
+
+class PriceWriter(object):
+    """
+    Buffers new MarketPrice objects in memory and writes them to the database in
+    batches - once batch_size prices are waiting, or max_delay seconds after the
+    oldest was queued, whichever comes first - rather than with one INSERT (and
+    transaction) per price. If a write fails the batch is kept, and retried
+    after max_delay. Anything still buffered is written when the process exits.
+
+    Readers should get the latest prices from price_cache, which is updated as
+    soon as a price is fetched. Prices written in batches don't have their ids
+    set (bulk_create doesn't return them)
+    """
+
+    def __init__(self, batch_size, max_delay):
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.buffer = []
+        self.first_queued = None
+        self.timer = None
+        self.failed_at = None
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+    def add(self, market_price):
+        with self.lock:
+            self.buffer.append(market_price)
+            now = time.time()
+            if self.first_queued is None:
+                self.first_queued = now
+            due = len(self.buffer) >= self.batch_size or now - self.first_queued >= self.max_delay
+
+            # After a failed write, leave retrying to the timer rather than holding up callers
+            if self.failed_at is not None and now - self.failed_at < self.max_delay:
+                due = False
+
+            if not due:
+                self._start_timer()
+
+        if due:
+            try:
+                self.flush()
+            except Exception:
+                # The prices are still buffered, so the caller's price is not lost
+                logger.exception('Unable to write market prices')
+
+    def _start_timer(self):
+        # Make sure buffered prices are still written after max_delay, even if no more arrive
+        if self.timer is None:
+            self.timer = threading.Timer(self.max_delay, self._timed_flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        """
+        Write everything buffered so far. Returns the number of prices written
+        """
+        with self.flush_lock:
+            with self.lock:
+                market_prices = self.buffer
+                first_queued = self.first_queued
+                self.buffer = []
+                self.first_queued = None
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+
+            if len(market_prices) > 0:
+                try:
+                    write_market_prices(market_prices)
+                except Exception:
+                    # Put the batch back in front of anything queued since, and try again later
+                    with self.lock:
+                        self.buffer[:0] = market_prices
+                        self.first_queued = first_queued
+                        self.failed_at = time.time()
+                        self._start_timer()
+                    raise
+
+            self.failed_at = None
+            return len(market_prices)
+
+    def _timed_flush(self):
+        # Runs on the timer's own thread, so has its own database connection
+        try:
+            self.flush()
+        except Exception:
+            logger.exception('Unable to write market prices')
+        finally:
+            connection.close()
+
+
+default_settings = market_settings()
+
+price_cache = PriceCache(shared=get_market_setting(default_settings, 'price_cache_shared'))
+
+price_writer = PriceWriter(get_market_setting(default_settings, 'price_write_batch_size'),
+                           get_market_setting(default_settings, 'price_write_max_delay'))
+atexit.register(price_writer.flush)
+
+
+@worker_process_shutdown.connect
+def flush_market_prices(**kwargs):
+    # Celery worker processes may exit without running atexit handlers
+    price_writer.flush()
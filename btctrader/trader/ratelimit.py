@@ -0,0 +1,101 @@
+import fcntl
+import os
+import threading
+import time
+from collections import deque
+
+
+class SlidingWindow(object):
+    """
+    Sliding window rate limiter. Allows up to max_requests in any window
+    seconds - all at once, or spread out - and never more.
+
+    The times of the last max_requests requests are kept, and a request is
+    allowed once the one max_requests before it is a full window old. Each
+    request reserves its slot straight away - possibly in the future, in which
+    case the caller is told exactly how long to wait for it. So every check is
+    O(1), and concurrent callers queue up fairly without oversleeping.
+
+    If shared_dir is given, the request times are kept in a file there (guarded
+    by a file lock) rather than in memory, so that every process on the machine
+    shares one budget - e.g. all Celery workers and web processes
+    """
+
+    def __init__(self, name, max_requests, window, shared_dir=None):
+        self.name = name
+        self.max_requests = max_requests
+        self.window = float(window)
+        self.path = os.path.join(shared_dir, '%s.window' % name) if shared_dir is not None else None
+
+        self.lock = threading.Lock()
+        self.times = deque(maxlen=max_requests)
+
+    def _reserve(self, times, now, max_wait):
+        """
+        Reserve the next slot after the request times given (the last
+        max_requests of them, oldest first), and return the number of seconds
+        to wait for it - or None if that would be longer than max_wait, in
+        which case no slot is taken
+        """
+        slot = now
+        if len(times) > 0:
+            slot = max(slot, times[-1])
+        if len(times) >= self.max_requests:
+            slot = max(slot, times[-self.max_requests] + self.window)
+
+        wait = slot - now
+        if max_wait is not None and wait > max_wait:
+            return None
+        times.append(slot)
+        return wait
+
+    def reserve(self, max_wait=None):
+        """
+        Reserve a slot. Returns the number of seconds the caller must wait before
+        using it, or None if no slot could be reserved within max_wait seconds
+        """
+        now = time.time()
+        with self.lock:
+            if self.path is None:
+                return self._reserve(self.times, now, max_wait)
+
+            state_file = os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644), 'r+b')
+            try:
+                fcntl.flock(state_file.fileno(), fcntl.LOCK_EX)
+                times = deque((float(t) for t in state_file.read().split()), maxlen=self.max_requests)
+
+                wait = self._reserve(times, now, max_wait)
+
+                state_file.seek(0)
+                state_file.truncate()
+                state_file.write(' '.join(repr(t) for t in times))
+                return wait
+            finally:
+                state_file.close()
+
+    def acquire(self, max_wait=None):
+        """
+        Wait for a slot. Returns False (without waiting) if one wouldn't be
+        available within max_wait seconds
+        """
+        wait = self.reserve(max_wait)
+        if wait is None:
+            return False
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+
+# Per-process limiters, keyed by name - so every API object for the same exchange
+# shares a single budget
+limiters = {}
+limiters_lock = threading.Lock()
+
+
+def get_limiter(name, max_requests, window, shared_dir=None):
+    with limiters_lock:
+        limiter = limiters.get(name)
+        if limiter is None:
+            limiter = SlidingWindow(name, max_requests, window, shared_dir)
+            limiters[name] = limiter
+        return limiter
@@ -0,0 +1,43 @@
+import threading
+
+
+class Registry(object):
+    """
+    Per-process registry of objects built from model instances - e.g. the API
+    object for each Market - so they are only constructed once.
+
+    Lookups are a single dictionary access. Construction happens under a lock,
+    so concurrent lookups (e.g. from the market thread pool) never build the same
+    object twice. Each object is stored alongside a version of the instance it
+    was built from (e.g. its api_name): if a later lookup sees a different
+    version, because the row was changed by another process, the object is
+    rebuilt. Changes saved in this process invalidate the object straight away
+    """
+
+    def __init__(self, factory, version):
+        self.factory = factory
+        self.version = version
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, instance):
+        version = self.version(instance)
+        entry = self.entries.get(instance.id)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+
+        with self.lock:
+            # Someone else may have built it while we waited for the lock
+            entry = self.entries.get(instance.id)
+            if entry is None or entry[0] != version:
+                entry = (version, self.factory(instance))
+                self.entries[instance.id] = entry
+            return entry[1]
+
+    def invalidate(self, instance_id):
+        with self.lock:
+            self.entries.pop(instance_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
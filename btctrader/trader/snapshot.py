@@ -0,0 +1,98 @@
+from django.core.cache import cache
+from django.utils import timezone
+import events
+import models
+
+
+# Cache key the latest price snapshot is published under
+SNAPSHOT_CACHE_KEY = 'trader:price_snapshot'
+
+# Seconds a published snapshot is kept for. If the agent stops publishing, readers
+# fall back to the database after this long
+SNAPSHOT_TIMEOUT = 600
+
+# Seconds a snapshot rebuilt from the database is kept for
+SNAPSHOT_FALLBACK_TIMEOUT = 10
+
+
+def price_entry(market, market_price):
+    """
+    Snapshot entry for a market's latest MarketPrice - plain, JSON serializable values only
+    """
+    return {
+        'id': market.id,
+        'name': market.name,
+        'abbrev': market.abbrev,
+        'currency_from': market_price.currency_from.abbrev,
+        'currency_to': market_price.currency_to.abbrev,
+        'buy_price': float(market_price.buy_price),
+        'sell_price': float(market_price.sell_price),
+        'time': market_price.time.isoformat(),
+    }
+
+
+def build_snapshot(entries):
+    return {
+        'time': timezone.now().isoformat(),
+        'markets': sorted(entries, key=lambda entry: entry['name']),
+    }
+
+
+def publish_prices(markets, market_prices):
+    """
+    Update the published snapshot with new prices, given a list of markets and a
+    dictionary of market id -> MarketPrice, and publish a 'prices' event with
+    the new entries. Markets without a new price keep their previous entry.
+    Called by the agent whenever prices are updated
+    """
+    previous = cache.get(SNAPSHOT_CACHE_KEY)
+    entries = {}
+    if previous is not None:
+        entries = dict((entry['id'], entry) for entry in previous['markets'])
+
+    changed = []
+    for market in markets:
+        market_price = market_prices.get(market.id)
+        if market_price is not None:
+            entries[market.id] = price_entry(market, market_price)
+            changed.append(entries[market.id])
+
+    snapshot = build_snapshot(entries.values())
+    cache.set(SNAPSHOT_CACHE_KEY, snapshot, SNAPSHOT_TIMEOUT)
+
+    # Push just the new prices to connected clients
+    if len(changed) > 0:
+        events.publish('prices', changed)
+
+    return snapshot
+
+
+def load_snapshot():
+    """
+    Build a snapshot from the latest MarketPrice stored for each market's default
+    currency pair - one indexed query per market, and never any API calls
+    """
+    entries = []
+    for market in models.Market.objects.select_related('default_currency_from', 'default_currency_to'):
+        latest = models.MarketPrice.objects.filter(market=market,
+                                                   currency_from=market.default_currency_from,
+                                                   currency_to=market.default_currency_to)\
+                                           .select_related('currency_from', 'currency_to').order_by('-time')[:1]
+        if len(latest) > 0:
+            entries.append(price_entry(market, latest[0]))
+    return build_snapshot(entries)
+
+
+def get_snapshot():
+    """
+    Returns the latest price snapshot: a dictionary with the time it was built,
+    and a list of price entries (one per market, sorted by name). Normally a
+    single cache read. If nothing has been published to a cache this process
+    can see (e.g. the agent isn't running, or the cache backend isn't shared),
+    the snapshot is rebuilt from the database, and cached for a few seconds
+    """
+    snapshot = cache.get(SNAPSHOT_CACHE_KEY)
+    if snapshot is None:
+        snapshot = load_snapshot()
+        cache.add(SNAPSHOT_CACHE_KEY, snapshot, SNAPSHOT_FALLBACK_TIMEOUT)
+    return snapshot
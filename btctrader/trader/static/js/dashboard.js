@@ -0,0 +1,60 @@
+// Keeps the dashboard ticker and order table up to date from the live event stream
+$(function() {
+    var ticker = $('#ticker');
+    var tickerPrices = $('#ticker-prices');
+    var orderTable = $('.order-table');
+
+    // Number of orders shown in the table
+    var maxOrders = 30;
+
+    // Latest price entry for each market, by market id
+    var prices = {};
+
+    function renderTicker() {
+        var entries = $.map(prices, function(price) { return price; });
+        entries.sort(function(a, b) { return a.name < b.name ? -1 : (a.name > b.name ? 1 : 0); });
+
+        tickerPrices.empty();
+        $.each(entries, function(i, price) {
+            tickerPrices.append(document.createTextNode(
+                price.name + ' B: ' + price.buy_price + ' S: ' + price.sell_price + ' | '));
+        });
+    }
+
+    function updatePrices(entries) {
+        $.each(entries, function(i, price) {
+            prices[price.id] = price;
+        });
+        renderTicker();
+    }
+
+    function updateOrders(orders) {
+        $.each(orders, function(i, order) {
+            var row = $('<tr>').attr('data-order-id', order.id);
+            $.each([order.id, order.when_created, order.market, order.market_order_id, order.currency_from,
+                    order.currency_to, order.order_type, order.market_order ? 'Yes' : 'No', order.amount,
+                    order.price, order.price === null ? '' : (order.amount * order.price).toFixed(5),
+                    order.status], function(j, value) {
+                row.append($('<td>').text(value === null ? 'None' : value));
+            });
+
+            var existing = order.id === null ? $() : orderTable.find('tr[data-order-id="' + order.id + '"]');
+            if (existing.length > 0) {
+                existing.replaceWith(row);
+            } else {
+                orderTable.find('tr').first().after(row);
+            }
+        });
+        orderTable.find('tr').slice(maxOrders + 1).remove();
+    }
+
+    // Start from the current snapshot, then apply deltas as they arrive
+    $.getJSON(ticker.data('url'), function(snapshot) {
+        updatePrices(snapshot.markets);
+    });
+
+    subscribeEvents(ticker.data('stream-url'), ticker.data('poll-url'), {
+        prices: updatePrices,
+        orders: updateOrders
+    });
+});
@@ -0,0 +1,37 @@
+// Subscribes to live events, calling handlers[event type](data) for each event. Uses
+// server-sent events when the server offers a stream (streamUrl is set) and the
+// browser supports them, and polling otherwise - the server says how long to wait
+// between polls. A 'reset' event means too many events were missed - the page reloads
+function subscribeEvents(streamUrl, pollUrl, handlers) {
+    function dispatch(type, data) {
+        if (type == 'reset') {
+            window.location.reload();
+        } else if (handlers[type]) {
+            handlers[type](data);
+        }
+    }
+
+    if (streamUrl && window.EventSource) {
+        var source = new EventSource(streamUrl);
+        $.each(['prices', 'orders', 'reset'], function(i, type) {
+            source.addEventListener(type, function(e) {
+                dispatch(type, JSON.parse(e.data));
+            });
+        });
+        return;
+    }
+
+    var since = null;
+    function poll() {
+        $.getJSON(pollUrl, since === null ? {} : {since: since}, function(result) {
+            since = result.last_event_id;
+            $.each(result.events, function(i, event) {
+                dispatch(event.type, event.data);
+            });
+            setTimeout(poll, result.retry);
+        }).fail(function() {
+            setTimeout(poll, 5000);
+        });
+    }
+    poll();
+}
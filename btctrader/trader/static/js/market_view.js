@@ -0,0 +1,16 @@
+// Keeps the market page's price up to date from the live event stream
+$(function() {
+    var marketPrice = $('#market-price');
+    var marketId = marketPrice.data('market-id');
+
+    subscribeEvents(marketPrice.data('stream-url'), marketPrice.data('poll-url'), {
+        prices: function(entries) {
+            $.each(entries, function(i, price) {
+                if (price.id == marketId) {
+                    marketPrice.find('.sell-price').text(price.sell_price.toFixed(2));
+                    marketPrice.find('.buy-price').text(price.buy_price.toFixed(2));
+                }
+            });
+        }
+    });
+});
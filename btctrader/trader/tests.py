@@ -14,3 +14,609 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class HistoricalImportTest(TestCase):
+    def test_iter_csv_trades_across_chunks(self):
+        """
+        Rows split across chunk boundaries are reassembled, and blank lines
+        and rows older than min_timestamp are skipped
+        """
+        from cStringIO import StringIO
+        from agent import iter_csv_trades
+
+        csv_file = StringIO('100,1.5,2.0\n101,1.6,0.5\n\n102,1.7,0.25')
+        rows = list(iter_csv_trades(csv_file, chunk_size=4, min_timestamp=101))
+        self.assertEqual(rows, [(101, '1.6', '0.5'), (102, '1.7', '0.25')])
+
+        # Rows from max_timestamp on are already stored by the live sync
+        csv_file.seek(0)
+        rows = list(iter_csv_trades(csv_file, chunk_size=4, max_timestamp=102))
+        self.assertEqual(rows, [(100, '1.5', '2.0'), (101, '1.6', '0.5')])
+
+    def test_import_progress(self):
+        """
+        Import progress is kept per symbol, apart from the trades themselves
+        """
+        import agent
+        from models import HistoricalImport
+
+        self.assertEqual(agent.get_import_progress('mtgoxUSD'), None)
+        agent.set_import_progress('mtgoxUSD', 100)
+        agent.set_import_progress('mtgoxUSD', 200)
+        self.assertEqual(agent.get_import_progress('mtgoxUSD'), 200)
+        self.assertEqual(HistoricalImport.objects.count(), 1)
+
+    def test_fetch_trades_since_fails_on_gap(self):
+        """
+        A page failing part way back leaves a gap, so nothing is returned
+        """
+        import agent
+
+        pages = {300: (True, None, [(250, '1.0', '1.0'), (200, '1.1', '1.0')]),
+                 200: (False, 'bitcoincharts request failed', None)}
+        old_fetch = agent.fetch_bitcoincharts_trades
+        agent.fetch_bitcoincharts_trades = lambda symbol, end: pages[end]
+        try:
+            self.assertEqual(agent.fetch_trades_since('mtgoxUSD', 100, 300), (False, 'bitcoincharts request failed', None))
+
+            pages[200] = (True, None, [(150, '1.2', '1.0'), (90, '1.3', '1.0')])
+            success, err, trades = agent.fetch_trades_since('mtgoxUSD', 100, 300)
+            self.assertEqual(sorted(timestamp for timestamp, price, amount in trades), [150, 200, 250])
+        finally:
+            agent.fetch_bitcoincharts_trades = old_fetch
+
+
+class TradeStoreTest(TestCase):
+    def test_append_trim_and_window(self):
+        from tradestore import TradeStore
+
+        store = TradeStore(None, None, None, capacity=2)
+        store.append([10, 20, 30], [1.0, 2.0, 3.0], [0.1, 0.2, 0.3])
+        store.append([25], [2.5], [0.25])
+        self.assertEqual(list(store.times), [10, 20, 25, 30])
+
+        store.trim(20)
+        times, prices, amounts = store.window(20, 30)
+        self.assertEqual(list(times), [20, 25])
+        self.assertEqual(list(prices), [2.0, 2.5])
+        self.assertEqual(store.last_price(29), 2.5)
+
+
+class TradeArchiveTest(TestCase):
+    def test_append_window_and_truncate(self):
+        import archive
+        import os
+        import shutil
+        import tempfile
+
+        tmp_dir = tempfile.mkdtemp()
+        old_locations = archive.ARCHIVE_LOCATION, archive.ARCHIVE_INDEX_LOCATION, archive.ARCHIVE_INDEX_INTERVAL
+        archive.ARCHIVE_LOCATION = os.path.join(tmp_dir, '%s.trades')
+        archive.ARCHIVE_INDEX_LOCATION = os.path.join(tmp_dir, '%s.index')
+        archive.ARCHIVE_INDEX_INTERVAL = 3
+        try:
+            trade_archive = archive.TradeArchive('testUSD')
+            trade_archive.append(range(0, 10), [float(i) for i in range(0, 10)], [1.0] * 10)
+            trade_archive.append(range(10, 20), [float(i) for i in range(10, 20)], [1.0] * 10)
+
+            times, prices, amounts = trade_archive.window(4, 14)
+            self.assertEqual(list(times), range(4, 14))
+            self.assertEqual(list(prices), [float(i) for i in range(4, 14)])
+
+            trade_archive.truncate(15)
+            self.assertEqual(trade_archive.last_timestamp, 14)
+            self.assertEqual(list(trade_archive.window(13)[0]), [13, 14])
+        finally:
+            archive.ARCHIVE_LOCATION, archive.ARCHIVE_INDEX_LOCATION, archive.ARCHIVE_INDEX_INTERVAL = old_locations
+            shutil.rmtree(tmp_dir)
+
+
+class CandleTest(TestCase):
+    def test_parse_period(self):
+        from candles import parse_period
+
+        self.assertEqual(parse_period('1M'), 60)
+        self.assertEqual(parse_period('4h'), 4 * 60 * 60)
+        self.assertEqual(parse_period(300), 300)
+        self.assertRaises(ValueError, parse_period, '1Y')
+
+    def test_build_candles(self):
+        import numpy as np
+        from candles import build_candles
+
+        times = np.array([0, 30, 59, 60, 185], dtype=np.int64)
+        prices = np.array([10.0, 12.0, 9.0, 11.0, 13.0])
+        amounts = np.array([1.0, 2.0, 3.0, 4.0, 5.0])
+
+        start_times, open_prices, highs, lows, close_prices, volumes = build_candles(times, prices, amounts, 60)
+        self.assertEqual(list(start_times), [0, 60, 180])
+        self.assertEqual(list(open_prices), [10.0, 11.0, 13.0])
+        self.assertEqual(list(highs), [12.0, 11.0, 13.0])
+        self.assertEqual(list(lows), [9.0, 11.0, 13.0])
+        self.assertEqual(list(close_prices), [9.0, 11.0, 13.0])
+        self.assertEqual(list(volumes), [6.0, 4.0, 5.0])
+
+    def test_rollup_matches_direct_build(self):
+        import numpy as np
+        from candles import build_candles, rollup_candles
+
+        times = np.arange(0, 7200, 7, dtype=np.int64)
+        prices = np.sin(times / 100.0) + 2
+        amounts = np.ones(len(times))
+
+        direct = build_candles(times, prices, amounts, 3600)
+        rolled = rollup_candles(build_candles(times, prices, amounts, 60), 3600)
+        for direct_column, rolled_column in zip(direct, rolled):
+            self.assertTrue(np.allclose(direct_column, rolled_column))
+
+
+class EmaCrossoverTest(TestCase):
+    def test_crossover_signals(self):
+        from traders import EmaCrossover
+
+        crossover = EmaCrossover(2, 3)
+
+        # Falling prices during warm-up never signal
+        signals = [crossover.update(i * 60, price) for i, price in enumerate([10.0, 9.0, 8.0, 7.0])]
+        self.assertEqual(signals, [None] * 4)
+
+        # A sharp rise takes the short EMA above the long EMA
+        self.assertEqual(crossover.update(240, 20.0), 'B')
+        self.assertEqual(crossover.update(300, 21.0), None)
+        self.assertEqual(crossover.update(360, 1.0), 'S')
+        self.assertEqual(crossover.last_start_time, 360)
+
+    def test_workers_signal_each_candle_once(self):
+        import numpy as np
+        from datetime import datetime
+        from django.utils import timezone
+        from models import Currency, Market, Trader
+        from traders import EmaTrader
+
+        btc = Currency.objects.create(name='Bitcoin', abbrev='BTC')
+        usd = Currency.objects.create(name='US Dollar', abbrev='USD')
+        market = Market.objects.create(name='A', abbrev='a', api_name='null', default_currency_from=btc,
+                                       default_currency_to=usd, reserved_currency=usd)
+        trader = Trader.objects.create(name='EMA', abbrev='ema', algo_name='ema')
+
+        closes = [10.0, 9.0, 8.0, 7.0, 20.0]
+
+        class FakeData(object):
+            live = True
+
+            def candles(self, market, period, start, end):
+                times = np.arange(0, len(closes) * 60, 60)
+                keep = (times >= (start or 0)) & (times < end)
+                return times[keep], None, None, None, np.array(closes)[keep], None
+
+        class FakeSettings(object):
+            algo = {'ema': {'period': '1M', 'short_period': 2, 'long_period': 3}}
+
+        # Two workers, each with its own EmaTrader - only the first acts on the crossover
+        timestamp = datetime.fromtimestamp(len(closes) * 60, timezone.utc)
+        first, second = EmaTrader(trader, data=FakeData()), EmaTrader(trader, data=FakeData())
+        self.assertEqual([order.order_type for order in first.build_orders([market], timestamp, FakeSettings())],
+                         ['B'])
+        self.assertEqual(second.build_orders([market], timestamp, FakeSettings()), [])
+
+
+class BacktestTest(TestCase):
+    def test_pending_orders_fill(self):
+        import numpy as np
+        from backtest import PendingOrders
+        from models import Order
+
+        pending = PendingOrders()
+        market_buy = Order(order_type='B', market_order=True)
+        limit_buy = Order(order_type='B', market_order=False, price=96)
+        limit_sell = Order(order_type='S', market_order=False, price=110)
+        for order in (limit_buy, market_buy, limit_sell):
+            pending.add(order)
+
+        # No trades - nothing fills
+        self.assertEqual(pending.fill(np.array([])), [])
+
+        # Fills come back in submission order, and the sell above the range keeps waiting
+        self.assertEqual(pending.fill(np.array([100.0, 95.0, 105.0])), [(limit_buy, 96.0), (market_buy, 100.0)])
+        self.assertEqual(len(pending), 1)
+        self.assertEqual(pending.fill(np.array([111.0])), [(limit_sell, 110.0)])
+
+    def test_expand_grid(self):
+        from backtest import expand_grid
+
+        combinations = expand_grid({'short_period': [5, 10], 'period': ['1M']})
+        self.assertEqual(combinations, [{'period': '1M', 'short_period': 5},
+                                        {'period': '1M', 'short_period': 10}])
+
+
+class SlidingWindowTest(TestCase):
+    def check_limiter(self, limiter):
+        self.assertEqual(limiter.reserve(), 0)
+        self.assertEqual(limiter.reserve(), 0)
+
+        # Window is full - the next slot is two seconds away, which is too long to wait
+        self.assertEqual(limiter.reserve(max_wait=0.5), None)
+        self.assertAlmostEqual(limiter.reserve(), 2.0, places=1)
+        self.assertAlmostEqual(limiter.reserve(), 2.0, places=1)
+
+    def test_in_process(self):
+        from ratelimit import SlidingWindow
+
+        self.check_limiter(SlidingWindow('test', 2, 2))
+
+    def test_shared(self):
+        import shutil
+        import tempfile
+        from ratelimit import SlidingWindow
+
+        shared_dir = tempfile.mkdtemp()
+        try:
+            self.check_limiter(SlidingWindow('test', 2, 2, shared_dir))
+
+            # Another process (or limiter) sees the same state
+            self.assertAlmostEqual(SlidingWindow('test', 2, 2, shared_dir).reserve(), 4.0, places=1)
+        finally:
+            shutil.rmtree(shared_dir)
+
+    def test_full_limit_in_every_window(self):
+        from ratelimit import SlidingWindow
+
+        # Exactly the limit is let through in the first window, and in each one after it -
+        # the requests for each window are given slots at its start
+        for max_requests, window in ((10, 10), (600, 600), (1, 0.5)):
+            limiter = SlidingWindow('test', max_requests, window)
+            waits = [limiter.reserve() for i in range(max_requests * 3)]
+            for windows in (1, 2, 3):
+                self.assertEqual(len([wait for wait in waits if wait < window * (windows - 0.5)]),
+                                 max_requests * windows)
+
+
+class PriceWriterTest(TestCase):
+    def test_batches_until_size_threshold(self):
+        import prices
+
+        written = []
+        old_write = prices.write_market_prices
+        prices.write_market_prices = written.append
+        try:
+            writer = prices.PriceWriter(batch_size=2, max_delay=60)
+            writer.add('first')
+            self.assertEqual(written, [])
+
+            writer.add('second')
+            self.assertEqual(written, [['first', 'second']])
+
+            writer.add('third')
+            self.assertEqual(writer.flush(), 1)
+            self.assertEqual(written[-1], ['third'])
+            self.assertEqual(writer.timer, None)
+        finally:
+            prices.write_market_prices = old_write
+
+    def test_failed_write_is_kept(self):
+        import prices
+
+        written = []
+
+        def fail(market_prices):
+            raise Exception('Database unavailable')
+
+        old_write = prices.write_market_prices
+        prices.write_market_prices = fail
+        try:
+            writer = prices.PriceWriter(batch_size=1, max_delay=60)
+            writer.add('first')
+            self.assertEqual(writer.buffer, ['first'])
+
+            # Retrying is left to the timer for a while, rather than every new price
+            writer.add('second')
+            self.assertEqual(writer.buffer, ['first', 'second'])
+
+            prices.write_market_prices = written.append
+            self.assertEqual(writer.flush(), 2)
+            self.assertEqual(written, [['first', 'second']])
+        finally:
+            prices.write_market_prices = old_write
+
+
+class ReconcileTest(TestCase):
+    def setUp(self):
+        from models import Currency, Order
+
+        btc = Currency(abbrev='BTC')
+        usd = Currency(abbrev='USD')
+        self.orders = [Order(id=i, market_order_id=str(i), status='O', amount=1, market_order=False,
+                             currency_from=btc, currency_to=usd) for i in range(1, 5)]
+
+    def get_market(self, market_class):
+        # Skip __init__, which needs a Market in the database
+        market = market_class.__new__(market_class)
+        self.saved = []
+        market.save_order_statuses = lambda transitions, fill_times: self.saved.append((transitions, fill_times))
+        return market
+
+    def test_mtgox_reconcile_orders(self):
+        from markets import MtGoxMarket
+
+        market = self.get_market(MtGoxMarket)
+        open_orders = {
+            '1': {'oid': '1', 'currency': 'USD', 'item': 'BTC', 'amount': 1, 'price': '100', 'status': 'open'},
+            '2': {'oid': '2', 'currency': 'USD', 'item': 'BTC', 'amount': 1, 'price': '100', 'status': 'executing'},
+        }
+
+        self.assertEqual(market.reconcile_orders(self.orders[:3], open_orders), (True, None, None))
+        # Order 1 is unchanged, order 2 is executing, and order 3 is no longer open so is assumed filled
+        transitions, fill_times = self.saved[0]
+        self.assertEqual(transitions, {self.orders[1]: 'E', self.orders[2]: 'F'})
+        self.assertEqual(list(fill_times.keys()), [self.orders[2]])
+
+    def test_mtgox_lists_each_currency_pair(self):
+        from markets import MtGoxMarket
+
+        market = self.get_market(MtGoxMarket)
+        requested = []
+
+        def api_request(path, idempotent=None):
+            requested.append(path)
+            return True, None, [{'oid': path}]
+
+        market.api_request = api_request
+        success, err, open_orders = market.api_list_open_orders(['BTCEUR', 'BTCUSD'])
+        self.assertEqual(requested, ['BTCEUR/money/orders', 'BTCUSD/money/orders'])
+        self.assertEqual(sorted(open_orders.keys()), requested)
+
+    def test_reconcile_orders_with_fills(self):
+        from datetime import datetime
+        from django.utils import timezone
+        from markets import BitstampMarket
+
+        market = self.get_market(BitstampMarket)
+        when = datetime(2013, 9, 1, tzinfo=timezone.utc)
+
+        market.reconcile_orders(self.orders, {'1': {'id': 1}}, {'1': when, '2': when})
+        # Order 1 is still open (partially filled), order 2 was filled, and orders 3 and 4
+        # are neither open nor recently filled
+        transitions, fill_times = self.saved[0]
+        self.assertEqual(transitions, {self.orders[1]: 'F', self.orders[2]: 'U', self.orders[3]: 'U'})
+        self.assertEqual(fill_times, {self.orders[1]: when})
+
+
+class NullMarketTest(TestCase):
+    def get_market(self):
+        from markets import NullMarket
+
+        # Skip __init__, which needs a Market in the database
+        return NullMarket.__new__(NullMarket)
+
+    def test_order_ids_are_namespaced(self):
+        market = self.get_market()
+        self.assertEqual(market.make_order_id('abc', 1), 'abc-1')
+        self.assertEqual(market.parse_order_id('abc-1'), ('abc', 1))
+        # Not from any book - e.g. placed before order ids were namespaced
+        self.assertEqual(market.parse_order_id('1'), None)
+
+    def test_missing_price_source(self):
+        market = self.get_market()
+        market.price_source = 'missing'
+        success, err, result = market.load_replay('BTC', 'USD', None)
+        self.assertEqual((success, result), (False, None))
+        self.assertTrue('missing' in err)
+
+
+class ArbitrageTest(TestCase):
+    def test_find_opportunity(self):
+        from models import Market
+        from traders import ArbitrageTrader
+
+        a, b, c = Market(id=1), Market(id=2), Market(id=3)
+        trader = ArbitrageTrader(None, data=object())
+
+        # Market a is both the cheapest to buy on and the best to sell on
+        buys = [(100.0, a), (101.0, b), (105.0, c)]
+        sells = [(104.0, a), (102.0, c), (99.0, b)]
+        self.assertEqual(trader.find_opportunity(buys, sells, 0.01), (a, c))
+
+        # Not enough profit
+        self.assertEqual(trader.find_opportunity(buys, sells, 0.03), None)
+
+    def test_build_orders_uses_data_fees(self):
+        from datetime import datetime
+        from django.utils import timezone
+        from models import Currency, Market, Trader
+        from traders import ArbitrageTrader
+        from utils import datetime_to_timestamp
+
+        timestamp = datetime(2013, 9, 1, tzinfo=timezone.utc)
+        btc, usd = Currency(abbrev='BTC'), Currency(abbrev='USD')
+        a = Market(id=1, default_currency_from=btc, default_currency_to=usd)
+        b = Market(id=2, default_currency_from=btc, default_currency_to=usd)
+
+        class FakeData(object):
+            quotes = {1: (100.0, 99.0), 2: (104.0, 103.0)}
+            fees = {1: 0.01}
+
+            def quote(self, market, now):
+                return (datetime_to_timestamp(timestamp),) + self.quotes[market.id]
+
+            def fee(self, market):
+                return self.fees.get(market.id)
+
+        class FakeSettings(object):
+            algo = {'arbitrage': {'amount': 1.0, 'default_fee': 0.0}}
+
+        trader = ArbitrageTrader(Trader(abbrev='arbitrage'), data=FakeData())
+        buy, sell = trader.build_orders([a, b], timestamp, FakeSettings())
+
+        # Buy on a, and sell only what's left of it after a's fee on b
+        self.assertEqual((buy.market, buy.order_type, buy.amount, buy.price), (a, 'B', 1.0, 100.0))
+        self.assertEqual((sell.market, sell.order_type, sell.amount, sell.price), (b, 'S', 0.99, 103.0))
+
+
+class FeeCacheTest(TestCase):
+    def test_fee_cache(self):
+        from fees import FeeCache, amount_after_fees, amount_incl_fees
+
+        class FakeMarket(object):
+            id = 1
+
+        class FakeApi(object):
+            market = FakeMarket()
+            default_trade_fee = 0.006
+            trade_fee_max_age = 3600
+
+            def api_fetch_trade_fee(self):
+                return True, None, 0.005
+
+        api = FakeApi()
+        cache = FeeCache()
+        cache.fetch_times[1] = float('inf')
+        # Never fetched, and not due for a refresh - the default is used
+        self.assertEqual(cache.get_fee(api), 0.006)
+
+        self.assertEqual(cache.refresh(api), (True, None, 0.005))
+        self.assertEqual(cache.get_fee(api), 0.005)
+
+        self.assertAlmostEqual(amount_incl_fees(amount_after_fees(10.0, 0.005), 0.005), 10.0)
+
+
+class PriceSnapshotTest(TestCase):
+    def test_publish_prices_keeps_previous_entries(self):
+        from datetime import datetime
+        from django.core.cache import cache
+        from django.utils import timezone
+        from models import Currency, Market, MarketPrice
+        import snapshot
+
+        cache.delete(snapshot.SNAPSHOT_CACHE_KEY)
+        btc = Currency(abbrev='BTC')
+        usd = Currency(abbrev='USD')
+        a = Market(id=1, name='A', abbrev='a')
+        b = Market(id=2, name='B', abbrev='b')
+
+        def market_price(market, price):
+            return MarketPrice(market=market, currency_from=btc, currency_to=usd, buy_price=price,
+                               sell_price=price, time=datetime(2013, 9, 1, tzinfo=timezone.utc))
+
+        snapshot.publish_prices([a, b], {1: market_price(a, 100), 2: market_price(b, 101)})
+        # Market b failed to update - its last price stays in the snapshot
+        snapshot.publish_prices([a, b], {1: market_price(a, 102)})
+
+        prices = snapshot.get_snapshot()['markets']
+        self.assertEqual([(price['abbrev'], price['buy_price']) for price in prices], [('a', 102.0), ('b', 101.0)])
+        cache.delete(snapshot.SNAPSHOT_CACHE_KEY)
+
+
+class EventTest(TestCase):
+    def test_publish_and_get_events(self):
+        import events
+
+        since = events.latest_event_id()
+        first = events.publish('prices', [1])
+        events.publish('orders', [2])
+
+        self.assertEqual([(event['type'], event['data']) for event in events.get_events(since)],
+                         [('prices', [1]), ('orders', [2])])
+        self.assertEqual(len(events.get_events(first)), 1)
+        self.assertEqual(events.wait_for_events(first + 1, timeout=0), [])
+
+        # Clients too far behind are told to reload
+        self.assertEqual(events.get_events(first + 1 - events.MAX_EVENTS_PER_READ - 1)[0]['type'], 'reset')
+
+
+class OrderCursorTest(TestCase):
+    def test_cursor_round_trip(self):
+        from datetime import datetime
+        from django.utils import timezone
+        from models import Order
+        from views import decode_cursor, encode_cursor
+
+        when_created = datetime(2013, 9, 1, 12, 30, 15, 123456, tzinfo=timezone.utc)
+        cursor = encode_cursor(Order(id=42, when_created=when_created))
+        self.assertEqual(decode_cursor(cursor), (when_created, 42))
+
+
+class RegistryTest(TestCase):
+    def test_build_once_and_rebuild_on_change(self):
+        from registry import Registry
+
+        class Instance(object):
+            def __init__(self, id, name):
+                self.id = id
+                self.name = name
+
+        built = []
+
+        def factory(instance):
+            built.append(instance.name)
+            return instance.name.upper()
+
+        apis = Registry(factory, lambda instance: instance.name)
+        self.assertEqual(apis.get(Instance(1, 'a')), 'A')
+        self.assertEqual(apis.get(Instance(1, 'a')), 'A')
+        self.assertEqual(built, ['a'])
+
+        # The row has changed since the object was built
+        self.assertEqual(apis.get(Instance(1, 'b')), 'B')
+
+        apis.invalidate(1)
+        apis.get(Instance(1, 'b'))
+        self.assertEqual(built, ['a', 'b', 'b'])
+
+
+class OrderBookTest(TestCase):
+    def test_price_time_priority(self):
+        from orderbook import OrderBook
+
+        book = OrderBook()
+        first, fills = book.submit('S', 1.0, 100.0)
+        second, fills = book.submit('S', 1.0, 100.0)
+        cheaper, fills = book.submit('S', 1.0, 99.0)
+        self.assertEqual(book.best_price('S'), 99.0)
+
+        # Best price first, then oldest first - leaving part of the second order resting
+        order, fills = book.submit('B', 2.5, 100.0)
+        self.assertEqual(order.status, 'F')
+        self.assertEqual([(maker.id, price, amount) for maker, price, amount in fills],
+                         [(cheaper.id, 99.0, 1.0), (first.id, 100.0, 1.0), (second.id, 100.0, 0.5)])
+        self.assertEqual(second.status, 'O')
+        self.assertAlmostEqual(second.remaining, 0.5)
+
+        self.assertTrue(book.cancel(second.id))
+        self.assertFalse(book.cancel(second.id))
+        self.assertEqual(book.best_price('S'), None)
+
+        # Nothing left to take, so a market order is cancelled unfilled
+        order, fills = book.submit('B', 1.0)
+        self.assertEqual((order.status, fills), ('C', []))
+
+    def test_simulated_exchange(self):
+        from orderbook import SimulatedExchange
+
+        reference = {'price': 100.0}
+        exchange = SimulatedExchange(lambda now: reference['price'], spread=0.02, depth=5.0)
+        self.assertEqual(exchange.quote(), (101.0, 99.0))
+
+        order, fills = exchange.submit('B', 1.0, 98.0)
+        self.assertEqual(exchange.list_open_orders().keys(), [order.id])
+
+        # The price moves through the resting bid, and the market maker fills it
+        reference['price'] = 97.0
+        exchange.quote()
+        self.assertEqual(order.status, 'F')
+        self.assertEqual(exchange.list_open_orders(), {})
+        self.assertTrue(order.id in exchange.list_recent_fills())
+
+    def test_pickled_exchange(self):
+        import cPickle
+        from orderbook import SimulatedExchange
+
+        exchange = SimulatedExchange(lambda now: 100.0, spread=0.02, depth=5.0)
+        order, fills = exchange.submit('B', 1.0, 98.0)
+
+        # Another process picks up the same book, and continues its order ids
+        exchange = cPickle.loads(cPickle.dumps(exchange, cPickle.HIGHEST_PROTOCOL))
+        exchange.attach(lambda now: 97.0)
+        self.assertEqual(exchange.quote(), (97.97, 96.03))
+        self.assertTrue(order.id in exchange.list_recent_fills())
+        self.assertTrue(exchange.submit('B', 1.0, 90.0)[0].id > order.id)
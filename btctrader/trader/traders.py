@@ -1,3 +1,20 @@
+import math
+from django.db import transaction
+import models
+import candles
+import fees
+from marketdata import LiveMarketData
+from utils import datetime_to_timestamp, timestamp_to_datetime
+
+
+# Algorithm settings used when a trader's settings don't specify them
+ARBITRAGE_DEFAULTS = {
+    'amount': 0.1,
+    'min_profit': 0.002,
+    'default_fee': 0.006,
+    'max_price_age': 120,
+}
+EMA_DEFAULT_AMOUNT = 0.1
 
 
 class TraderBase(object):
@@ -5,12 +22,14 @@ class TraderBase(object):
     Defines the interface for a trading algorithm
     """
 
-    def __init__(self, trader):
+    def __init__(self, trader, data=None):
         """
         Instantiate the Trader Algorithm object. Stores a pointer back to the Trader
-        database object
+        database object, and the source of market data to base decisions on (live
+        data by default - historical simulations pass their own)
         """
         self.trader = trader
+        self.data = data if data is not None else LiveMarketData()
 
     def build_orders(self, markets, timestamp, settings):
         """
@@ -18,6 +37,15 @@ class TraderBase(object):
         """
         return []
 
+    def save_state(self):
+        """
+        Persist any internal state built up by build_orders. Called after live
+        trading runs only - build_orders itself must not modify the database,
+        other than to claim state that several workers could otherwise act on
+        at once (see EmaTrader)
+        """
+        pass
+
     def get_settings_dict(self, settings):
         if self.trader.abbrev in settings.algo.keys():
             return settings.algo[self.trader.abbrev]
@@ -35,25 +63,149 @@ class ArbitrageTrader(TraderBase):
     be taken to configure the algorithm correctly in order to limit excessive trading.
     """
 
+    def get_fee(self, market, settings):
+        """
+        Returns the fee (as a fraction) charged on the market, as given by the
+        market data - so simulations use the fees they were given, rather than
+        the live account's. Markets with no known fee are assumed to charge
+        default_fee
+        """
+        fee = self.data.fee(market)
+        return settings['default_fee'] if fee is None else fee
+
+    def find_opportunity(self, buys, sells, min_profit):
+        """
+        Given lists of (effective buy price, market) and (effective sell price,
+        market) tuples, sorted best first, returns the most profitable
+        (buy market, sell market) pair of different markets - or None if no pair
+        makes at least min_profit (as a fraction of the amount spent).
+
+        The best pair either uses the best buy and best sell markets, or (if those
+        are the same market) one of them alongside the runner up on the other
+        side, so only the first two entries of each list need to be considered
+        """
+        candidates = [(buy, sell) for buy in buys[:2] for sell in sells[:2] if buy[1].id != sell[1].id]
+        if len(candidates) == 0:
+            return None
+
+        buy, sell = max(candidates, key=lambda candidate: candidate[1][0] - candidate[0][0])
+        if sell[0] - buy[0] < min_profit * buy[0]:
+            return None
+        return buy[1], sell[1]
+
     def build_orders(self, markets, timestamp, trader_settings):
         settings = self.get_settings_dict(trader_settings)
+        if not settings:
+            return []
+        settings = dict(ARBITRAGE_DEFAULTS, **settings)
 
         # Only run if we have more than one available market
         if len(markets) <= 1:
             return []
 
+        now = datetime_to_timestamp(timestamp)
+
+        # Index the markets trading each currency pair by their effective buy and sell
+        # prices (i.e. including fees), so the best opportunity can be found after a
+        # sort, rather than by comparing every pair of markets
+        buys = {}
+        sells = {}
+        quotes = {}
+        market_fees = {}
+        for market in markets:
+            quote = self.data.quote(market, now)
+            if quote is None or now - quote[0] > settings['max_price_age']:
+                continue
+            quote_time, buy_price, sell_price = quote
+            if buy_price <= 0 or sell_price <= 0:
+                continue
+
+            fee = self.get_fee(market, settings)
+            if fee >= 1:
+                continue
+
+            pair = (market.default_currency_from_id, market.default_currency_to_id)
+            # Price paid for each unit actually received, and amount received for each unit sold
+            buys.setdefault(pair, []).append((fees.amount_incl_fees(buy_price, fee), market))
+            sells.setdefault(pair, []).append((fees.amount_after_fees(sell_price, fee), market))
+            quotes[market.id] = (buy_price, sell_price)
+            market_fees[market.id] = fee
+
         orders = []
 
-        # Run over alternate pairs of markets
-        # TODO: Optimize this code block!
-        for market_a in markets:
-            for market_b in markets:
-                if market_a.id != market_b.id:
-                    pass
+        for pair in buys.keys():
+            pair_buys = sorted(buys[pair], key=lambda entry: entry[0])
+            pair_sells = sorted(sells[pair], key=lambda entry: entry[0], reverse=True)
+
+            opportunity = self.find_opportunity(pair_buys, pair_sells, settings['min_profit'])
+            if opportunity is None:
+                continue
+
+            # Place both legs as limit orders at the quoted prices, so neither can fill
+            # at a price that wipes out the spread. Only sell as much as the buy leg
+            # delivers once its fee has been taken (rounded down to what an Order stores)
+            buy_market, sell_market = opportunity
+            buy_amount = settings['amount']
+            sell_amount = math.floor(fees.amount_after_fees(buy_amount, market_fees[buy_market.id]) * 1e5) / 1e5
+            for market, order_type, amount, price in ((buy_market, 'B', buy_amount, quotes[buy_market.id][0]),
+                                                      (sell_market, 'S', sell_amount, quotes[sell_market.id][1])):
+                orders.append(models.Order(order_type=order_type,
+                                           when_created=timestamp,
+                                           market=market,
+                                           market_order=False,
+                                           amount=amount,
+                                           price=price,
+                                           currency_from=market.default_currency_from,
+                                           currency_to=market.default_currency_to,
+                                           trader=self.trader))
 
         return orders
 
 
+class EmaCrossover(object):
+    """
+    Streaming short/long EMA pair for a single market and candle period.
+
+    Each closed candle updates both EMAs in O(1), so the full candle history never
+    needs to be revisited. The EMAs are seeded with the first close, and no
+    crossover signals are given until long_period candles have been seen.
+    """
+
+    def __init__(self, short_period, long_period):
+        self.short_alpha = 2.0 / (short_period + 1)
+        self.long_alpha = 2.0 / (long_period + 1)
+        self.warmup = long_period
+
+        self.short_ema = None
+        self.long_ema = None
+        self.candle_count = 0
+        self.last_start_time = None
+
+    def update(self, start_time, close_price):
+        """
+        Update with the close of the candle starting at start_time (a unix
+        timestamp). Returns 'B' if the short EMA crossed above the long EMA,
+        'S' if it crossed below, otherwise None
+        """
+        self.last_start_time = start_time
+        self.candle_count += 1
+
+        if self.short_ema is None:
+            self.short_ema = close_price
+            self.long_ema = close_price
+            return None
+
+        was_above = self.short_ema > self.long_ema
+        self.short_ema += self.short_alpha * (close_price - self.short_ema)
+        self.long_ema += self.long_alpha * (close_price - self.long_ema)
+        is_above = self.short_ema > self.long_ema
+
+        if self.candle_count <= self.warmup or was_above == is_above:
+            return None
+
+        return 'B' if is_above else 'S'
+
+
 class EmaTrader(TraderBase):
     """
     Trader built on the concept of EMA (Exponential Moving Average) crossover.
@@ -62,14 +214,103 @@ class EmaTrader(TraderBase):
 
     Ensure you configure the algorithm correctly.
     """
+
+    def __init__(self, trader, data=None):
+        super(EmaTrader, self).__init__(trader, data)
+
+        # EmaCrossover state for simulations, keyed by (market id, period in seconds)
+        self.crossovers = {}
+
+    def restore_crossover(self, state, settings):
+        """
+        Build an EmaCrossover from its persisted EmaState
+        """
+        crossover = EmaCrossover(settings['short_period'], settings['long_period'])
+        crossover.short_ema = state.short_ema
+        crossover.long_ema = state.long_ema
+        crossover.candle_count = state.candle_count
+        if state.last_start_time is not None:
+            crossover.last_start_time = datetime_to_timestamp(state.last_start_time)
+        return crossover
+
+    def update_crossover(self, crossover, market, period, closed_before):
+        """
+        Feed the candles closed since the crossover was last updated into it, and
+        return the signal given by the most recently closed one (or None)
+        """
+        start = crossover.last_start_time + period if crossover.last_start_time is not None else None
+        start_times, open_prices, highs, lows, close_prices, volumes = \
+            self.data.candles(market, period, start, closed_before)
+
+        # Only a crossover on the most recently closed candle is acted upon - any
+        # earlier ones (e.g. when catching up after a restart) are stale
+        signal = None
+        for start_time, close_price in zip(start_times.tolist(), close_prices.tolist()):
+            signal = crossover.update(start_time, close_price)
+        return signal
+
+    def update_live_crossover(self, market, period, closed_before, settings):
+        """
+        Update the persisted crossover state for a market, and return its signal.
+        The state is re-read on every run, with its row locked until the update is
+        saved - so however many workers run the trader, each candle is fed in (and
+        its signal given) exactly once
+        """
+        with transaction.commit_on_success():
+            state, created = models.EmaState.objects.select_for_update().get_or_create(
+                trader=self.trader, market=market, period=period)
+            crossover = self.restore_crossover(state, settings)
+
+            signal = self.update_crossover(crossover, market, period, closed_before)
+
+            if crossover.last_start_time is not None:
+                state.short_ema = crossover.short_ema
+                state.long_ema = crossover.long_ema
+                state.candle_count = crossover.candle_count
+                state.last_start_time = timestamp_to_datetime(crossover.last_start_time)
+                state.save()
+
+        return signal
+
     def build_orders(self, markets, timestamp, trader_settings):
         settings = self.get_settings_dict(trader_settings)
+        if not settings:
+            return []
+
+        period = candles.parse_period(settings['period'])
+        now = datetime_to_timestamp(timestamp)
+
+        # Only use candles that had closed by the given timestamp
+        closed_before = now - now % period
 
         orders = []
 
         # Run over each market
         for market in markets:
-            pass
+            if self.data.live:
+                signal = self.update_live_crossover(market, period, closed_before, settings)
+            else:
+                key = (market.id, period)
+                crossover = self.crossovers.get(key)
+
+                # Start afresh if there's no state yet, or we've been asked about the past
+                # (i.e. a new simulation) - the state can't be wound backwards
+                if crossover is None or (crossover.last_start_time is not None and
+                                         crossover.last_start_time >= closed_before):
+                    crossover = EmaCrossover(settings['short_period'], settings['long_period'])
+                    self.crossovers[key] = crossover
+
+                signal = self.update_crossover(crossover, market, period, closed_before)
+
+            if signal is not None:
+                orders.append(models.Order(order_type=signal,
+                                           when_created=timestamp,
+                                           market=market,
+                                           market_order=True,
+                                           amount=settings.get('amount', EMA_DEFAULT_AMOUNT),
+                                           currency_from=market.default_currency_from,
+                                           currency_to=market.default_currency_to,
+                                           trader=self.trader))
 
         return orders
 
@@ -0,0 +1,226 @@
+import numpy as np
+from django.db import connection
+from django.utils import timezone
+from datetime import timedelta
+import models
+from utils import datetime_to_timestamp, timestamp_to_datetime
+
+
+# Rows fetched from the database cursor at a time when loading a store
+TRADE_STORE_FETCH_SIZE = 100000
+
+# Initial number of trades a store has room for before it needs to grow
+TRADE_STORE_INITIAL_CAPACITY = 1024
+
+
+class TradeStore(object):
+    """
+    Columnar in-memory store of HistoricalTrade data for a single market and
+    currency pair.
+
+    Trades are held in contiguous NumPy arrays (int64 unix timestamps, float64
+    price and amount) sorted by time, rather than as one Django model instance
+    per trade. Appends are amortized O(1) and trimming old trades is O(1) until
+    the arrays are compacted. All accessors return views, not copies, so they
+    should be treated as read-only.
+    """
+
+    def __init__(self, market, currency_from, currency_to, capacity=TRADE_STORE_INITIAL_CAPACITY):
+        self.market = market
+        self.currency_from = currency_from
+        self.currency_to = currency_to
+
+        self._times = np.empty(capacity, dtype=np.int64)
+        self._prices = np.empty(capacity, dtype=np.float64)
+        self._amounts = np.empty(capacity, dtype=np.float64)
+
+        # Valid data lives in [_start, _end) - trimming only moves _start
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    @property
+    def times(self):
+        return self._times[self._start:self._end]
+
+    @property
+    def prices(self):
+        return self._prices[self._start:self._end]
+
+    @property
+    def amounts(self):
+        return self._amounts[self._start:self._end]
+
+    def load(self, start=None, end=None):
+        """
+        Replace the contents of the store with trades from the database, between
+        the start and end datetimes (either may be None for an open range)
+        """
+        trades = models.HistoricalTrade.objects.filter(market=self.market,
+                                                       currency_from=self.currency_from,
+                                                       currency_to=self.currency_to)
+        if start is not None:
+            trades = trades.filter(time__gte=start)
+        if end is not None:
+            trades = trades.filter(time__lt=end)
+
+        self._start = 0
+        self._end = 0
+
+        if connection.vendor == 'postgresql':
+            # Let the database do the conversion, so no datetime/Decimal objects get created
+            where = ['market_id = %s', 'currency_from_id = %s', 'currency_to_id = %s']
+            params = [self.market.id, self.currency_from.id, self.currency_to.id]
+            if start is not None:
+                where.append('time >= %s')
+                params.append(start)
+            if end is not None:
+                where.append('time < %s')
+                params.append(end)
+
+            cursor = connection.cursor()
+            table = models.HistoricalTrade._meta.db_table
+            cursor.execute('SELECT EXTRACT(EPOCH FROM time)::bigint, price::float8, amount::float8 FROM %s '
+                           'WHERE %s ORDER BY time, id' % (table, ' AND '.join(where)),
+                           params)
+            while True:
+                rows = cursor.fetchmany(TRADE_STORE_FETCH_SIZE)
+                if not rows:
+                    break
+                self._append_rows(rows)
+        else:
+            rows = []
+            for time, price, amount in trades.order_by('time', 'id').values_list('time', 'price', 'amount')\
+                                             .iterator():
+                rows.append((datetime_to_timestamp(time), price, amount))
+                if len(rows) >= TRADE_STORE_FETCH_SIZE:
+                    self._append_rows(rows)
+                    rows = []
+            self._append_rows(rows)
+
+        return self
+
+    def _append_rows(self, rows):
+        if len(rows) == 0:
+            return
+        columns = zip(*rows)
+        self.append(columns[0], columns[1], columns[2])
+
+    def _reserve(self, count):
+        """
+        Make sure there's room for count more trades at the end of the arrays,
+        compacting away trimmed trades or growing the arrays as required
+        """
+        size = len(self)
+        capacity = len(self._times)
+        if self._end + count <= capacity:
+            return
+
+        new_capacity = capacity
+        while size + count > new_capacity:
+            new_capacity *= 2
+
+        for name in ('_times', '_prices', '_amounts'):
+            old = getattr(self, name)
+            if new_capacity == capacity:
+                # Enough room once trimmed trades are discarded - compact in place
+                old[:size] = old[self._start:self._end]
+            else:
+                new = np.empty(new_capacity, dtype=old.dtype)
+                new[:size] = old[self._start:self._end]
+                setattr(self, name, new)
+
+        self._start = 0
+        self._end = size
+
+    def append(self, timestamps, prices, amounts):
+        """
+        Append trades to the store. Trades are expected to be newer than those
+        already present - if not, the store is re-sorted
+        """
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        count = len(timestamps)
+        if count == 0:
+            return
+
+        self._reserve(count)
+        out_of_order = len(self) > 0 and timestamps[0] < self._times[self._end - 1]
+
+        end = self._end + count
+        self._times[self._end:end] = timestamps
+        self._prices[self._end:end] = np.asarray(prices, dtype=np.float64)
+        self._amounts[self._end:end] = np.asarray(amounts, dtype=np.float64)
+        self._end = end
+
+        if out_of_order or np.any(np.diff(timestamps) < 0):
+            order = np.argsort(self.times, kind='mergesort')
+            self._times[self._start:self._end] = self.times[order]
+            self._prices[self._start:self._end] = self.prices[order]
+            self._amounts[self._start:self._end] = self.amounts[order]
+
+    def trim(self, min_timestamp):
+        """
+        Discard all trades older than min_timestamp
+        """
+        self._start += int(np.searchsorted(self.times, min_timestamp, side='left'))
+
+    def window(self, start_timestamp=None, end_timestamp=None):
+        """
+        Returns (times, prices, amounts) views covering [start_timestamp, end_timestamp)
+        """
+        times = self.times
+        lo = 0 if start_timestamp is None else int(np.searchsorted(times, start_timestamp, side='left'))
+        hi = len(times) if end_timestamp is None else int(np.searchsorted(times, end_timestamp, side='left'))
+        return times[lo:hi], self.prices[lo:hi], self.amounts[lo:hi]
+
+    def last_price(self, timestamp=None):
+        """
+        Returns the price of the last trade at or before timestamp, or None
+        """
+        times = self.times
+        idx = len(times) if timestamp is None else int(np.searchsorted(times, timestamp, side='right'))
+        if idx == 0:
+            return None
+        return float(self.prices[idx - 1])
+
+    @property
+    def first_time(self):
+        return timestamp_to_datetime(int(self.times[0])) if len(self) > 0 else None
+
+    @property
+    def last_time(self):
+        return timestamp_to_datetime(int(self.times[-1])) if len(self) > 0 else None
+
+
+# Per-process stores, keyed by (market id, currency_from id, currency_to id)
+trade_stores = {}
+
+
+def get_trade_store(market, currency_from, currency_to, days_to_keep):
+    """
+    Returns the TradeStore for the given market/currency pair, loading the last
+    days_to_keep days of trades from the database the first time it is requested
+    """
+    key = (market.id, currency_from.id, currency_to.id)
+    store = trade_stores.get(key)
+    if store is None:
+        store = TradeStore(market, currency_from, currency_to)
+        store.load(start=timezone.now() + timedelta(days=-days_to_keep))
+        trade_stores[key] = store
+    return store
+
+
+def append_trades(market, currency_from, currency_to, rows, days_to_keep):
+    """
+    Append newly stored (timestamp, price, amount) rows to the TradeStore for the
+    market/currency pair, and trim it to days_to_keep. Does nothing if no store
+    has been loaded in this process - it will pick the trades up when loaded.
+    """
+    store = trade_stores.get((market.id, currency_from.id, currency_to.id))
+    if store is None:
+        return
+
+    store._append_rows(rows)
+    store.trim(datetime_to_timestamp(timezone.now() + timedelta(days=-days_to_keep)))
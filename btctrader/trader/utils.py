@@ -0,0 +1,49 @@
+from django.utils import timezone
+from datetime import datetime
+import calendar
+
+
+# Defaults for market settings that an older trader_settings.py may not define
+MARKET_SETTING_DEFAULTS = {
+    'market_periods': ('1M', '5M', '1H', '1D'),
+    'rate_limit_dir': None,
+    'price_cache_shared': False,
+    'price_write_batch_size': 50,
+    'price_write_max_delay': 10,
+    'market_prices_days_to_keep': 7,
+    'historical_trades_expire': False,
+    'historical_trades_archive_expired': True,
+    # NullMarket - see trader_settings.py.default
+    'null_market_price_source': 'mtgox',
+    'null_market_replay_start': None,
+    'null_market_replay_days': 1,
+    'null_market_replay_speed': 1.0,
+    'null_market_spread': 0.002,
+    'null_market_depth': 10.0,
+    'null_market_latency': 0,
+    'null_market_failure_rate': 0,
+    'null_market_seed': None,
+    'null_market_state_dir': None,
+}
+
+
+def get_market_setting(settings, name):
+    """
+    Read a market setting, falling back to its default in MARKET_SETTING_DEFAULTS
+    if trader_settings.py doesn't define it
+    """
+    return getattr(settings, name, MARKET_SETTING_DEFAULTS[name])
+
+
+def datetime_to_timestamp(dt):
+    """
+    Convert an aware datetime into an integer unix timestamp
+    """
+    return calendar.timegm(dt.utctimetuple())
+
+
+def timestamp_to_datetime(timestamp):
+    """
+    Convert a unix timestamp into an aware (UTC) datetime
+    """
+    return datetime.fromtimestamp(timestamp, timezone.utc)
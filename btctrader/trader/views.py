@@ -1,9 +1,19 @@
+from django.conf import settings
 from django.shortcuts import render_to_response
-from django.http import HttpResponse, HttpResponseNotAllowed
+from django.db.models import Q
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed, HttpResponseNotFound, \
+    StreamingHttpResponse
 from django.template import RequestContext
+from django.utils import timezone
+from datetime import datetime, timedelta
+import json
+import time
+import urllib
 import markets
+import events
 import forms
-from models import Market, Order
+import snapshot
+from models import Market, Order, Trader, ORDER_STATUS_CHOICES
 
 
 def index(request):
@@ -16,24 +26,202 @@ def market_view(request, market_id):
     market = Market.objects.get(id=market_id)
     new_order_form = forms.NewOrderForm()
 
-    market_api = market.market_api()
+    market_api = market.market_api
 
     success, err, market_price = market_api.api_get_current_market_price()
 
     return render_to_response('trader/market_view.html',
-                              {'market': market, 'new_order_form': new_order_form, 'market_price': market_price},
+                              {'market': market, 'new_order_form': new_order_form, 'market_price': market_price,
+                               'event_stream': event_stream_enabled()},
                               context_instance=RequestContext(request))
 
 
 def dashboard(request):
     markets = Market.objects.all()
-    recent_orders = Order.objects.all().order_by('-when_created')[0:30]
+    recent_orders = Order.objects.select_related('market', 'currency_from', 'currency_to', 'trader')\
+                                 .order_by('-when_created', '-id')[0:30]
+
+    # Prices come from the snapshot kept up to date by the agent, so rendering the
+    # page never waits on a market
+    price_snapshot = snapshot.get_snapshot()
 
     return render_to_response('trader/dashboard.html',
-                              {'markets': markets, 'recent_orders': recent_orders},
+                              {'markets': markets, 'recent_orders': recent_orders, 'snapshot': price_snapshot,
+                               'event_stream': event_stream_enabled()},
+                              context_instance=RequestContext(request))
+
+
+# Orders per page of order history, by default and at most
+ORDER_PAGE_SIZE = 50
+MAX_ORDER_PAGE_SIZE = 500
+
+CURSOR_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def encode_cursor(order):
+    """
+    Position of an order in the history, as a string - its creation time (in
+    microseconds) and id
+    """
+    delta = order.when_created - CURSOR_EPOCH
+    microseconds = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    return '%d_%d' % (microseconds, order.id)
+
+
+def decode_cursor(cursor):
+    microseconds, order_id = cursor.split('_')
+    return CURSOR_EPOCH + timedelta(microseconds=int(microseconds)), int(order_id)
+
+
+def get_order_page(params):
+    """
+    Returns a page of orders, newest first, along with the cursor of the page
+    after it (or None if it's the last page). params may filter by market,
+    status and trader, and give the cursor to start from as 'before'.
+
+    Pages are found by seeking to the cursor's (when_created, id) position over
+    an index, rather than with an OFFSET, so any page costs the same to fetch.
+    There's an index for no filter, and for each of the filters on its own (see
+    Order.Meta) - combining filters seeks over one of them and checks the rest
+    row by row. Related objects are fetched in the same query. Raises
+    ValueError if the parameters are invalid
+    """
+    page_size = min(int(params.get('page_size', ORDER_PAGE_SIZE)), MAX_ORDER_PAGE_SIZE)
+    if page_size <= 0:
+        raise ValueError('Invalid page size')
+
+    orders = Order.objects.select_related('market', 'currency_from', 'currency_to', 'trader')
+    if params.get('market'):
+        orders = orders.filter(market=int(params['market']))
+    if params.get('status'):
+        if params['status'] not in dict(ORDER_STATUS_CHOICES):
+            raise ValueError('Invalid status')
+        orders = orders.filter(status=params['status'])
+    if params.get('trader'):
+        orders = orders.filter(trader=int(params['trader']))
+    if params.get('before'):
+        when_created, order_id = decode_cursor(params['before'])
+        # The OR can't be used to seek the index by itself, so it's bounded by a plain
+        # range on when_created as well
+        orders = orders.filter(Q(when_created__lt=when_created) | Q(when_created=when_created, id__lt=order_id),
+                               when_created__lte=when_created)
+
+    # Fetch one extra order to find out whether there's another page
+    page = list(orders.order_by('-when_created', '-id')[:page_size + 1])
+    next_cursor = encode_cursor(page[page_size - 1]) if len(page) > page_size else None
+    return page[:page_size], next_cursor
+
+
+def order_history(request):
+    try:
+        orders, next_cursor = get_order_page(request.GET)
+    except ValueError:
+        return HttpResponseBadRequest('Invalid parameters')
+
+    filters = dict((name, request.GET[name]) for name in ('market', 'status', 'trader', 'page_size')
+                   if request.GET.get(name))
+    next_query = urllib.urlencode(dict(filters, before=next_cursor)) if next_cursor is not None else None
+
+    return render_to_response('trader/order_history.html',
+                              {'orders': orders, 'next_query': next_query, 'filters': filters,
+                               'markets': Market.objects.all(), 'traders': Trader.objects.all(),
+                               'statuses': ORDER_STATUS_CHOICES},
                               context_instance=RequestContext(request))
 
 
+def order_list(request):
+    """
+    JSON API for the order history. Takes the same parameters as order_history,
+    and returns a page of orders along with the cursor to pass as 'before' to
+    get the next page
+    """
+    try:
+        orders, next_cursor = get_order_page(request.GET)
+    except ValueError:
+        return HttpResponseBadRequest('Invalid parameters')
+
+    return HttpResponse(json.dumps({'orders': [events.order_entry(order) for order in orders],
+                                    'next': next_cursor}),
+                        content_type='application/json')
+
+
+def price_snapshot(request):
+    return HttpResponse(json.dumps(snapshot.get_snapshot()), content_type='application/json')
+
+
+# Seconds an event stream is held open before the browser is asked to reconnect, and
+# seconds a long-poll request waits for events
+EVENT_STREAM_DURATION = 60
+EVENT_POLL_TIMEOUT = 25
+
+# Seconds between polls, when events can't be waited for
+EVENT_POLL_INTERVAL = 3
+
+
+def event_stream_enabled():
+    # Waiting for events holds a worker, so needs asynchronous workers - see TRADER_EVENT_STREAM
+    return getattr(settings, 'TRADER_EVENT_STREAM', False)
+
+
+def get_last_event_id(request):
+    # EventSource sends the id of the last event it saw when reconnecting
+    last_event_id = request.META.get('HTTP_LAST_EVENT_ID', request.GET.get('since'))
+    try:
+        return int(last_event_id)
+    except (TypeError, ValueError):
+        return events.latest_event_id()
+
+
+def event_stream(request):
+    """
+    Server-sent event stream of price and order updates. Each event is a delta -
+    clients get the full state from the page (or the price snapshot) first.
+    Only available when TRADER_EVENT_STREAM is enabled
+    """
+    if not event_stream_enabled():
+        return HttpResponseNotFound()
+
+    since = get_last_event_id(request)
+
+    def stream():
+        last_event_id = since
+        deadline = time.time() + EVENT_STREAM_DURATION
+        yield 'retry: 1000\n\n'
+        while time.time() < deadline:
+            stream_events = events.wait_for_events(last_event_id, min(15, deadline - time.time()))
+            for event in stream_events:
+                last_event_id = event['id']
+                yield 'id: %d\nevent: %s\ndata: %s\n\n' % (event['id'], event['type'], json.dumps(event['data']))
+            if len(stream_events) == 0:
+                # Keep the connection alive through proxies
+                yield ': keep-alive\n\n'
+
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+def event_poll(request):
+    """
+    Polling alternative to event_stream. Returns the events published after
+    the 'since' event id, along with the id to pass as since next time, and
+    the number of milliseconds to wait before polling again. If
+    TRADER_EVENT_STREAM is enabled this is a long-poll, waiting for events
+    before returning - otherwise it returns straight away
+    """
+    since = get_last_event_id(request)
+    if event_stream_enabled():
+        poll_events = events.wait_for_events(since, EVENT_POLL_TIMEOUT)
+        retry = 0
+    else:
+        poll_events = events.get_events(since)
+        retry = EVENT_POLL_INTERVAL * 1000
+    last_event_id = poll_events[-1]['id'] if len(poll_events) > 0 else since
+
+    return HttpResponse(json.dumps({'last_event_id': last_event_id, 'events': poll_events, 'retry': retry}),
+                        content_type='application/json')
+
+
 def order_submit(request):
     if request.method != 'POST':
         return HttpResponseNotAllowed(['POST'])
@@ -56,7 +244,10 @@ def order_submit(request):
         order.price = price
 
     order.save()
-    market.market_api.api_execute_order(order)
+    success, err, result = market.market_api.api_execute_order(order)
+    if success:
+        order.save()
+        events.publish('orders', [events.order_entry(order)])
 
     return render_to_response('trader/json/success_plain.json',
                               content_type="application/json",